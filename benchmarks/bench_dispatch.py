@@ -0,0 +1,101 @@
+"""
+Compare the cost of finding the extractor for a url
+  legacy: the old chain of uncompiled `re.match('.*host.*', url)` checks
+  registry: utils.extractor_registry host lookup
+
+Run from the repo root: python3 benchmarks/bench_dispatch.py [num_urls]
+"""
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.extractor_registry import default_registry
+
+SUPPORTED_EXT = ['3g2', '3gp', 'asf', 'asx', 'avi', 'flv', 'm2ts', 'mkv', 'mov', 'mp4', 'mpg', 'mpeg',
+                 'rm', 'swf', 'vob', 'wmv', 'mp3', 'wma', 'wav', 'ra', 'ram', 'rm', 'mid', 'ogg', 'acc',
+                 'm4a', 'jpeg', 'jpg', 'tiff', 'rif', 'gif', 'bmp', 'png', 'svg', 'gifv', 'pdf', 'zip',
+                 'rar', 'tar', 'gz', '7z',
+                 ]
+
+# Rough mix of what shows up in /r/all
+URL_TEMPLATES = [(30, 'http://i.imgur.com/{id}.jpg'),
+                 (10, 'http://i.redd.it/{id}.png'),
+                 (12, 'http://imgur.com/a/{id}'),
+                 (8, 'https://imgur.com/{id}'),
+                 (10, 'https://www.youtube.com/watch?v={id}'),
+                 (3, 'https://youtu.be/{id}'),
+                 (6, 'https://gfycat.com/{id}'),
+                 (2, 'http://www.vidble.com/album/{id}'),
+                 (1, 'http://v.pornbot.net/{id}'),
+                 (1, 'https://www.pornhub.com/view_video.php?viewkey={id}'),
+                 (17, 'https://www.{id}.com/news/story-{id}'),
+                 ]
+
+
+def legacy_dispatch(url):
+    url_temp = url.split('?')[0]
+    if url_temp.split('.')[-1].lower() in SUPPORTED_EXT:
+        return 'single_file'
+    elif re.match('.*imgur.com.*', url):
+        return 'imgur'
+    elif re.match('.*youtu(be\.com|\.be).*', url) or \
+         re.match('.*vid\.me.*', url) or \
+         re.match('.*vimeo\.com.*', url) or \
+         re.match('.*xvideos\.com.*', url) or \
+         re.match('.*xvids\.us.*', url) or \
+         re.match('.*xvid6\.com.*', url) or \
+         re.match('.*soundgasm\.net.*', url) or \
+         re.match('.*mrpeepers\.net.*', url) or \
+         re.match('.*lovefreeporn\.com.*', url) or \
+         re.match('.*extremetube\.com.*', url) or \
+         re.match('.*vidbox\.us.*', url) or \
+         re.match('.*pornhub\.com.*', url) or \
+         re.match('.*xhamster\.com.*', url):
+        return 'youtube_dl'
+    elif re.match('.*gfycat\.com.*', url):
+        return 'gfycat'
+    elif re.match('.*vidble\.com.*', url):
+        return 'vidble'
+    elif re.match('.*pornbot\.net.*', url):
+        return 'pornbot'
+    return None
+
+
+def make_corpus(num_urls, seed=1):
+    rand = random.Random(seed)
+    weights = [weight for weight, template in URL_TEMPLATES]
+    templates = [template for weight, template in URL_TEMPLATES]
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    corpus = []
+    for template in rand.choices(templates, weights=weights, k=num_urls):
+        corpus.append(template.format(id=''.join(rand.choice(chars) for _ in range(7))))
+    return corpus
+
+
+def bench(name, func, corpus):
+    start = time.perf_counter()
+    results = [func(url) for url in corpus]
+    took = time.perf_counter() - start
+    print(name.ljust(10) + str(round(took, 3)).rjust(8) + "s" +
+          str(round(took / len(corpus) * 1e9)).rjust(8) + " ns/url")
+    return results
+
+
+if __name__ == '__main__':
+    num_urls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    corpus = make_corpus(num_urls)
+    registry = default_registry(SUPPORTED_EXT)
+
+    def registry_dispatch(url):
+        extractor = registry.find(url)
+        return None if extractor is None else extractor.name
+
+    print("Dispatching " + str(num_urls) + " urls")
+    legacy = bench('legacy', legacy_dispatch, corpus)
+    new = bench('registry', registry_dispatch, corpus)
+
+    mismatches = sum(1 for a, b in zip(legacy, new) if a != b)
+    print("Mismatched results: " + str(mismatches))
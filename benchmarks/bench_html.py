@@ -0,0 +1,103 @@
+"""
+Compare the cost of getting the links out of imgur, vidble and pornbot pages
+  soup: what _get_html used to do, BeautifulSoup(page) with the default parser then find_all
+  strainer: BeautifulSoup with a SoupStrainer and the fastest parser installed (lxml, else html.parser)
+  fast: utils.html_extract, one compiled pattern over the page
+soup and strainer are skipped if beautifulsoup4 is not installed
+Pages are in benchmarks/fixtures, named <extractor>_<anything>.html, expected.json has the links each should give
+
+Run from the repo root: python3 benchmarks/bench_html.py [iterations]
+"""
+import os
+import sys
+import json
+import time
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import html_extract
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def soup_imgur(page):
+    files = []
+    for content in html_extract.BeautifulSoup(page).find_all("div", {"class": "image"}):
+        image_url = content.find("img")
+        if image_url is not None:
+            files.append(image_url['src'])
+        else:
+            video_url = content.find("source", {"type": "video/mp4"})
+            if video_url:
+                files.append(video_url['src'])
+    return files
+
+
+def soup_vidble(page):
+    images = []
+    for content in html_extract.BeautifulSoup(page).find_all("img", {"class": "img2"}):
+        images.append(content.get('src') or content['data-original'])
+    return images
+
+
+def soup_pornbot(page):
+    return [content['href'] for content in html_extract.BeautifulSoup(page).find_all("a", {"target": "_new"})]
+
+
+SOUP = {'imgur': soup_imgur, 'vidble': soup_vidble, 'pornbot': soup_pornbot}
+
+
+def bench(func, page, iterations):
+    """
+    :return: (seconds per page, links found)
+    """
+    start = time.perf_counter()
+    for i in range(iterations):
+        found = func(page)
+    return (time.perf_counter() - start) / iterations, found
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    # No parser given is what the old code did, do not fill the output with the warning about it
+    warnings.simplefilter('ignore')
+
+    with open(os.path.join(FIXTURES, 'expected.json')) as f:
+        expected = json.load(f)
+
+    if html_extract.BeautifulSoup is None:
+        print("beautifulsoup4 is not installed, only timing the fast path")
+    else:
+        print("Strainer parser: " + html_extract.SOUP_PARSER)
+    print("fixture".ljust(22) + "KB".rjust(6) + "links".rjust(7) + "soup(ms)".rjust(10) +
+          "strainer(ms)".rjust(14) + "fast(ms)".rjust(10) + "speedup".rjust(9))
+
+    mismatches = 0
+    for name in sorted(os.listdir(FIXTURES)):
+        if not name.endswith('.html'):
+            continue
+        extractor = name.split('_')[0].split('.')[0]
+        with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+            page = f.read()
+        fast, soup = html_extract.EXTRACTORS[extractor]
+
+        results = {'fast': bench(fast, page, iterations)}
+        if html_extract.BeautifulSoup is not None:
+            results['soup'] = bench(SOUP[extractor], page, iterations)
+            results['strainer'] = bench(soup, page, iterations)
+
+        for method, (took, found) in results.items():
+            if found != expected[name]:
+                mismatches += 1
+                print("  " + method + " gave different links for " + name + ": " + str(found))
+
+        def ms(method):
+            return ('-' if method not in results else str(round(results[method][0] * 1000, 2)))
+
+        speedup = '-'
+        if 'soup' in results:
+            speedup = str(round(results['soup'][0] / results['fast'][0], 1)) + "x"
+        print(name.ljust(22) + str(round(len(page) / 1024)).rjust(6) + str(len(expected[name])).rjust(7) +
+              ms('soup').rjust(10) + ms('strainer').rjust(14) + ms('fast').rjust(10) + speedup.rjust(9))
+
+    print("Mismatched results: " + str(mismatches))
@@ -0,0 +1,106 @@
+"""
+Compare the time and bytes it takes to save post dicts as json
+  legacy: json.dump(sort_keys=True, indent=4), what save_file used to do
+  the rest: utils.json_serializer with each library/format
+
+Uses post.json files from a save path if one is given, else made up posts shaped like praw submissions
+Run from the repo root: python3 benchmarks/bench_json.py [num_posts] [save_path]
+"""
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.json_serializer import JsonSerializer, orjson, ujson
+
+
+def make_post(rand):
+    chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
+
+    def word(length):
+        return ''.join(rand.choice(chars) for _ in range(length))
+
+    post_id = word(6)
+    author = word(rand.randint(4, 16))
+    subreddit = word(rand.randint(3, 14))
+    created = 1460000000.0 + rand.randint(0, 30000000)
+    is_self = rand.random() < 0.3
+    url = 'https://www.reddit.com/r/' + subreddit + '/comments/' + post_id + '/' if is_self else \
+          'http://i.imgur.com/' + word(7) + '.jpg'
+    selftext = ' '.join(word(rand.randint(2, 9)) for _ in range(rand.randint(0, 300))) if is_self else ''
+    return {'approved_by': None, 'archived': False, 'author': author, 'author_flair_css_class': None,
+            'author_flair_text': None, 'banned_by': None, 'clicked': False, 'created': created + 28800,
+            'created_utc': created, 'distinguished': None, 'domain': 'self.' + subreddit if is_self else 'i.imgur.com',
+            'downs': 0, 'edited': False, 'from': None, 'from_id': None, 'from_kind': None, 'gilded': 0,
+            'hidden': False, 'hide_score': False, 'id': post_id, 'is_self': is_self, 'likes': None,
+            'link_flair_css_class': None, 'link_flair_text': None, 'locked': False, 'media': None,
+            'media_embed': {}, 'mod_reports': [], 'name': 't3_' + post_id, 'num_comments': rand.randint(0, 50),
+            'num_reports': None, 'over_18': rand.random() < 0.2,
+            'permalink': '/r/' + subreddit + '/comments/' + post_id + '/' + word(20) + '/',
+            'post_hint': 'image', 'preview': {'images': [{'id': word(40), 'resolutions': [
+                {'height': 108 * i, 'url': 'https://i.redditmedia.com/' + word(43) + '.jpg?w=' + str(108 * i),
+                 'width': 108 * i} for i in range(1, 6)], 'source': {'height': 1000, 'url': url, 'width': 800},
+                'variants': {}}]},
+            'quarantine': False, 'removal_reason': None, 'report_reasons': None, 'saved': False,
+            'score': rand.randint(1, 10), 'secure_media': None, 'secure_media_embed': {},
+            'selftext': selftext, 'selftext_html': '<div class="md"><p>' + selftext + '</p></div>' if is_self else None,
+            'stickied': False, 'subreddit': subreddit, 'subreddit_id': 't5_' + word(5), 'suggested_sort': None,
+            'thumbnail': 'http://b.thumbs.redditmedia.com/' + word(43) + '.jpg', 'title': ' '.join(
+                word(rand.randint(2, 9)) for _ in range(rand.randint(3, 20))),
+            'ups': rand.randint(1, 10), 'url': url, 'user_reports': [], 'visited': False,
+            'user_web_path': '/user/' + author[0] + '/' + author + '/',
+            'post_web_path': '/user/' + author[0] + '/' + author + '/posts/2016/4/7/' + str(int(created)) + '/',
+            }
+
+
+def load_corpus(num_posts, save_path=None, seed=1):
+    if save_path is None:
+        rand = random.Random(seed)
+        return [make_post(rand) for _ in range(num_posts)]
+
+    corpus = []
+    for root, dirs, files in os.walk(os.path.join(save_path, 'user')):
+        if 'post.json' in files:
+            with open(os.path.join(root, 'post.json')) as f:
+                corpus.append(json.load(f))
+            if len(corpus) >= num_posts:
+                break
+    return corpus
+
+
+def bench(name, encode, decode, corpus):
+    start = time.perf_counter()
+    encoded = [encode(post) for post in corpus]
+    encode_took = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for data in encoded:
+        decode(data)
+    decode_took = time.perf_counter() - start
+
+    total_bytes = sum(len(data) for data in encoded)
+    print(name.ljust(22) +
+          str(round(encode_took / len(corpus) * 1e6, 1)).rjust(8) + " us/post dump" +
+          str(round(decode_took / len(corpus) * 1e6, 1)).rjust(8) + " us/post load" +
+          str(round(total_bytes / len(corpus))).rjust(8) + " bytes/post")
+
+
+if __name__ == '__main__':
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    save_path = sys.argv[2] if len(sys.argv) > 2 else None
+    corpus = load_corpus(num_posts, save_path)
+    print("Serializing " + str(len(corpus)) + " posts")
+
+    bench('legacy', lambda post: json.dumps(post, sort_keys=True, indent=4), json.loads, corpus)
+    libraries = ['json']
+    if ujson is not None:
+        libraries.append('ujson')
+    if orjson is not None:
+        libraries.append('orjson')
+    for library in libraries:
+        for pretty, sort_keys, ensure_ascii in [(True, True, True), (False, True, False), (False, False, False)]:
+            serializer = JsonSerializer(library, pretty=pretty, sort_keys=sort_keys, ensure_ascii=ensure_ascii)
+            name = library + (' pretty' if pretty else ' compact utf8') + (' sorted' if sort_keys else '')
+            bench(name, serializer.encode, serializer.decode, corpus)
@@ -0,0 +1,246 @@
+"""
+Measure how many posts a second RedditScraper can get through, without reddit or the real media hosts
+  A made up (or recorded) submission stream is passed in place of /r/all
+  Every download goes through benchmarks/fake_hosts.py, which stands in for imgur, gfycat and direct file hosts
+For each num_threads it reports posts/sec, p50/p99 seconds from a post being queued to it being saved,
+MB/sec downloaded and read/write syscalls per post (Linux only, from /proc/self/io)
+
+Needs the same packages as main.py. Run from the repo root:
+  python3 benchmarks/bench_scraper.py --posts 500 --threads 1,4,16 --latency 0.05
+  python3 benchmarks/bench_scraper.py --replay <json segment or file with a post per line>
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from main import RedditScraper
+from bench_json import make_post
+from fake_hosts import FakeHosts
+from utils.log import setup_custom_logger
+from utils.http_client import HttpClient
+from utils.host_scheduler import HostScheduler
+from utils.json_segments import SegmentReader
+
+# Rough mix of what shows up in /r/all
+URL_TEMPLATES = [(35, 'http://i.imgur.com/{id}.jpg'),
+                 (15, 'http://i.redd.it/{id}.png'),
+                 (10, 'http://imgur.com/a/{id}'),
+                 (10, 'http://imgur.com/{id}'),
+                 (10, 'http://gfycat.com/{id}'),
+                 (20, None),  # self post
+                 ]
+
+
+class FakeAuthor:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeSubmission:
+    """
+    Just enough of a praw submission for RedditScraper.submission_to_dict
+    """
+
+    def __init__(self, post):
+        self.__dict__.update(post)
+        self.author = FakeAuthor(post['author']) if post.get('author') not in [None, '[deleted]'] else None
+
+
+def synthetic_posts(num_posts, seed=1):
+    rand = random.Random(seed)
+    weights = [weight for weight, template in URL_TEMPLATES]
+    templates = [template for weight, template in URL_TEMPLATES]
+    chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    posts = []
+    for template in rand.choices(templates, weights=weights, k=num_posts):
+        post = make_post(rand)
+        if template is None:
+            post['is_self'] = True
+            post['url'] = 'http://www.reddit.com/r/' + post['subreddit'] + '/comments/' + post['id'] + '/'
+            post['domain'] = 'self.' + post['subreddit']
+            post['thumbnail'] = 'self'
+        else:
+            post['is_self'] = False
+            post['url'] = template.format(id=''.join(rand.choice(chars) for _ in range(7)))
+            post['domain'] = post['url'].split('/')[2]
+        posts.append(post)
+    return posts
+
+
+def recorded_posts(replay_file, num_posts):
+    """
+    :return: up to `num_posts` posts from a json segment, or a file with one post json per line
+    """
+    if '.jsonl' in replay_file:
+        source = SegmentReader().iter_posts(replay_file)
+    else:
+        source = (json.loads(line) for line in open(replay_file) if line.strip())
+
+    posts = []
+    for post in source:
+        # The fake hosts can only answer plain http
+        for key in ['url', 'thumbnail']:
+            if isinstance(post.get(key), str) and post[key].startswith('https://'):
+                post[key] = 'http://' + post[key][len('https://'):]
+        # Saved posts have the paths of where they were saved, work them out again
+        for key in ['user_web_path', 'post_web_path', 'user_save_path', 'post_save_path', 'file_downloads']:
+            post.pop(key, None)
+        posts.append(post)
+        if len(posts) >= num_posts:
+            break
+    return posts
+
+
+def syscalls():
+    """
+    :return: read + write syscalls made by this process so far, None if the os does not tell us
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counts = dict(line.split(':') for line in f.read().splitlines())
+        return int(counts['syscr']) + int(counts['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class BenchScraper(RedditScraper):
+    """
+    Times each post from the filter stage until it has been saved
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.queued = {}
+        self.latencies = []
+        self.timing_lock = threading.Lock()
+        self.run_time = 0
+        self.num_syscalls = None
+        super().__init__(*args, **kwargs)
+
+    def main(self):
+        self.started = time.perf_counter()
+        self.start_syscalls = syscalls()
+        super().main()
+
+    def cleanup(self):
+        # Flushing the buffered csv/listing writes is part of saving the posts
+        super().cleanup()
+        self.run_time = time.perf_counter() - self.started
+        end_syscalls = syscalls()
+        if end_syscalls is not None and self.start_syscalls is not None:
+            self.num_syscalls = end_syscalls - self.start_syscalls
+
+    def filter_stage(self, raw_post):
+        self.queued[raw_post.id] = time.perf_counter()
+        super().filter_stage(raw_post)
+
+    def persist_post(self, post):
+        super().persist_post(post)
+        took = time.perf_counter() - self.queued.pop(post['id'])
+        with self.timing_lock:
+            self.latencies.append(took)
+
+
+def run(posts, num_threads, hosts, args):
+    save_path = tempfile.mkdtemp(prefix='bench_scraper_')
+    try:
+        scrape_config_file = os.path.join(save_path, 'scrape.ini')
+        with open(scrape_config_file, 'w') as f:
+            f.write("[scrape]\nsubreddits = all\nusers =\n")
+
+        # Send every download to the fake hosts, with no rate limits so we only measure the scraper
+        http_client = HttpClient('root', pool_size=max(10, num_threads), stats_interval=0)
+        http_client.session.trust_env = False
+        http_client.session.proxies = {'http': hosts.proxy_url}
+        scheduler = HostScheduler(rate=1000000, burst=1000000, concurrency=1000000)
+
+        start_stats = hosts.stats()
+        stream = [FakeSubmission(dict(post)) for post in posts]
+        # The status line is printed for every post, keep it out of the results
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            scraper = BenchScraper({'user': '', 'pass': '', 'force': 'false'}, save_path, num_threads, False,
+                                   persist_threads=args.persist_threads, stream=stream,
+                                   scrape_config_file=scrape_config_file,
+                                   download_opts={'http_client': http_client, 'scheduler': scheduler})
+        end_stats = hosts.stats()
+        http_client.close()
+
+        num_saved = len(scraper.latencies)
+        downloaded = end_stats['bytes'] - start_stats['bytes']
+        result = {'threads': num_threads,
+                  'posts': num_saved,
+                  'posts_per_sec': num_saved / scraper.run_time,
+                  'p50': percentile(scraper.latencies, 50),
+                  'p99': percentile(scraper.latencies, 99),
+                  'mb_per_sec': downloaded / scraper.run_time / 1048576,
+                  'syscalls_per_post': scraper.num_syscalls / max(1, num_saved) if scraper.num_syscalls is not None else None,
+                  }
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(save_path, ignore_errors=True)
+
+
+def print_result(result):
+    syscalls_per_post = result['syscalls_per_post']
+    print(str(result['threads']).rjust(7) +
+          str(result['posts']).rjust(7) +
+          str(round(result['posts_per_sec'], 1)).rjust(11) +
+          str(round(result['p50'], 3)).rjust(9) +
+          str(round(result['p99'], 3)).rjust(9) +
+          str(round(result['mb_per_sec'], 1)).rjust(8) +
+          ('-' if syscalls_per_post is None else str(round(syscalls_per_post))).rjust(15))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--threads', default='1,4,16')
+    parser.add_argument('--persist_threads', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--bandwidth', type=float, default=0)
+    parser.add_argument('--image_size', type=int, default=200000)
+    parser.add_argument('--video_size', type=int, default=2000000)
+    parser.add_argument('--replay')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+
+    log_path = tempfile.mkdtemp(prefix='bench_scraper_logs_')
+    logger = setup_custom_logger('root', os.path.join(log_path, 'bench_scraper.log'))
+
+    if args.replay:
+        posts = recorded_posts(args.replay, args.posts)
+    else:
+        posts = synthetic_posts(args.posts)
+
+    hosts = FakeHosts(latency=args.latency, bandwidth=args.bandwidth,
+                      image_size=args.image_size, video_size=args.video_size)
+    try:
+        if not args.json:
+            print("Scraping " + str(len(posts)) + " posts, " + str(args.latency) + "s host latency, log in " + log_path)
+            print("threads  posts  posts/sec   p50(s)   p99(s)   MB/sec  syscalls/post")
+        for num_threads in [int(n) for n in args.threads.split(',')]:
+            result = run(posts, num_threads, hosts, args)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print_result(result)
+    finally:
+        hosts.stop()
@@ -0,0 +1,157 @@
+"""
+Stand in for the media hosts ExternalDownload talks to, so benchmarks never touch the internet
+Runs as an http proxy in its own process: point the http client at it and every http:// url is answered here
+  gfycat.com/cajax/get/<id>          gfycat api json, links to giant.gfycat.com/<id>.gif and .mp4
+  imgur.com/a/<id>/noscript          imgur album page with `album_size` images
+  imgur.com/<id>                     imgur page with one image
+  any url ending in a file extension the file, `video_size` bytes for videos else `image_size` bytes
+Anything else is a 404. Every response waits `latency` seconds first, files are sent at `bandwidth` bytes/sec
+
+Run on its own: python3 benchmarks/fake_hosts.py [port]
+"""
+import os
+import sys
+import json
+import time
+import multiprocessing
+from urllib.parse import urlsplit
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+VIDEO_EXT = ['mp4', 'webm', 'mov', 'avi', 'mkv', 'flv', 'wmv']
+
+# Sent over and over to make up the file bodies, so making a response costs next to nothing
+FILLER = bytes(range(256)) * 256
+
+
+class FakeHostServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeHostHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        opts = self.server.opts
+        # Proxy requests have the full url as the path
+        url = urlsplit(self.path)
+        host = (url.hostname or self.headers.get('Host', '')).lower()
+        path = url.path
+        name = path.rstrip('/').split('/')[-1]
+
+        if opts['latency'] > 0:
+            time.sleep(opts['latency'])
+
+        if host.endswith('gfycat.com') and path.startswith('/cajax/get/'):
+            self.send_body(json.dumps({'gfyItem': {'gifUrl': 'http://giant.gfycat.com/' + name + '.gif',
+                                                   'mp4Url': 'http://giant.gfycat.com/' + name + '.mp4',
+                                                   }}).encode('utf-8'), 'application/json')
+        elif '.' in name:
+            ext = name.rsplit('.', 1)[-1].lower()
+            self.send_file(opts['video_size'] if ext in VIDEO_EXT else opts['image_size'])
+        elif host.endswith('imgur.com'):
+            parts = [part for part in path.split('/') if part]
+            if len(parts) >= 2 and parts[0] == 'a':
+                images = [parts[1] + str(i) for i in range(opts['album_size'])]
+            else:
+                images = [name]
+            html = '<html><body>'
+            for image in images:
+                html += '<div class="image"><a href="//i.imgur.com/' + image + '.jpg">' \
+                        '<img src="//i.imgur.com/' + image + '.jpg" /></a></div>'
+            html += '</body></html>'
+            self.send_body(html.encode('utf-8'), 'text/html')
+        else:
+            self.send_body(b'Not Found', 'text/plain', status=404)
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.count(len(body))
+
+    def send_file(self, size):
+        # Start each file with its url so every file has its own hash
+        first = (self.path + "\n").encode('utf-8')
+        size = max(size, len(first))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+        bandwidth = self.server.opts['bandwidth']
+        self.wfile.write(first)
+        sent = len(first)
+        while sent < size:
+            chunk = FILLER[:min(len(FILLER), size - sent)]
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            if bandwidth > 0:
+                time.sleep(len(chunk) / bandwidth)
+        self.count(size)
+
+    def count(self, num_bytes):
+        with self.server.num_requests.get_lock():
+            self.server.num_requests.value += 1
+        with self.server.bytes_sent.get_lock():
+            self.server.bytes_sent.value += num_bytes
+
+
+def _serve(port, opts, num_requests, bytes_sent, ready):
+    server = FakeHostServer(('127.0.0.1', port), FakeHostHandler)
+    server.opts = opts
+    server.num_requests = num_requests
+    server.bytes_sent = bytes_sent
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeHosts:
+    """
+    Starts the fake hosts in another process, so serving files does not take cpu time from what is being measured
+    """
+
+    def __init__(self, port=0, latency=0.0, bandwidth=0, image_size=200000, video_size=2000000, album_size=3):
+        """
+        :param port: port to listen on, 0 to pick a free one
+        :param latency: seconds to wait before every response
+        :param bandwidth: bytes/sec each file is sent at, 0 for as fast as possible
+        """
+        self.opts = {'latency': latency, 'bandwidth': bandwidth, 'image_size': image_size,
+                     'video_size': video_size, 'album_size': album_size}
+        self.num_requests = multiprocessing.Value('q', 0)
+        self.bytes_sent = multiprocessing.Value('q', 0)
+
+        ready = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=_serve, name='fake_hosts', daemon=True,
+                                                args=(port, self.opts, self.num_requests, self.bytes_sent, ready))
+        self._process.start()
+        self.port = ready.get(timeout=30)
+        self.proxy_url = 'http://127.0.0.1:' + str(self.port)
+
+    def stats(self):
+        """
+        :return: dict of requests answered and bytes sent so far
+        """
+        return {'requests': self.num_requests.value, 'bytes': self.bytes_sent.value}
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+if __name__ == '__main__':
+    hosts = FakeHosts(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081)
+    print("Fake hosts running, use " + hosts.proxy_url + " as the http proxy. Ctrl-c to stop")
+    try:
+        while True:
+            time.sleep(60)
+            print(hosts.stats())
+    except KeyboardInterrupt:
+        hosts.stop()
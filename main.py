@@ -3,31 +3,144 @@ import sys
 import json
 import praw
 import socket
+import time
 import signal
 import warnings
 import argparse
 import threading
+import subprocess
 import traceback
 import configparser
 from queue import Queue
 from utils.reddit import RedditData
 from utils.log import setup_custom_logger
-from utils.general_utils import GeneralUtils
+from utils.general_utils import GeneralUtils, set_json_serializer, set_process_locks
+from utils.json_serializer import JsonSerializer
+from utils.catalog import Catalog
+from utils.search_index import SearchIndex, parse_date
+from utils.url_index import UrlIndex
+from utils.failed_backlog import FailedBacklog
+from utils.retry_queue import RetryQueue
+from utils.http_client import HttpClient
+from utils.host_scheduler import HostScheduler
+from utils.media_store import MediaStore
+from utils.lru_cache import LruSet
+from utils.json_segments import SegmentReader, SegmentWriter
+from utils.spill_queue import SpillQueue
+from utils.pipeline import Stage, StageCounter
+from utils.scrape_filter import ScrapeConfigWatcher
+from utils.write_behind import WriteBehindAppender
+from utils.listings import ListingWriter
+from utils.metrics import metrics, domain_label, MetricsExporter
+from utils.profiler import SamplingProfiler, ThreadProfiler
+from utils.shards import shard_for, parse_shard, ShardStream, ProcessLocks
 from utils.static_assets import StaticTemplates
+from utils.archive_server import ArchiveServer
+from utils.async_engine import AsyncEngine
 from utils.external_download import ExternalDownload
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
 
+def get_media_store(base_dir, use_media_store, logger_name):
+    """
+    :return: MediaStore for `base_dir` if it is turned on, else None
+    """
+    if use_media_store:
+        return MediaStore(base_dir, logger_name)
+    return None
+
+
+def get_url_index(base_dir, use_url_index, dead_ttl):
+    """
+    :return: UrlIndex for `base_dir` if it is turned on, else None
+    """
+    if use_url_index:
+        return UrlIndex(os.path.join(base_dir, 'logs', 'url_index.sqlite'), dead_ttl=dead_ttl)
+    return None
+
+
+def get_catalog(base_dir, use_catalog):
+    """
+    :return: Catalog for `base_dir` if it is turned on, else None
+    """
+    if use_catalog:
+        return Catalog(os.path.join(base_dir, 'logs', 'catalog.sqlite'))
+    return None
+
+
+def get_search_index(base_dir, use_search, logger_name):
+    """
+    :return: SearchIndex for `base_dir` if it is turned on, else None
+    """
+    if use_search:
+        return SearchIndex(os.path.join(base_dir, 'logs', 'search.sqlite'), logger_name)
+    return None
+
+
+def get_http_client(download_config, num_threads, logger_name):
+    """
+    :return: HttpClient setup from the [download] config section
+    """
+    return HttpClient(logger_name,
+                      connect_timeout=download_config.getfloat('connect_timeout', fallback=10),
+                      read_timeout=download_config.getfloat('read_timeout', fallback=60),
+                      retries=download_config.getint('retries', fallback=3),
+                      backoff=download_config.getfloat('backoff', fallback=0.5),
+                      pool_hosts=download_config.getint('pool_hosts', fallback=100),
+                      # Every thread should be able to keep its own connection open to a host
+                      pool_size=max(download_config.getint('pool_size', fallback=10), num_threads),
+                      )
+
+
+def get_scheduler(download_config, hosts_config, num_shards=1):
+    """
+    :param num_shards: the limits are split between this many processes, so a host still gets no more then it allows
+    :return: HostScheduler setup from the [download] and [hosts] config sections
+    """
+    def share(rate, burst, concurrency):
+        return rate / num_shards, max(1, burst // num_shards), max(1, concurrency // num_shards)
+
+    host_limits = {}
+    for host, limits in hosts_config.items():
+        # host = rate, burst, concurrency
+        rate, burst, concurrency = [item.strip() for item in limits.split(',')]
+        host_limits[host.lower()] = share(float(rate), int(burst), int(concurrency))
+
+    rate, burst, concurrency = share(download_config.getfloat('rate_limit', fallback=10),
+                                     download_config.getint('burst', fallback=20),
+                                     download_config.getint('host_concurrency', fallback=8))
+    return HostScheduler(rate=rate, burst=burst, concurrency=concurrency, host_limits=host_limits)
+
+
+def submission_to_dict(raw_post):
+    """
+    Convert the praw submission to a plain dict that can be queued/saved
+    :return: post dict
+    """
+    post = vars(raw_post)
+    # Convert objects to strings
+    if raw_post.author:
+        post['author'] = raw_post.author.name
+    else:
+        post['author'] = '[deleted]'
+    post['subreddit'] = str(raw_post.subreddit).lower()
+
+    # Remove, we do not need this
+    post.pop('reddit_session', None)
+
+    return post
+
+
 class TestUrl(GeneralUtils):
 
-    def __init__(self, save_path, test_url):
+    def __init__(self, save_path, test_url, download_opts={}):
         super().__init__('test')
         self.base_dir = self.norm_path(save_path)
         self.download_path = self.create_save_path("download")
 
         # Setup external scraper
-        self.ed = ExternalDownload(self.base_dir, self.download_path, 'test')
+        self.ed = ExternalDownload(self.base_dir, self.download_path, 'test', **download_opts)
         print("Starting download")
         flist = self.ed.download(test_url, self.base_dir)
         print(flist)
@@ -35,30 +148,35 @@ class TestUrl(GeneralUtils):
 
 class GetFailed(GeneralUtils):
 
-    def __init__(self, save_path, num_threads):
+    def __init__(self, save_path, num_threads, catalog=None, domains=None, download_opts={}):
         super().__init__('failed')
         self.base_dir = self.norm_path(save_path)
         self.download_path = self.create_save_path("temp", "re-downloads")
+        self.catalog = catalog
+        # Only retry urls from these domains, None for all of them
+        self.domains = domains
 
         # Thread life
         self.num_threads = num_threads
-        self.q = Queue(maxsize=0)
+        self.q = Queue(maxsize=num_threads * 10)
+
+        # Urls left to do, so we can pick up where we left off if we get stopped
+        self.backlog = FailedBacklog(os.path.join(self.base_dir, 'logs', 'get_failed.sqlite'))
+        self.num_done = 0
+        self.num_pending = 0
+        self.done_lock = threading.Lock()
 
         # Setup external scraper
-        self.ed = ExternalDownload(self.base_dir, self.download_path, 'failed')
+        self.ed = ExternalDownload(self.base_dir, self.download_path, 'failed', **download_opts)
 
         # Create failed domain down path
         self.failed_domain_file = os.path.join(self.base_dir, 'logs', 'failed_domains.csv')
-        if not os.path.isfile(self.failed_domain_file):
-            # If there is no failed domain file then we have nothing to do
-            return
-
-        # Rename file so we dont confilct with anything new added
         self.failed_domain_file_failed = self.failed_domain_file + ".backloging"
-        os.rename(self.failed_domain_file, self.failed_domain_file_failed)
 
-        # New failed domains list
-        self.failed_domain_list = []
+        # Rename file so we dont confilct with anything new added
+        #   If the last run was stopped before it read all of it, finish that one first
+        if not os.path.isfile(self.failed_domain_file_failed) and os.path.isfile(self.failed_domain_file):
+            os.rename(self.failed_domain_file, self.failed_domain_file_failed)
 
         # Get to work
         self.main()
@@ -67,78 +185,338 @@ class GetFailed(GeneralUtils):
         self.cleanup()
 
     def main(self):
+        # Anything marked done was finished by a run that got stopped
+        self.backlog.clear_done()
 
-        # Read in failed content
-        with open(self.failed_domain_file_failed) as f:
-            failed_domains = f.readlines()
+        ###
+        # Read the failed content into the backlog, a batch at a time
+        ###
+        if os.path.isfile(self.failed_domain_file_failed):
+            self.backlog.import_file(self.failed_domain_file_failed,
+                                     progress=lambda num_lines: self.cprint("Reading failed domains: " + str(num_lines)))
+            # Everything is in the backlog now
+            # Forget its offset first, if we stop in between the file is read again instead of
+            # a new file with the same name being read from the old offset
+            self.backlog.forget_file(self.failed_domain_file_failed)
+            os.remove(self.failed_domain_file_failed)
+
+        self.num_pending = self.backlog.count_pending(self.domains)
+        if self.num_pending == 0:
+            self.cprint("Nothing to download\n")
+            return
 
         ###
-        # Thread processing of each failed post
+        # Thread processing of each failed url
         ###
         for i in range(self.num_threads):
-            worker = threading.Thread(target=self.domain_worker)
+            worker = threading.Thread(target=self.domain_worker, name="domain_worker-" + str(i))
             worker.setDaemon(True)
             worker.start()
 
-        for content in failed_domains:
-            content = content.strip().split(',')
-            self.q.put(content)
+        # Sorted by domain, so the same host is worked on together
+        for url, domain in self.backlog.pending(self.domains):
+            self.q.put((url, domain))
 
         self.q.join()
+        self.backlog.clear_done()
 
         self.cprint("Completed\n")
-        # Remove the copy we made
-        os.remove(self.failed_domain_file_failed)
 
     def domain_worker(self):
-        try:
-            while True:
-                self.download_again(self.q.get())
-                self.q.task_done()
-        except Exception as e:
-            self.log("Exception in main for posts: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+        while True:
+            url, domain = self.q.get()
+            try:
+                for post_path in self.backlog.post_paths(url):
+                    self.download_again(post_path)
+                # If it failed again it is back in failed_domains.csv for next time
+                self.backlog.mark_done(url)
+            except Exception as e:
+                self.log("Exception in main for posts: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+            with self.done_lock:
+                self.num_done += 1
+            self.q.task_done()
+
+    def queue_status(self):
+        """
+        :return: String showing how many urls are done
+        """
+        return "Done: " + str(self.num_done) + "/" + str(self.num_pending)
 
-    def download_again(self, content):
+    def download_again(self, post_path):
         """
         Try and download content again
         """
+        # The same post can be in the list more then once, skip it if we already got it
+        if self.catalog is not None and self.catalog.status_for_path(post_path) == Catalog.SAVED:
+            return
+
         # Get the post json file and read it in
-        post_json_file = os.path.join(content[2], 'post.json')
+        post_json_file = os.path.join(post_path, 'post.json')
         try:
-            with open(post_json_file, 'r') as data_file:
-                post = json.load(data_file)
+            post = self.load_json(post_json_file)
         except FileNotFoundError:
             return
 
-        self.log("Downloading content [download_again]: " + content[2])
-        post = self.download_content(post)
-        self.log("Saving content [download_again]: " + content[2])
+        self.log("Downloading content [download_again]: " + post_path)
+        # The url index may have it as dead from before the site was supported
+        post = self.download_content(post, retry=True)
+        self.log("Saving content [download_again]: " + post_path)
         # Save the new post data to the post.json file
         self.save_file(post_json_file, post, content_type='json')
+        if self.catalog is not None:
+            self.catalog.add_post(post, post_path, self.catalog.post_status(post))
 
     def cleanup(self):
+        self.backlog.close()
         try:
             os.removedirs(self.download_path)
         except OSError:
             pass
 
 
+class MigrateStore(GeneralUtils):
+
+    def __init__(self, save_path, num_threads):
+        super().__init__('root')
+        self.base_dir = self.norm_path(save_path)
+        self.store = MediaStore(self.base_dir, 'root')
+
+        # Thread life
+        self.num_threads = num_threads
+        self.q = Queue(maxsize=0)
+
+        # Bytes freed by removing duplicates
+        self.saved_bytes = 0
+        self.saved_lock = threading.Lock()
+
+        # Get to work
+        self.main()
+
+    def main(self):
+        ###
+        # Thread processing of each user
+        ###
+        for i in range(self.num_threads):
+            worker = threading.Thread(target=self.user_worker, name="user_worker-" + str(i))
+            worker.setDaemon(True)
+            worker.start()
+
+        # user/<username[0]>/<username>
+        user_base = os.path.join(self.base_dir, 'user')
+        if os.path.isdir(user_base):
+            for letter in os.listdir(user_base):
+                letter_path = os.path.join(user_base, letter)
+                if not os.path.isdir(letter_path):
+                    continue
+                for user in os.listdir(letter_path):
+                    user_path = os.path.join(letter_path, user)
+                    # Skip users done on a previous run
+                    if not self.store.is_migrated(user_path):
+                        self.q.put(user_path)
+
+        self.q.join()
+
+        self.cprint("Completed, saved " + str(self.saved_bytes) + " bytes\n", log=True)
+
+    def user_worker(self):
+        while True:
+            user_path = self.q.get()
+            self.cprint("Migrating: " + user_path)
+            try:
+                saved_bytes = self.store.migrate_user(user_path)
+                with self.saved_lock:
+                    self.saved_bytes += saved_bytes
+            except Exception as e:
+                self.log("Exception migrating user " + user_path + ": " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+            self.q.task_done()
+
+
+class RebuildCatalog(GeneralUtils):
+    """
+    Add every saved post to the catalog, and to the search index if one is passed, reading the save path once
+    Either can be None
+    """
+
+    def __init__(self, save_path, num_threads, catalog, is_just_json, batch_size=500, search_index=None):
+        super().__init__('root')
+        self.base_dir = self.norm_path(save_path)
+        self.catalog = catalog
+        self.search_index = search_index
+        self.just_json = is_just_json
+        # What is being rebuilt, for the progress messages
+        self.name = ' and '.join(name for name, index in [('catalog', catalog), ('search index', search_index)]
+                                 if index is not None)
+        self.batch_size = batch_size
+        self.reader = SegmentReader()
+
+        # Thread life
+        self.num_threads = num_threads
+        self.q = Queue(maxsize=num_threads * 100)
+
+        self.num_posts = 0
+        self.num_lock = threading.Lock()
+
+        # Get to work
+        self.main()
+
+    def main(self):
+        ###
+        # Thread processing of each json file
+        ###
+        workers = []
+        for i in range(self.num_threads):
+            worker = threading.Thread(target=self.json_worker, name="json_worker-" + str(i))
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        if self.just_json:
+            # subreddits/<s>/<su>/<sub>/<subreddit>/y/m/d/<created_utc>_<id>.json
+            tree = os.path.join(self.base_dir, 'subreddits')
+        else:
+            # user/<u>/<user>/posts/y/m/d/<created_utc>/post.json
+            tree = os.path.join(self.base_dir, 'user')
+
+        for root, dirs, files in os.walk(tree):
+            for name in files:
+                if self.just_json and name.endswith('.json'):
+                    self.q.put(os.path.join(root, name))
+                elif name == 'post.json':
+                    self.q.put(os.path.join(root, name))
+
+        if self.just_json:
+            # segments/<subreddit or _all>/y/m/d/<hour>.jsonl[.gz|.zst|.part]
+            for root, dirs, files in os.walk(os.path.join(self.base_dir, 'segments')):
+                segments = set()
+                for name in files:
+                    if '.jsonl' in name and not name.endswith('.idx'):
+                        # The reader finds every file for the segment from <hour>.jsonl
+                        segments.add(name.split('.jsonl')[0] + '.jsonl')
+                for name in sorted(segments):
+                    self.q.put(os.path.join(root, name))
+
+        # Tell the workers there is nothing left
+        for i in range(self.num_threads):
+            self.q.put(None)
+        for worker in workers:
+            worker.join()
+
+        self.cprint("Completed, added " + str(self.num_posts) + " posts to the " + self.name + "\n", log=True)
+        # Only once every post is in, a rebuild that was stopped part way is done again on the next run
+        if self.catalog is not None:
+            self.catalog.set_built()
+        if self.search_index is not None:
+            self.cprint("Optimizing the search index\n")
+            self.search_index.optimize()
+            self.search_index.set_built()
+
+    def json_worker(self):
+        # (post, post_path) to add
+        posts = []
+        users = set()
+        while True:
+            json_file = self.q.get()
+            if json_file is None or len(posts) >= self.batch_size:
+                self.add_posts(posts, users)
+                posts = []
+                users = set()
+            if json_file is None:
+                break
+
+            try:
+                if json_file.endswith('.jsonl'):
+                    for post in self.reader.iter_posts(json_file):
+                        posts.append((post, json_file))
+                        if len(posts) >= self.batch_size:
+                            self.add_posts(posts, users)
+                            posts = []
+                    continue
+
+                post = self.load_json(json_file)
+                if self.just_json:
+                    posts.append((post, json_file))
+                else:
+                    # Same name prepare_post uses, so we know not to create the user again
+                    users.add(post['author'])
+                    posts.append((post, os.path.dirname(json_file)))
+            except Exception as e:
+                self.log("Exception adding " + json_file + " to the " + self.name + ": " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+
+    def catalog_row(self, post, post_path):
+        if self.just_json:
+            return self.catalog.post_row(post, post_path, Catalog.JSON)
+        return self.catalog.post_row(post, post_path, self.catalog.post_status(post))
+
+    def add_posts(self, posts, users):
+        if len(posts) == 0:
+            return
+        if self.catalog is not None:
+            self.catalog.add_users(users)
+            self.catalog.add_posts([self.catalog_row(post, post_path) for post, post_path in posts])
+        if self.search_index is not None:
+            self.search_index.add_rows([self.search_index.post_row(post, post_path) for post, post_path in posts])
+        with self.num_lock:
+            self.num_posts += len(posts)
+        self.cprint("Added " + str(self.num_posts) + " posts to the " + self.name)
+
+
 class RedditScraper(GeneralUtils):
 
-    def __init__(self, reddit_data, save_path, num_threads, is_just_json):
+    def __init__(self, reddit_data, save_path, num_threads, is_just_json, engine='threads', max_concurrency=1000,
+                 queue_size=1000, persist_threads=2, persist_queue_size=100, catalog=None,
+                 csv_flush_lines=100, csv_flush_interval=5, json_segments=None, retry_queue=None, retry_threads=1,
+                 listing_page_size=100, listing_flush_interval=10, view_index=True, search_index=None,
+                 stream=None, scrape_config_file='./configs/scrape.ini', shard=None, download_opts={}):
         super().__init__('root')
         self.base_dir = self.norm_path(save_path)
 
+        # Posts and users we already have, None to check the save path instead
+        self.catalog = catalog
+        # Full text search of saved posts, None if it is turned off
+        self.search_index = search_index
+
         # Do we only want the json files?
         self.just_json = is_just_json
+        # Save an index.html in every post/day/month/year dir, not needed when using --serve
+        self.view_index = view_index
+        # SegmentWriter to save just_json posts to, None to save each post to its own file
+        self.json_segments = json_segments
 
         # Thread life
         self.num_threads = num_threads
-        self.q = Queue(maxsize=0)
+        # Posts past `queue_size` wait on disk so a traffic spike can not use up all the memory
+        #   Each shard process has its own
+        self.shard = shard
+        self.q = SpillQueue(self.create_save_path("temp", "queue" if shard is None else "queue-shard" + str(shard)),
+                            maxsize=queue_size)
+        # Posts that have been downloaded and are waiting to be saved
+        self.persist_threads = persist_threads
+        self.persist_q = Queue(maxsize=persist_queue_size)
+
+        # Stages, created in main()
+        self.filter_counter = StageCounter('filter')
+        self.download_stage = None
+        self.persist_stage = None
+
+        # Failed downloads are tried again in the background by `retry_threads` workers
+        self.retry_queue = retry_queue
+        self.retry_threads = retry_threads
+        self.retry_q = Queue(maxsize=retry_threads * 2)
+        self.retry_stage = None
+
+        # Submissions to parse, None for every new post on /r/all. benchmarks/bench_scraper.py passes in its own
+        self.stream = stream
+
+        # `threads` or `async`
+        self.engine = engine
+        self.max_concurrency = max_concurrency
+        self.async_engine = None
 
         scraper_name = socket.gethostname()  # Name of scraper to put in the user agent
         self.reddit = RedditData(reddit_data, scraper_name)
-        self.reddit.login()
+        # Only needed to read /r/all
+        if self.stream is None:
+            self.reddit.login()
 
         # We only need the static files if we are downloading the content as well
         if self.just_json is False:
@@ -148,20 +526,30 @@ class RedditScraper(GeneralUtils):
             # Add static templates to use
             self.static = StaticTemplates()
 
-            # Create/update static assets
-            self.gen_static_files()
+            # Create/update static assets, only one shard needs to
+            if self.shard in [None, 0]:
+                self.gen_static_files()
 
             # Setup external scraper
-            self.ed = ExternalDownload(self.base_dir, self.download_path, 'root')
+            self.ed = ExternalDownload(self.base_dir, self.download_path, 'root', **download_opts)
 
             # Create failed domain down path
             self.failed_domain_file = os.path.join(self.base_dir, 'logs', 'failed_domains.csv')
 
-        # Dict of users and subreddits to scrape
-        self.scrape = {}
+            # urls.csv lines are buffered and written a batch at a time
+            self.appender = WriteBehindAppender('root', flush_lines=csv_flush_lines, flush_interval=csv_flush_interval)
+            # Paged listing.json files, so the csv_viewer can show a dir in one request
+            self.listings = ListingWriter('root', page_size=listing_page_size, flush_interval=listing_flush_interval)
+            # Dirs we know already have an index.html
+            self.view_index_known = LruSet(maxsize=100000)
 
-        # load content into self.scrape
-        self.load_scrape_config()
+        # Queue sizes and the stats each part keeps, read each time the metrics are
+        metrics.add_collector(self.collect_metrics)
+
+        # Users and subreddits to scrape, reloaded when ./configs/scrape.ini changes
+        self.scrape_watcher = ScrapeConfigWatcher(scrape_config_file, 'root',
+                                                  on_reload=self.scrape_config_reloaded)
+        self.scrape_watcher.start()
 
         # Run parser
         self.main()
@@ -170,150 +558,348 @@ class RedditScraper(GeneralUtils):
         self.cleanup()
 
     def main(self):
+        stream = self.stream
+        if stream is None:
+            stream = praw.helpers.submission_stream(self.reddit.r, 'all', None, 0)
+
+        if self.retry_queue is not None and self.just_json is False:
+            self.start_retries()
+
+        if self.engine == 'async':
+            self.async_engine = AsyncEngine(self, self.num_threads, self.max_concurrency)
+            try:
+                self.async_engine.run(stream)
+            except InterruptedError:
+                pass
+            return
+
         ###
-        # Thread processing of each failed post
+        # Each stage has its own threads
+        #   filter (this thread) -> self.q -> download -> self.persist_q -> persist
         ###
-        for i in range(self.num_threads):
-            worker = threading.Thread(target=self.post_worker)
-            worker.setDaemon(True)
-            worker.start()
+        self.download_stage = Stage('download', self.download_post, self.q, self.num_threads, out_q=self.persist_q)
+        self.persist_stage = Stage('persist', self.persist_post, self.persist_q, self.persist_threads)
+        self.download_stage.start()
+        self.persist_stage.start()
 
         try:
-            stream = praw.helpers.submission_stream(self.reddit.r, 'all', None, 0)
             for item in stream:
-                self.q.put(item)
+                self.filter_stage(item)
             self.q.join()
+            self.persist_q.join()
         except InterruptedError:
             return
 
-    def post_worker(self):
+    def start_retries(self):
         """
-        Function to be used as the thread worker
+        Start the workers that retry failed downloads, they use the lowest priority lane
         """
-        try:
-            while True:
-                self.parse_post(self.q.get())
-                self.q.task_done()
-        except Exception as e:
-            self.log("Exception in main for posts: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+        self.retry_stage = Stage('retry', self.retry_post, self.retry_q, self.retry_threads)
+        self.retry_stage.start()
+        feeder = threading.Thread(target=self.retry_feeder, name="retry_feeder")
+        feeder.setDaemon(True)
+        feeder.start()
 
-    def load_scrape_config(self):
+    def retry_feeder(self):
         """
-        Load scrape.ini config file into self.scrape
-        This will run every n seconds to get any updates to the config in its own thread
+        Pass posts that are due a retry to the retry workers
         """
-        # Read scrap config file
-        scrape_config_file = './configs/scrape.ini'
-        if not os.path.isfile(scrape_config_file):
-            self.cprint("\nScrape config file not found: " + scrape_config_file, log=True)
-        config.read(scrape_config_file)
+        while True:
+            try:
+                due = self.retry_queue.claim_due(limit=self.retry_q.maxsize)
+                for item in due:
+                    self.retry_q.put(item)
+            except Exception as e:
+                due = []
+                self.log("Exception getting retries: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+            if len(due) == 0:
+                time.sleep(30)
 
-        temp_scrape = {'subreddits': [], 'users': [], 'content': {}}
+    def retry_post(self, item):
+        """
+        Retry stage, try to download the media of a saved post again
+        """
+        post_path, url, attempts = item
+        post_json_file = os.path.join(post_path, 'post.json')
+        try:
+            post = self.load_json(post_json_file)
+        except FileNotFoundError:
+            # It has not been saved yet, or it was removed
+            if self.retry_queue.add_failure(post_path, url, None, 'NotSaved'):
+                self.log("Giving up on: NotSaved post: " + post_path, level='error')
+            return False
 
-        # Break down the params in the user and subreddit lists
-        for feed in ['users', 'subreddits']:
-            for subreddit in config['scrape'][feed].split("\n"):
-                option = subreddit.lower().split(',')
-                temp_scrape[feed].append(option[0].strip())
-                if len(option) > 1:
-                    temp_scrape['content'][option[0].strip()] = option[1].strip().lower()
+        self.log("Retrying (attempt " + str(attempts + 1) + "): " + post_path)
+        post = self.download_content(post, retry=True)
+        if len(post['file_downloads']) > 0:
+            self.retry_queue.remove(post_path)
+            self.log("Retry worked: " + post_path)
 
-        # Cpoy temp_scrape to self.scrape
-        self.scrape = temp_scrape.copy()
+        self.save_file(post_json_file, post, content_type='json')
+        if self.catalog is not None:
+            self.catalog.add_post(post, post_path, self.catalog.post_status(post))
+        return True
 
-        self.log("Reloaded scape config: " + str(self.scrape['subreddits']), level='debug')
+    def filter_stage(self, raw_post):
+        """
+        Drop the posts we do not want as fast as we can, the rest are queued to be downloaded
+        """
+        start = time.time()
+        post = self.filter_post(self.submission_to_dict(raw_post))
+        if post is not None:
+            self.q.put(post)
+        took = time.time() - start
+        self.filter_counter.add(took, passed=post is not None)
+        metrics.observe('stage_seconds', took, stage='filter', domain='', extractor='')
+
+    def queue_status(self):
+        """
+        :return: String showing the posts waiting or in flight
+        """
+        if self.async_engine is not None:
+            return "In flight: " + str(self.async_engine.in_flight())
+
+        stats = self.q.stats()
+        status = "Queue: " + str(stats['memory'] + stats['disk']) + \
+                 " (disk: " + str(stats['disk']) + \
+                 ", spilled: " + str(round(stats['bytes_spilled'] / 1048576, 1)) + "MB" + \
+                 ", oldest: " + str(int(stats['oldest_age'])) + "s)"
+
+        # Posts per second through each stage
+        counters = [self.filter_counter]
+        for stage in [self.download_stage, self.persist_stage, self.retry_stage]:
+            if stage is not None:
+                counters.append(stage.counter)
+        status += " |"
+        for counter in counters:
+            status += " " + counter.name + ": " + str(round(counter.stats()['per_sec'], 1)) + "/s"
+
+        return status
+
+    def collect_metrics(self):
+        """
+        :return: list of (name, labels, value) gauges for the metrics
+        """
+        gauges = []
+        if self.async_engine is not None:
+            gauges.append(('in_flight', {}, self.async_engine.in_flight()))
+
+        stats = self.q.stats()
+        gauges.append(('queue_items', {'queue': 'download', 'where': 'memory'}, stats['memory']))
+        gauges.append(('queue_items', {'queue': 'download', 'where': 'disk'}, stats['disk']))
+        gauges.append(('queue_items', {'queue': 'persist', 'where': 'memory'}, self.persist_q.qsize()))
+        gauges.append(('queue_items', {'queue': 'retry', 'where': 'memory'}, self.retry_q.qsize()))
+        gauges.append(('queue_spilled_bytes', {}, stats['bytes_spilled']))
+        gauges.append(('queue_oldest_seconds', {}, round(stats['oldest_age'], 3)))
+
+        counters = [self.filter_counter]
+        for stage in [self.download_stage, self.persist_stage, self.retry_stage]:
+            if stage is not None:
+                counters.append(stage.counter)
+        for counter in counters:
+            stats = counter.stats()
+            gauges.append(('stage_items', {'stage': counter.name, 'result': 'passed'}, stats['passed']))
+            gauges.append(('stage_items', {'stage': counter.name, 'result': 'dropped'}, stats['processed'] - stats['passed']))
+
+        stats = self.path_cache_stats()
+        gauges.append(('cache_hits', {'cache': 'known_dirs'}, stats['hits']))
+        gauges.append(('cache_misses', {'cache': 'known_dirs'}, stats['misses']))
+        gauges.append(('cache_size', {'cache': 'known_dirs'}, stats['size']))
 
+        if self.just_json is False:
+            stats = self.view_index_known.stats()
+            gauges.append(('cache_hits', {'cache': 'view_index'}, stats['hits']))
+            gauges.append(('cache_misses', {'cache': 'view_index'}, stats['misses']))
+            gauges.append(('cache_size', {'cache': 'view_index'}, stats['size']))
+
+            stats = self.appender.stats()
+            gauges.append(('csv_lines', {}, stats['lines']))
+            gauges.append(('csv_writes', {}, stats['writes']))
+
+            stats = self.ed.http.stats()
+            gauges.append(('http_requests', {}, stats['requests']))
+            gauges.append(('http_errors', {}, stats['errors']))
+            for host, pool in stats['hosts'].items():
+                gauges.append(('http_connections', {'host': host}, pool['connections']))
+
+            for host, (active, waiting) in self.ed.scheduler.stats().items():
+                # Only the busy hosts, we may have talked to thousands
+                if active == 0 and waiting == 0:
+                    continue
+                gauges.append(('host_in_flight', {'host': host}, active))
+                gauges.append(('host_waiting', {'host': host}, waiting))
+
+        if self.retry_queue is not None:
+            stats = self.retry_queue.stats()
+            gauges.append(('retries', {'state': 'waiting'}, stats['waiting']))
+            gauges.append(('retries', {'state': 'dead'}, stats['dead']))
+
+        return gauges
+
+    def scrape_config_reloaded(self, scrape_filter):
+        """
+        Called each time scrape.ini changes
+        """
         # Check to see if both the subreddit and user lists are blank
         #   If so exit the script as there is no reason to run
-        if (len(temp_scrape['users']) == 1 and temp_scrape['users'][0] == '') and (len(temp_scrape['subreddits'])  == 1 and temp_scrape['subreddits'][0] == ''):
+        if scrape_filter.is_empty():
             self.cprint("You have no users or subreddits in ./configs/scrape.ini", log=True)
         else:
             self.cprint("Searching for posts", log=True)
 
-        # Reload again in n seconds
-        t_reload = threading.Timer(10, self.load_scrape_config)
-        t_reload.setDaemon(True)
-        t_reload.start()
+    def parse_post(self, post):
+        """
+        Process post start to finish in the current thread
+        """
+        post = self.filter_post(post)
+        if post is None:
+            # This is not the post we are looking for, move along
+            return
+
+        post = self.download_post(post)
+        if post is False:
+            return
+
+        self.persist_post(post)
+
+        # Done doing things here
+        return True
 
-    def parse_post(self, raw_post):
+    def download_post(self, post):
         """
-        Process post
+        Download stage, get the thumbnail and any media the post links to
+        :return: post dict ready to be saved, False if there is nothing to save
         """
-        post = vars(raw_post)
-        # Convert objects to strings
-        if raw_post.author:
-            post['author'] = raw_post.author.name
-        else:
-            post['author'] = '[deleted]'
-        post['subreddit'] = str(raw_post.subreddit).lower()
-
-        # Check if we even want this post
-        if 'all' not in self.scrape['subreddits']:
-            if post['subreddit'] not in self.scrape['subreddits'] and \
-               post['author'].lower() not in self.scrape['subreddits']:
-                # This is not the post we are looking for, move along
-                return
+        # Check here if we just want the json
+        #   If we do pass `post` on to be saved
+        if self.just_json:
+            return post
+
+        ###
+        # If we already have the post then skip it
+        ###
+        if not self.prepare_post(post):
+            return False
 
-        # Check if we want only sfw or nsfw content from this subreddit
-        if 'all' not in self.scrape['content']:
-            if post['subreddit'] in self.scrape['content']:
-                if self.scrape['content'][post['subreddit']] == 'nsfw' and post['over_18'] is False:
-                    return
-                elif self.scrape['content'][post['subreddit']] == 'sfw' and post['over_18'] is True:
-                    return
+        self.cprint("Getting post " + post['id'] + " by: " + post['author'])
+
+        ###
+        # Download thumbnail if there is one
+        ###
+        if self.has_thumbnail(post):
+            post['thumbnail_original'] = post['thumbnail']
+            with metrics.timer('stage_seconds', stage='thumbnail', domain=domain_label(post['thumbnail_original']),
+                               extractor=''):
+                download_response = self.ed.download(post['thumbnail_original'], post['user_save_path'], lane='thumbnail')
+            self.add_thumbnail(post, download_response)
+
+        ###
+        # Process post data and download any media needed
+        ###
+        if post['is_self'] is False:
+            # Try to save the content
+            post = self.download_content(post)
+
+        return post
+
+    def persist_post(self, post):
+        """
+        Persist stage, write the post and its listings to disk
+        """
+        if self.just_json:
+            self.save_just_json(post)
         else:
-            if self.scrape['content']['all'] == 'nsfw' and post['over_18'] is False:
-                return
-            elif self.scrape['content']['all'] == 'sfw' and post['over_18'] is True:
-                return
+            self.save_post(post)
 
-        # Remove, we do not need this
-        post.pop('reddit_session')
+    def submission_to_dict(self, raw_post):
+        """
+        :return: post dict
+        """
+        # Shards are sent posts the supervisor already converted
+        if isinstance(raw_post, dict):
+            return raw_post
+        return submission_to_dict(raw_post)
+
+    def filter_post(self, post):
+        """
+        Check if we want the post
+        :return: post dict, None if the post is not wanted
+        """
+        # Check if we even want this post, and if we want only sfw or nsfw content from this subreddit
+        if not self.scrape_watcher.current.wants(post['subreddit'], post['author'].lower(), post['over_18']):
+            return None
 
         self.cprint("Checking post: " + post['id'])
 
+        return post
+
+    def post_date(self, post):
+        """
+        :return: year, month, day, created_utc of the post as strings
+        """
         created = self.get_datetime(post['created_utc'])
-        y = str(created.year)
-        m = str(created.month)
-        d = str(created.day)
-        utc_str = str(int(post['created_utc']))
+        return str(created.year), str(created.month), str(created.day), str(int(post['created_utc']))
 
-        # Check here if we just want the json
-        #   If we do save `post` to json file and move on
-        if self.just_json:
-            # Also check if the first 3 letters match
-            #  We already checked if the whole name was in bad_folders
-
-            sub = post['subreddit'][0:3]
-            sub_dir = sub
-            # Check if first 3 letters of sub name is in bad_folders
-            if sub in self.bad_folders or post['subreddit'] in self.bad_folders:
-                sub_dir = sub + "_r_" + sub
-            # Check if full sub name is in bad_folders
-            if post['subreddit'] in self.bad_folders:
-                post['subreddit_original'] = post['subreddit']
-                post['subreddit'] = sub_dir
-
-            # Create .json savepath, filename will be created_utc_id.json
-            # Create directory 3 letters deep (min length of a subreddit name)
-            self.log("Saving just json for subreddit: " + post['subreddit'], level='info')
-            # Make sure the subreddit cannot create the folder `con` (Windows bug)
-            jjson_save_path = self.create_base_path('subreddits',
-                                                    post['subreddit'][0:1],
-                                                    post['subreddit'][0:2],
-                                                    sub_dir,
-                                                    post['subreddit'],
-                                                    y, m, d
-                                                    )
-            # Save json data
-            jjson_save_file = os.path.join(jjson_save_path, utc_str + "_" + post['id'] + ".json")
+    def save_just_json(self, post):
+        """
+        Save `post` to its own json file, or append it to a json segment
+        """
+        if self.json_segments is not None:
             try:
-                self.save_file(jjson_save_file, post, content_type='json')
+                with metrics.timer('stage_seconds', stage='json_write', domain='', extractor=''):
+                    segment_file = self.json_segments.write(post)
+                if self.catalog is not None:
+                    self.catalog.add_post(post, segment_file, Catalog.JSON)
+                if self.search_index is not None:
+                    self.search_index.add_post(post, segment_file)
             except Exception as e:
-                self.log("Exception [just_json]: " + post['subreddit'] + "\n" + str(e) + " " + post['id'] + "\n" + str(traceback.format_exc()), level='critical')
-            # We are done here
+                self.log("Exception [just_json segments]: " + post['subreddit'] + "\n" + str(e) + " " + post['id'] + "\n" + str(traceback.format_exc()), level='critical')
             return
 
+        y, m, d, utc_str = self.post_date(post)
+
+        # Also check if the first 3 letters match
+        #  We already checked if the whole name was in bad_folders
+        sub = post['subreddit'][0:3]
+        sub_dir = sub
+        # Check if first 3 letters of sub name is in bad_folders
+        if sub in self.bad_folders or post['subreddit'] in self.bad_folders:
+            sub_dir = sub + "_r_" + sub
+        # Check if full sub name is in bad_folders
+        if post['subreddit'] in self.bad_folders:
+            post['subreddit_original'] = post['subreddit']
+            post['subreddit'] = sub_dir
+
+        # Create .json savepath, filename will be created_utc_id.json
+        # Create directory 3 letters deep (min length of a subreddit name)
+        self.log("Saving just json for subreddit: " + post['subreddit'], level='info')
+        # Make sure the subreddit cannot create the folder `con` (Windows bug)
+        jjson_save_path = self.create_base_path('subreddits',
+                                                post['subreddit'][0:1],
+                                                post['subreddit'][0:2],
+                                                sub_dir,
+                                                post['subreddit'],
+                                                y, m, d
+                                                )
+        # Save json data
+        jjson_save_file = os.path.join(jjson_save_path, utc_str + "_" + post['id'] + ".json")
+        try:
+            with metrics.timer('stage_seconds', stage='json_write', domain='', extractor=''):
+                self.save_file(jjson_save_file, post, content_type='json')
+            if self.catalog is not None:
+                self.catalog.add_post(post, jjson_save_file, Catalog.JSON)
+            if self.search_index is not None:
+                self.search_index.add_post(post, jjson_save_file)
+        except Exception as e:
+            self.log("Exception [just_json]: " + post['subreddit'] + "\n" + str(e) + " " + post['id'] + "\n" + str(traceback.format_exc()), level='critical')
+
+    def prepare_post(self, post):
+        """
+        Build the save/web paths for the post
+        :return: `False` if we already have the post, `True` if it still needs to be saved
+        """
+        y, m, d, utc_str = self.post_date(post)
+
         # Check for bad folder names, only care about authors if we are saving content
         if post['author'] in self.bad_folders:
             post['author_original'] = post['author']
@@ -334,13 +920,26 @@ class RedditScraper(GeneralUtils):
         post['user_save_path'] = self.create_base_path(post['user_web_path'])
         post['post_save_path'] = self.create_base_path(post['post_web_path'])
 
-        post_json_file = os.path.join(post['post_save_path'], "post.json")
+        if self.catalog is not None:
+            ###
+            # If we already have the post then skip it
+            ###
+            if self.catalog.has_post(post['id']):
+                return False
+
+            ###
+            # If we have not seen this user before, create new user
+            ###
+            if self.catalog.add_user(post['author']):
+                self.add_new_user(post)
+
+            return True
 
         ###
         # If we already have the post then skip it
         ###
-        if os.path.isfile(post_json_file):
-            return True
+        if os.path.isfile(os.path.join(post['post_save_path'], "post.json")):
+            return False
 
         ###
         # If there is no user json file, create new user
@@ -348,35 +947,40 @@ class RedditScraper(GeneralUtils):
         if not os.path.isfile(post['user_save_path'] + "user.json"):
             self.add_new_user(post)
 
-        self.cprint("Getting post " + post['id'] + " by: " + post['author'])
+        return True
 
-        ###
-        # Download thumbnail if there is one
-        ###
-        if len(post['thumbnail']) > 0 and post['thumbnail'].startswith('http'):
-            post['thumbnail_original'] = post['thumbnail']
-            download_response = self.ed.download(post['thumbnail_original'], post['user_save_path'])
-            # If the thumbnail does not download then download_responce would have lenght 0
-            if len(download_response) > 0:
-                thumbnail_download = download_response[0]
-                post['thumbnail'] = self.save_to_web_path(thumbnail_download)
+    def has_thumbnail(self, post):
+        """
+        :return: `True` if the post has a thumbnail we can download
+        """
+        return len(post['thumbnail']) > 0 and post['thumbnail'].startswith('http')
 
-        ###
-        # Process post data and download any media needed
-        ###
-        if post['is_self'] is False:
-            # Try to save the content
-            post = self.download_content(post)
+    def add_thumbnail(self, post, download_response):
+        """
+        Point the post thumbnail at the downloaded copy
+        """
+        # If the thumbnail does not download then download_responce would have lenght 0
+        if len(download_response) > 0:
+            thumbnail_download = download_response[0]
+            post['thumbnail'] = self.save_to_web_path(thumbnail_download)
+
+    def save_post(self, post):
+        """
+        Save post json, its view and add it to the user and subreddit listings
+        """
+        y, m, d, utc_str = self.post_date(post)
 
         ###
         # Now save post data to json
         ###
-        self.save_file(post_json_file, post, content_type='json')
+        with metrics.timer('stage_seconds', stage='json_write', domain='', extractor=''):
+            self.save_file(os.path.join(post['post_save_path'], "post.json"), post, content_type='json')
 
         ###
         # Create post html file
         ###
-        self.save_file(os.path.join(post['post_save_path'], "index.html"), self.static.gen_frame('post_viewer'), content_type='html')
+        if self.view_index:
+            self.save_file(os.path.join(post['post_save_path'], "index.html"), self.static.gen_frame('post_viewer'), content_type='html')
 
         url_appends = []
         ###
@@ -396,21 +1000,32 @@ class RedditScraper(GeneralUtils):
         url_appends.append(self.create_joined_path(subreddit_post_base, y, m, d))
 
         ###
-        # Append urls to correct urls.csv files
+        # Append urls to correct urls.csv files and listings
         ###
+        start = time.perf_counter()
+        listing_entry = self.listings.listing_entry(post)
         for path in url_appends:
-            self.append_file(os.path.join(path, 'urls.csv'), post['post_web_path'])
+            self.appender.append(os.path.join(path, 'urls.csv'), post['post_web_path'])
+            self.listings.add(path, listing_entry)
             self.check_view_index(path)
             # self.log("Added " + post['post_web_path'] + " to " + path, level='debug')
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='csv_append', domain='', extractor='')
 
-        # Done doing things here
-        return True
+        ###
+        # Add post to the catalog last, so a post that did not finish saving is tried again
+        ###
+        if self.catalog is not None:
+            self.catalog.add_post(post, post['post_save_path'], self.catalog.post_status(post))
+        if self.search_index is not None:
+            self.search_index.add_post(post, post['post_save_path'])
 
     def add_new_user(self, post):
         """
         Add new user to the system
         """
         # self.log("Adding new user: " + post['author'], level='info')
+        if not self.view_index:
+            return
         # Create html redirect in users root to ./posts/
         self.save_file(os.path.join(post['user_save_path'], "index.html"), self.static.gen_redirect("./posts"), content_type='html')
 
@@ -419,10 +1034,14 @@ class RedditScraper(GeneralUtils):
         Check if there is an index.html in each of year, month, and day directories
         If not, create one
         """
+        if not self.view_index or self.view_index_known.has(path):
+            return
+
         index_view_file = os.path.join(path, 'index.html')
         if not os.path.isfile(index_view_file):
             # self.log("Creating view index at: " + index_view_file, level='debug')
             self.save_file(index_view_file, self.static.gen_frame('csv_viewer'), content_type='html')
+        self.view_index_known.add(path)
 
     def create_web_path(self, base, *args, path_type=''):
         """
@@ -455,6 +1074,104 @@ class RedditScraper(GeneralUtils):
         self.copy_file("./static_assets/templates/post_viewer.html", os.path.join(save_path_templates, "post_viewer.html"))
 
     def cleanup(self):
+        if self.just_json is False:
+            # Write out any urls still waiting
+            self.appender.close()
+            self.listings.close()
+        if self.json_segments is not None:
+            self.json_segments.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.retry_queue is not None:
+            self.log("Retry queue: " + str(self.retry_queue.stats()), level='info')
+        self.log("Known dir cache: " + str(self.path_cache_stats()), level='info')
+        self.reddit.close()
+
+
+class ShardSupervisor(GeneralUtils):
+    """
+    Reads the submission stream once and hands each post we want to one of `num_shards` scraper processes
+    Posts go to the shard `shard_by` (author or subreddit) hashes to, so all of a users posts are saved by the same process
+    Each shard is this script run again with `--shard <n>/<num_shards>`, posts are sent to it as json lines on its stdin
+    """
+
+    def __init__(self, reddit_data, num_shards, shard_by='author', stream=None,
+                 scrape_config_file='./configs/scrape.ini'):
+        super().__init__('root')
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        self.serializer = JsonSerializer(pretty=False, sort_keys=False, ensure_ascii=False)
+        self.num_sent = [0] * num_shards
+
+        # Submissions to route, None for every new post on /r/all
+        self.stream = stream
+        self.reddit = RedditData(reddit_data, socket.gethostname())
+        if self.stream is None:
+            self.reddit.login()
+
+        # Drop the posts no shard wants here, so they are not sent anywhere
+        self.scrape_watcher = ScrapeConfigWatcher(scrape_config_file, 'root')
+        self.scrape_watcher.start()
+
+        self.shards = []
+        for shard in range(self.num_shards):
+            self.shards.append(self.start_shard(shard))
+
+        # Get to work
+        self.main()
+
+        # Clean up
+        self.cleanup()
+
+    def start_shard(self, shard):
+        """
+        :return: the process for `shard`, run with the same args we were
+        """
+        cmd = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:] + \
+              ['--shard', str(shard) + "/" + str(self.num_shards)]
+        self.log("Starting shard " + str(shard) + ": " + " ".join(cmd), level='info')
+        # The shards log to logs/reddit_scraper-shard<n>.log, their status lines would only fight over the terminal
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    def main(self):
+        stream = self.stream
+        if stream is None:
+            stream = praw.helpers.submission_stream(self.reddit.r, 'all', None, 0)
+
+        for raw_post in stream:
+            post = submission_to_dict(raw_post)
+            if not self.scrape_watcher.current.wants(post['subreddit'], post['author'].lower(), post['over_18']):
+                continue
+
+            shard = shard_for(post[self.shard_by], self.num_shards)
+            try:
+                # Blocks while the shard has a pipe full of posts to get through
+                self.shards[shard].stdin.write(self.serializer.encode(post) + b"\n")
+                self.shards[shard].stdin.flush()
+            except (BrokenPipeError, OSError):
+                self.log("Shard " + str(shard) + " stopped (exit code " + str(self.shards[shard].poll()) +
+                         "), see logs/reddit_scraper-shard" + str(shard) + ".log", level='critical')
+                self.cprint("Shard " + str(shard) + " stopped, see logs/reddit_scraper-shard" + str(shard) + ".log\n")
+                return
+            self.num_sent[shard] += 1
+            self.cprint(self.queue_status())
+
+    def queue_status(self):
+        """
+        :return: String showing how many posts each shard has been sent
+        """
+        return "Sent to shards: " + " ".join(str(num) for num in self.num_sent)
+
+    def cleanup(self):
+        # Closing stdin ends their stream, they finish what they have and exit
+        for process in self.shards:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+        for shard, process in enumerate(self.shards):
+            process.wait()
+            self.log("Shard " + str(shard) + " exited with " + str(process.returncode), level='info')
         self.reddit.close()
 
 
@@ -481,9 +1198,33 @@ if __name__ == "__main__":
     # Get any args that got passed in
     parser = argparse.ArgumentParser()
     parser.add_argument('--get_failed', action='store_true')
+    parser.add_argument('--domain', action='append')
     parser.add_argument('--test_url', nargs=2)
+    parser.add_argument('--migrate_store', action='store_true')
+    parser.add_argument('--prune_store', action='store_true')
+    parser.add_argument('--rebuild_catalog', action='store_true')
+    parser.add_argument('--rebuild_search', action='store_true')
+    parser.add_argument('--search', metavar='QUERY')
+    parser.add_argument('--retry_status', action='store_true')
+    parser.add_argument('--subreddit')
+    parser.add_argument('--author')
+    parser.add_argument('--after', metavar='DATE')
+    parser.add_argument('--before', metavar='DATE')
+    parser.add_argument('--sort', choices=['relevance', 'new', 'old'], default='relevance')
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--read_json', nargs='+', metavar=('SEGMENT', 'POST_ID'))
+    parser.add_argument('--serve', action='store_true')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'])
+    parser.add_argument('--shard', type=parse_shard, metavar='N/SHARDS')
     args = parser.parse_args()
 
+    # Set when this is one of the scraper processes started by ShardSupervisor
+    shard, num_shards = None, 1
+    shard_suffix = ''
+    if args.shard is not None:
+        shard, num_shards = args.shard
+        shard_suffix = '-shard' + str(shard)
+
     # Get access to some helper functions
     utils = GeneralUtils('root')
     config = configparser.ConfigParser()
@@ -506,7 +1247,7 @@ if __name__ == "__main__":
     log_path = utils.create_path(os.path.expanduser(config['parser']['log_path']), is_dir=True)
 
     # Create logger to use
-    logger = setup_custom_logger('root', os.path.join(log_path, "reddit_scraper.log"))
+    logger = setup_custom_logger('root', os.path.join(log_path, "reddit_scraper" + shard_suffix + ".log"))
 
     # Check save path
     save_path = utils.create_path(os.path.expanduser(config['parser']['save_path']), is_dir=True)
@@ -529,24 +1270,260 @@ if __name__ == "__main__":
                    Please pick a location that will be just for saving content.")
             sys.exit(0)
 
-    lock_file = os.path.join(save_path, "running.lock")
+    lock_file = os.path.join(save_path, "running" + shard_suffix + ".lock")
+
+    # Other shards save to the same subreddit dirs and failed_domains.csv, take turns with them
+    if shard is not None:
+        set_process_locks(ProcessLocks(os.path.join(save_path, 'temp', 'locks')))
 
     # Get number of threads to use from config
     num_threads = int(config['parser']['num_threads'])
     if num_threads <= 0:
         num_threads = 1
 
+    # Which download engine to use, `threads` or `async`
+    engine = config['parser'].get('engine', 'threads').strip().lower()
+    max_concurrency = int(config['parser'].get('max_concurrency', '1000'))
+    if max_concurrency <= 0:
+        max_concurrency = 1
+
+    # Keep a single copy of each file in <save_path>/files
+    use_media_store = config['parser'].get('media_store', 'false').strip().lower() == 'true'
+
+    # Do not download urls we have already downloaded
+    use_url_index = config['parser'].get('url_index', 'true').strip().lower() == 'true'
+    # How long to wait before trying a url that gave us nothing again (hours)
+    dead_url_ttl = float(config['parser'].get('dead_url_ttl', '24')) * 3600
+
+    # Keep track of the posts we have in <save_path>/logs/catalog.sqlite
+    use_catalog = config['parser'].get('catalog', 'true').strip().lower() == 'true'
+
+    # Full text search of saved posts in <save_path>/logs/search.sqlite
+    use_search = config['parser'].get('search', 'true').strip().lower() == 'true'
+
+    # Timeouts/retries/connection pools/rate limits for all downloads
+    for section in ['download', 'hosts', 'metrics']:
+        if not config.has_section(section):
+            config.add_section(section)
+    download_opts = {'http_client': get_http_client(config['download'], num_threads, 'root'),
+                     'scheduler': get_scheduler(config['download'], config['hosts'], num_shards),
+                     }
+
+    # Max posts to keep in memory, the rest wait on disk
+    queue_size = int(config['parser'].get('queue_size', '1000'))
+
+    # Threads and queue size for saving posts to disk
+    persist_threads = int(config['parser'].get('persist_threads', '2'))
+    persist_queue_size = int(config['parser'].get('persist_queue_size', '100'))
+
+    # How json files are written, `pretty` or `compact`, and which json library to use
+    set_json_serializer(JsonSerializer(library=config['parser'].get('json_library', 'auto').strip().lower(),
+                                       pretty=config['parser'].get('json_format', 'pretty').strip().lower() == 'pretty',
+                                       sort_keys=config['parser'].get('json_sort_keys', 'true').strip().lower() == 'true',
+                                       ensure_ascii=config['parser'].get('json_ascii', 'true').strip().lower() == 'true'))
+
+    # Save just_json posts to their own `files`, or append them to hourly `segments`
+    use_json_segments = config['parser'].get('json_backend', 'files').strip().lower() == 'segments'
+    json_per_subreddit = config['parser'].get('json_segments', 'global').strip().lower() == 'subreddit'
+    json_compression = config['parser'].get('json_compression', 'gzip').strip().lower()
+
+    # Retry failed downloads in the background, waiting retry_delay * 2^n seconds between tries
+    use_retry = config['parser'].get('retry', 'true').strip().lower() == 'true'
+    retry_threads = max(1, int(config['parser'].get('retry_threads', '1')))
+    retry_attempts = int(config['parser'].get('retry_attempts', '5'))
+    retry_delay = float(config['parser'].get('retry_delay', '300'))
+    retry_max_delay = float(config['parser'].get('retry_max_delay', '86400'))
+
+    # Lines to buffer for a urls.csv file, and max seconds to wait, before writing them
+    csv_flush_lines = int(config['parser'].get('csv_flush_lines', '100'))
+    csv_flush_interval = float(config['parser'].get('csv_flush_interval', '5'))
+
+    # Posts on each page of a listing.json, and max seconds to wait before adding new posts to them
+    listing_page_size = int(config['parser'].get('listing_page_size', '100'))
+    listing_flush_interval = float(config['parser'].get('listing_flush_interval', '10'))
+
+    # Write an index.html into every dir, --serve does not need them
+    view_index = config['parser'].get('view_index', 'true').strip().lower() == 'true'
+
+    # Scraper processes to run, each saves the posts of the authors (or subreddits) that hash to it
+    shards = max(1, int(config['parser'].get('shards', '1')))
+    shard_by = config['parser'].get('shard_by', 'author').strip().lower()
+    if shard_by not in ['author', 'subreddit']:
+        shard_by = 'author'
+
+    ###
+    # --profile for scraping, --get_failed and --test_url
+    #   sample: count what every thread is doing, saved as collapsed stacks for a flamegraph
+    #   cprofile: exact call counts, slow so only one worker thread is used
+    ###
+    profiler = None
+    if args.profile and not (args.read_json or args.serve or args.search or args.retry_status or
+                             args.migrate_store or args.prune_store or args.rebuild_catalog or args.rebuild_search):
+        if not config.has_section('profile'):
+            config.add_section('profile')
+        if args.profile == 'cprofile':
+            num_threads = 1
+            persist_threads = 1
+            retry_threads = 1
+            profiler = ThreadProfiler('root', log_path, name='profile' + shard_suffix)
+        else:
+            profiler = SamplingProfiler('root', log_path,
+                                        interval=float(config['profile'].get('interval', '10')) / 1000,
+                                        duration=float(config['profile'].get('duration', '0')),
+                                        name='profile' + shard_suffix)
+        profiler.start()
+
     # Do something based on the arg passed
     if args.get_failed:
         failed_logger = setup_custom_logger('failed', os.path.join(log_path, "reddit_get_failed.log"))
-        get_failed = GetFailed(save_path, num_threads)
+        download_opts['media_store'] = get_media_store(save_path, use_media_store, 'failed')
+        # Dead links are what we are here to retry, so do not skip them
+        download_opts['url_index'] = get_url_index(save_path, use_url_index, 0)
+        get_failed = GetFailed(save_path, num_threads, catalog=get_catalog(save_path, use_catalog),
+                               domains=args.domain, download_opts=download_opts)
     elif args.test_url:
         test_path = utils.create_path(os.path.expanduser(args.test_url[0]), is_dir=True)
         # Create logger to use
         test_logger = setup_custom_logger('test', os.path.join(test_path, "test_download.log"))
-        test_url = TestUrl(test_path, args.test_url[1])
+        test_url = TestUrl(test_path, args.test_url[1], download_opts=download_opts)
+    elif args.read_json:
+        # Print posts from a json segment, one per line
+        reader = SegmentReader()
+        segment_file = os.path.expanduser(args.read_json[0])
+        if len(args.read_json) > 1:
+            for post_id in args.read_json[1:]:
+                print(json.dumps(reader.get(segment_file, post_id)))
+        else:
+            for post in reader.iter_posts(segment_file):
+                print(json.dumps(post))
+    elif args.serve:
+        # Browse the save path, no lock file since it only reads
+        if not config.has_section('server'):
+            config.add_section('server')
+        server_logger = setup_custom_logger('server', os.path.join(log_path, "reddit_server.log"))
+        search_file = os.path.join(save_path, 'logs', 'search.sqlite')
+        server = ArchiveServer(save_path, 'server', host=config['server'].get('host', '127.0.0.1'),
+                               port=int(config['server'].get('port', '8080')),
+                               search_index=SearchIndex(search_file, 'server') if os.path.isfile(search_file) else None)
+        # Nothing to clean up, so let ctrl-c stop it
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    elif args.retry_status:
+        retry_file = os.path.join(save_path, 'logs', 'retry_queue.sqlite')
+        if not os.path.isfile(retry_file):
+            print("Nothing has been queued to retry")
+            sys.exit(0)
+        retry_queue = RetryQueue(retry_file)
+        stats = retry_queue.stats()
+        print("Waiting to retry: " + str(stats['waiting']) + ", given up on: " + str(stats['dead']))
+        for dead in retry_queue.dead_letters(limit=args.limit):
+            print(str(dead['last_error']) + "  " + str(dead['attempts']) + " tries  " + dead['url'])
+            print("    " + dead['post_path'])
+        retry_queue.close()
+    elif args.search:
+        search_file = os.path.join(save_path, 'logs', 'search.sqlite')
+        if not os.path.isfile(search_file):
+            print("No search index found, build it with `python3 main.py --rebuild_search`")
+            sys.exit(0)
+        search_index = SearchIndex(search_file, 'root')
+        results = search_index.search(args.search, subreddit=args.subreddit, author=args.author,
+                                      after=parse_date(args.after), before=parse_date(args.before),
+                                      sort=args.sort, limit=args.limit)
+        for result in results:
+            created = utils.get_datetime(result['created_utc']).strftime('%Y-%m-%d %H:%M')
+            print(created + "  r/" + result['subreddit'] + "  u/" + result['author'] + "  " + result['title'])
+            print("    " + result['path'])
+    elif args.migrate_store:
+        check_lock_file(lock_file)
+        migrate_store = MigrateStore(save_path, num_threads)
+        os.remove(lock_file)
+    elif args.prune_store:
+        check_lock_file(lock_file)
+        media_store = MediaStore(save_path, 'root')
+        dropped, freed_bytes = media_store.prune()
+        print("Dropped " + str(dropped) + " removed files, freed " + str(freed_bytes) + " bytes")
+        media_store.close()
+        os.remove(lock_file)
+    elif args.rebuild_catalog:
+        check_lock_file(lock_file)
+        rebuild_catalog = RebuildCatalog(save_path, num_threads, get_catalog(save_path, True), is_just_json)
+        os.remove(lock_file)
+    elif args.rebuild_search:
+        check_lock_file(lock_file)
+        search_index = get_search_index(save_path, True, 'root')
+        search_index.clear()
+        rebuild_search = RebuildCatalog(save_path, num_threads, None, is_just_json, search_index=search_index)
+        os.remove(lock_file)
     else:
+        if shard is None and shards > 1:
+            # A shard from the last run that is still going, or was killed
+            for n in range(shards):
+                shard_lock_file = os.path.join(save_path, "running-shard" + str(n) + ".lock")
+                if os.path.isfile(shard_lock_file):
+                    check_lock_file(shard_lock_file)
         check_lock_file(lock_file)
-        reddit = RedditScraper(config['reddit_login'], save_path, num_threads, is_just_json)
+        download_opts['media_store'] = get_media_store(save_path, use_media_store, 'root')
+        download_opts['url_index'] = get_url_index(save_path, use_url_index, dead_url_ttl)
+        catalog = get_catalog(save_path, use_catalog)
+        search_index = get_search_index(save_path, use_search, 'root')
+        # First run with the catalog/search on an existing save path (or the last rebuild did not finish),
+        # add what we already have. Both are done from one read of the save path
+        rebuild_catalog = catalog if catalog is not None and not catalog.is_built() else None
+        rebuild_search = search_index if search_index is not None and not search_index.is_built() else None
+        if rebuild_catalog is not None or rebuild_search is not None:
+            if (os.path.isdir(os.path.join(save_path, 'user')) or
+                    os.path.isdir(os.path.join(save_path, 'subreddits'))):
+                RebuildCatalog(save_path, num_threads, rebuild_catalog, is_just_json, search_index=rebuild_search)
+            else:
+                for index in [rebuild_catalog, rebuild_search]:
+                    if index is not None:
+                        index.set_built()
+        if shard is None and shards > 1:
+            # This process only reads the stream, the posts are saved by the shards
+            supervisor = ShardSupervisor(config['reddit_login'], shards, shard_by=shard_by)
+        else:
+            retry_queue = None
+            if use_retry and not is_just_json:
+                retry_queue = RetryQueue(os.path.join(save_path, 'logs', 'retry_queue.sqlite'), max_attempts=retry_attempts,
+                                         base_delay=retry_delay, max_delay=retry_max_delay)
+            json_segments = None
+            if is_just_json and use_json_segments:
+                json_segments = SegmentWriter(save_path, 'root', per_subreddit=json_per_subreddit,
+                                              compression=json_compression,
+                                              serializer=JsonSerializer(library=config['parser'].get('json_library', 'auto').strip().lower(),
+                                                                        pretty=False, sort_keys=False, ensure_ascii=False),
+                                              name_suffix=shard_suffix)
+            # Per stage timings and queue/cache/pool stats, for Prometheus or a look with cat
+            #   Shards each have their own file, and port + <n>
+            metrics_port = int(config['metrics'].get('port', '0'))
+            if metrics_port > 0 and shard is not None:
+                metrics_port += shard
+            metrics_file = None
+            if config['metrics'].get('file', 'true').strip().lower() == 'true':
+                metrics_file = os.path.join(save_path, 'logs', 'metrics' + shard_suffix + '.prom')
+            exporter = MetricsExporter('root', metrics_file=metrics_file,
+                                       port=metrics_port,
+                                       host=config['metrics'].get('host', '127.0.0.1'),
+                                       interval=float(config['metrics'].get('interval', '15')))
+            # A shard gets its posts from the supervisor
+            stream = None
+            if shard is not None:
+                stream = ShardStream(sys.stdin.buffer, JsonSerializer(pretty=False, sort_keys=False, ensure_ascii=False))
+            reddit = RedditScraper(config['reddit_login'], save_path, num_threads, is_just_json,
+                                   engine=engine, max_concurrency=max_concurrency, queue_size=queue_size,
+                                   persist_threads=persist_threads, persist_queue_size=persist_queue_size,
+                                   catalog=catalog, csv_flush_lines=csv_flush_lines,
+                                   csv_flush_interval=csv_flush_interval, json_segments=json_segments,
+                                   retry_queue=retry_queue, retry_threads=retry_threads,
+                                   listing_page_size=listing_page_size, listing_flush_interval=listing_flush_interval,
+                                   view_index=view_index, search_index=search_index, stream=stream, shard=shard,
+                                   download_opts=download_opts)
+            exporter.close()
         # Remove lock file when we are done
         os.remove(lock_file)
+
+    if profiler is not None:
+        profiler.stop()
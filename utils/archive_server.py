@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import socket
+import posixpath
+import mimetypes
+import email.utils
+from urllib.parse import unquote, urlsplit, parse_qs
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from utils.general_utils import GeneralUtils
+from utils.static_assets import StaticTemplates
+from utils.search_index import parse_date
+
+# Files that are added to while we run, the browser has to check for a new copy each time
+CHANGING_FILES = ['.json', '.csv', '.html', '.txt']
+
+mimetypes.add_type('application/json', '.json')
+mimetypes.add_type('application/x-ndjson', '.jsonl')
+mimetypes.add_type('text/csv', '.csv')
+mimetypes.add_type('video/mp4', '.mp4')
+mimetypes.add_type('video/webm', '.webm')
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ArchiveServer(GeneralUtils):
+    """
+    Serves a save path, plus /assets from ./static_assets
+    Dirs without an index.html get the view they would have had (post, day/month/year or user redirect)
+    /search?q=<query>&subreddit=&author=&after=&before=&sort=&limit=&offset= returns json from the search index
+    """
+
+    def __init__(self, save_path, logger_name, host='127.0.0.1', port=8080, assets_path='./static_assets',
+                 search_index=None):
+        super().__init__(logger_name)
+        self.save_path = os.path.realpath(save_path)
+        self.assets_path = os.path.realpath(assets_path)
+        self.static = StaticTemplates()
+        self.search_index = search_index
+
+        self.httpd = ThreadedHTTPServer((host, port), ArchiveRequestHandler)
+        self.httpd.archive = self
+
+    def serve_forever(self):
+        host, port = self.httpd.server_address[:2]
+        self.log("Serving " + self.save_path + " on http://" + host + ":" + str(port) + "/", level='info')
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def translate_path(self, url_path):
+        """
+        :return: path on disk for `url_path`, None if it is outside of the archive
+        """
+        path = posixpath.normpath(unquote(url_path))
+        root = self.save_path
+        if path == '/assets' or path.startswith('/assets/'):
+            root = self.assets_path
+            path = path[len('/assets'):]
+
+        parts = [part for part in path.split('/') if part and part not in ('.', '..')]
+        full_path = os.path.realpath(os.path.join(root, *parts))
+        # Do not follow links out of the archive
+        if full_path != root and not full_path.startswith(root + os.sep):
+            return None
+        return full_path
+
+    def search(self, query_string):
+        """
+        :return: search results for the query string of a /search request
+        """
+        params = parse_qs(query_string)
+
+        def param(name, default=None):
+            return params.get(name, [default])[0]
+
+        limit = min(max(1, int(param('limit', '50'))), 500)
+        offset = max(0, int(param('offset', '0')))
+        results = self.search_index.search(param('q', ''), subreddit=param('subreddit'), author=param('author'),
+                                           after=parse_date(param('after')), before=parse_date(param('before')),
+                                           sort=param('sort', 'relevance'), limit=limit, offset=offset)
+        # Save paths are of no use to the browser
+        for result in results:
+            result.pop('path')
+        return {'limit': limit, 'offset': offset, 'results': results}
+
+    def virtual_index(self, dir_path):
+        """
+        :return: the index.html that would have been saved in `dir_path`, None if it does not get one
+        """
+        if os.path.isfile(os.path.join(dir_path, 'post.json')):
+            return self.static.gen_frame('post_viewer')
+        if os.path.isfile(os.path.join(dir_path, 'listing.json')) or os.path.isfile(os.path.join(dir_path, 'urls.csv')):
+            return self.static.gen_frame('csv_viewer')
+        if os.path.isdir(os.path.join(dir_path, 'posts')):
+            return self.static.gen_redirect("./posts")
+        return None
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests, the views load a lot of small files
+    protocol_version = 'HTTP/1.1'
+    server_version = 'RedditArchive'
+    timeout = 60
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def log_message(self, format, *args):
+        self.server.archive.log(self.address_string() + " " + (format % args), level='debug')
+
+    def handle_request(self, send_body):
+        archive = self.server.archive
+        url = urlsplit(self.path)
+        url_path = url.path
+
+        if url_path == '/search' and archive.search_index is not None:
+            try:
+                results = archive.search(url.query)
+            except ValueError:
+                self.send_error(400)
+                return
+            self.send_bytes(json.dumps(results).encode('utf-8'), 'application/json; charset=utf-8', send_body)
+            return
+
+        path = archive.translate_path(url_path)
+        if path is None:
+            self.send_error(404)
+            return
+
+        if os.path.isdir(path):
+            if not url_path.endswith('/'):
+                # So links relative to the dir work
+                self.send_response(301)
+                self.send_header('Location', url_path + '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            index_file = os.path.join(path, 'index.html')
+            if not os.path.isfile(index_file):
+                html = archive.virtual_index(path)
+                if html is None:
+                    self.send_error(404)
+                else:
+                    self.send_bytes(html.encode('utf-8'), 'text/html; charset=utf-8', send_body)
+                return
+            path = index_file
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        try:
+            self.send_file(path, send_body)
+        except (ConnectionError, socket.timeout):
+            # Client went away, seeking in a video does this a lot
+            self.close_connection = True
+
+    def send_bytes(self, data, content_type, send_body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def send_file(self, path, send_body):
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type == 'application/json':
+            content_type += '; charset=utf-8'
+
+        ###
+        # Use the .gz next to the file if the client can take it, not for ranges since those are into the real file
+        ###
+        encoding = None
+        if self.headers.get('Range') is None and 'gzip' in self.headers.get('Accept-Encoding', '') and \
+           os.path.isfile(path + '.gz') and os.stat(path + '.gz').st_mtime >= os.stat(path).st_mtime:
+            path = path + '.gz'
+            encoding = 'gzip'
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"' + format(stat.st_mtime_ns, 'x') + '-' + format(size, 'x') + ('-gz' if encoding else '') + '"'
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+
+            if self.not_modified(etag, stat.st_mtime):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                return
+
+            start, end = 0, size - 1
+            status = 200
+            byte_range = self.get_range(etag, size)
+            if byte_range == 'invalid':
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            elif byte_range is not None:
+                start, end = byte_range
+                status = 206
+
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Vary', 'Accept-Encoding')
+            if status == 206:
+                self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(end) + '/' + str(size))
+            if encoding is not None:
+                self.send_header('Content-Encoding', encoding)
+            if os.path.splitext(path[:-3] if encoding else path)[1].lower() in CHANGING_FILES:
+                self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            if send_body and end >= start:
+                # Zero copy when the os supports it, socket.sendfile falls back to send() when it does not
+                self.wfile.flush()
+                self.connection.sendfile(f, start, end - start + 1)
+
+    def not_modified(self, etag, mtime):
+        """
+        :return: True if the copy the client has is still good
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return int(mtime) <= since
+        return False
+
+    def get_range(self, etag, size):
+        """
+        Only a single range is supported, for anything else the whole file is sent
+        :return: (start, end) both inclusive, None for the whole file, or `invalid` if it can not be satisfied
+        """
+        range_header = self.headers.get('Range')
+        if range_header is None:
+            return None
+        # If-Range with an old etag means the file changed, so they need all of it
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() != etag:
+            return None
+
+        match = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+        if match is None or match.group(1) + match.group(2) == '':
+            return None
+
+        if match.group(1) == '':
+            # Last n bytes
+            suffix = int(match.group(2))
+            if suffix == 0:
+                return 'invalid'
+            return max(0, size - suffix), size - 1
+
+        start = int(match.group(1))
+        end = size - 1
+        if match.group(2) != '':
+            end = min(int(match.group(2)), size - 1)
+        if start >= size or start > end:
+            return 'invalid'
+        return start, end
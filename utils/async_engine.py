@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from utils.general_utils import GeneralUtils
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncEngine(GeneralUtils):
+
+    def __init__(self, scraper, num_threads, max_concurrency):
+        super().__init__('root')
+        self.scraper = scraper
+
+        # Threads used for anything that would block the event loop
+        #   (page scraping, youtube-dl, hashing, saving files)
+        self.num_threads = num_threads
+        # Max number of posts being worked on at once
+        self.max_concurrency = max_concurrency
+
+        self._tasks = set()
+        self._sem = None
+
+    def in_flight(self):
+        """
+        :return: Number of posts currently being worked on
+        """
+        return len(self._tasks)
+
+    def run(self, stream):
+        """
+        Process every submission from `stream` until it runs out
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.num_threads))
+        try:
+            loop.run_until_complete(self._main(stream))
+        finally:
+            loop.close()
+
+    async def _main(self, stream):
+        loop = asyncio.get_event_loop()
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+
+        session = None
+        if aiohttp is not None:
+            http = self.scraper.ed.http
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            timeout = aiohttp.ClientTimeout(sock_connect=http.connect_timeout, sock_read=http.read_timeout)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        else:
+            self.log("aiohttp is not installed, async engine will download files in threads", level='warning')
+
+        # The reddit stream blocks while waiting for new posts so read it in its own thread
+        stream_done = loop.create_future()
+        feeder = threading.Thread(target=self._feed, args=(stream, session, loop, stream_done))
+        feeder.setDaemon(True)
+        feeder.start()
+
+        try:
+            await stream_done
+            if self._tasks:
+                await asyncio.wait(list(self._tasks))
+        finally:
+            if session is not None:
+                await session.close()
+
+    def _feed(self, stream, session, loop, stream_done):
+        """
+        Hand each submission over to the event loop
+        Blocks when `max_concurrency` posts are already in flight
+        """
+        try:
+            for item in stream:
+                asyncio.run_coroutine_threadsafe(self._submit(item, session), loop).result()
+        except Exception as e:
+            self.log("Exception in async engine stream: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+        finally:
+            loop.call_soon_threadsafe(stream_done.set_result, None)
+
+    async def _submit(self, raw_post, session):
+        await self._sem.acquire()
+        task = asyncio.ensure_future(self._process(raw_post, session))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        self._sem.release()
+
+    async def _process(self, raw_post, session):
+        """
+        Coroutine version of `RedditScraper.parse_post`
+        """
+        scraper = self.scraper
+        loop = asyncio.get_event_loop()
+        try:
+            post = scraper.filter_post(scraper.submission_to_dict(raw_post))
+            if post is None:
+                return
+
+            if scraper.just_json:
+                await loop.run_in_executor(None, scraper.save_just_json, post)
+                return
+
+            is_new = await loop.run_in_executor(None, scraper.prepare_post, post)
+            if not is_new:
+                return
+
+            scraper.cprint("Getting post " + post['id'] + " by: " + post['author'])
+
+            if scraper.has_thumbnail(post):
+                post['thumbnail_original'] = post['thumbnail']
+                download_response = await scraper.ed.download_async(post['thumbnail_original'],
+                                                                    post['user_save_path'],
+                                                                    session,
+                                                                    lane='thumbnail')
+                scraper.add_thumbnail(post, download_response)
+
+            if post['is_self'] is False:
+                file_list = []
+                scraper.cprint("Downloading external data for: " + post['id'] + " from " + post['domain'], log=True)
+                try:
+                    file_list = await scraper.ed.download_async(post['url'], post['user_save_path'], session)
+                except Exception as e:
+                    self.log("Download failed: " + str(e) + "\n" + str(traceback.format_exc()), level='error')
+                post = await loop.run_in_executor(None, scraper.add_file_downloads, post, file_list)
+
+            await loop.run_in_executor(None, scraper.save_post, post)
+
+        except Exception as e:
+            self.log("Exception in async engine for post: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+from utils.sqlite_db import SqliteDb
+
+
+class Catalog:
+    """
+    Index of every post we have saved
+    Lets us check if we already have a post, or list posts, without touching the save tree
+    """
+
+    # Post status
+    SAVED = 'saved'  # Post and all of its media were saved
+    FAILED = 'failed'  # Post was saved but its media could not be downloaded
+    JSON = 'json'  # Only the json was saved (just_json)
+
+    def __init__(self, catalog_file):
+        self.index = SqliteDb(catalog_file, schema=(
+            '''CREATE TABLE IF NOT EXISTS posts (
+                 id TEXT PRIMARY KEY,
+                 subreddit TEXT NOT NULL,
+                 author TEXT NOT NULL,
+                 created_utc REAL NOT NULL,
+                 domain TEXT,
+                 url TEXT,
+                 post_path TEXT NOT NULL,
+                 web_path TEXT,
+                 files TEXT NOT NULL,
+                 status TEXT NOT NULL,
+                 updated REAL NOT NULL)''',
+            'CREATE INDEX IF NOT EXISTS posts_path ON posts (post_path)',
+            # Nothing queries by these, catalogs made before they were removed do not need to keep them up to date
+            'DROP INDEX IF EXISTS posts_subreddit',
+            'DROP INDEX IF EXISTS posts_author',
+            'DROP INDEX IF EXISTS posts_status',
+            '''CREATE TABLE IF NOT EXISTS users (
+                 name TEXT PRIMARY KEY)''',
+            '''CREATE TABLE IF NOT EXISTS meta (
+                 key TEXT PRIMARY KEY,
+                 value TEXT)''',
+        ))
+
+    def is_built(self):
+        """
+        :return: `True` once a rebuild has added everything already in the save path
+        """
+        row = self.index.db().execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def set_built(self):
+        with self.index.db() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (str(time.time()),))
+
+    def has_post(self, post_id):
+        """
+        :return: `True` if we already have the post
+        """
+        row = self.index.db().execute('SELECT 1 FROM posts WHERE id = ?', (post_id,)).fetchone()
+        return row is not None
+
+    def add_user(self, name):
+        """
+        :return: `True` if this is the first time we have seen the user
+        """
+        with self.index.db() as db:
+            cur = db.execute('INSERT OR IGNORE INTO users (name) VALUES (?)', (name,))
+            return cur.rowcount == 1
+
+    def add_users(self, names):
+        """
+        Add many users at once
+        """
+        with self.index.db() as db:
+            db.executemany('INSERT OR IGNORE INTO users (name) VALUES (?)', [(name,) for name in names])
+
+    def post_status(self, post):
+        """
+        :return: status for a saved post, `failed` if it links to media we do not have
+        """
+        if post.get('is_self') is False and len(post.get('file_downloads', [])) == 0:
+            return self.FAILED
+        return self.SAVED
+
+    def post_row(self, post, post_path, status):
+        """
+        :return: tuple to insert into the posts table for `post`
+        """
+        files = []
+        for saved_file in post.get('file_downloads', []):
+            files.append(os.path.basename(saved_file).partition('.')[0])
+
+        return (post['id'],
+                post.get('subreddit_original', post['subreddit']),
+                post.get('author_original', post['author']),
+                float(post['created_utc']),
+                post.get('domain'),
+                post.get('url'),
+                post_path,
+                post.get('post_web_path'),
+                json.dumps(files),
+                status,
+                time.time(),
+                )
+
+    def add_post(self, post, post_path, status):
+        """
+        Add or update `post`
+        :param post_path: dir (or json file for just_json) the post was saved to
+        """
+        self.add_posts([self.post_row(post, post_path, status)])
+
+    def add_posts(self, rows):
+        """
+        Add or update many posts at once
+        :param rows: list of tuples from `post_row`
+        """
+        with self.index.db() as db:
+            db.executemany('INSERT OR REPLACE INTO posts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def status_for_path(self, post_path):
+        """
+        :return: status of the post saved at `post_path`, None if it is not in the catalog
+        """
+        row = self.index.db().execute('SELECT status FROM posts WHERE post_path = ?', (post_path,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def close(self):
+        self.index.close()
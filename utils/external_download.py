@@ -1,30 +1,61 @@
 import os
-import re
+import time
 import uuid
 import shutil
+import asyncio
 import hashlib
 import requests
+import threading
 import traceback
 import youtube_dl
-import urllib.error
-import urllib.request
-from bs4 import BeautifulSoup
+from utils.http_client import HttpClient
+from utils.host_scheduler import HostScheduler
+from utils.extractor_registry import default_registry
+from utils.metrics import metrics, domain_label
+from utils import html_extract
 from utils.general_utils import GeneralUtils
 
+try:
+    # Only needed by the async engine
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 
 class ExternalDownload(GeneralUtils):
 
-    def __init__(self, base_dir, download_path, logger_name):
+    # Errors that mean the url is gone for good, anything else (timeouts, 429, 5xx, dns) may work next time
+    DEAD_ERRORS = ('HTTPError:404', 'HTTPError:410')
+
+    def __init__(self, base_dir, download_path, logger_name, media_store=None, url_index=None, http_client=None,
+                 scheduler=None):
         super().__init__(logger_name)
         self.base_dir = base_dir
+        # Pooled keep-alive connections shared by every extractor
+        if http_client is None:
+            http_client = HttpClient(logger_name)
+        self.http = http_client
+        # Per host rate limits, every request waits for its turn here
+        if scheduler is None:
+            scheduler = HostScheduler()
+        self.scheduler = scheduler
+        # If set, files are kept once in the global store and hardlinked into the users files
+        self.media_store = media_store
+        # If set, urls we have already downloaded are not downloaded again
+        self.url_index = url_index
         self._url_header = {'User-Agent': 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'}
         self._download_path = download_path
+        # Bytes read from the host at a time when downloading/hashing files
+        self._chunk_size = 65536
+        # Last error each thread hit, so the caller can tell why nothing was downloaded
+        self._errors = threading.local()
 
         # More types here: http://fileinfo.com/filetypes/common
-        self._supported_ext = [  # Video formats
-                                   '3g2', '3gp', 'asf', 'asx', 'avi', 'flv',
-                                   'm2ts', 'mkv', 'mov', 'mp4', 'mpg', 'mpeg',
-                                   'rm', 'swf', 'vob', 'wmv',
+        self._video_ext = ['3g2', '3gp', 'asf', 'asx', 'avi', 'flv',
+                           'm2ts', 'mkv', 'mov', 'mp4', 'mpg', 'mpeg',
+                           'rm', 'swf', 'vob', 'wmv',
+                           ]
+        self._supported_ext = self._video_ext + [
                                  # Audio formats
                                    'mp3', 'wma', 'wav', 'ra', 'ram', 'rm',
                                    'mid', 'ogg', 'acc', 'm4a',
@@ -35,91 +66,246 @@ class ExternalDownload(GeneralUtils):
                                    'pdf', 'zip', 'rar', 'tar', 'gz', '7z',
                                ]
 
+        # Which extractor handles which host
+        #   To support a new site add a `_<name>` method and register it in utils/extractor_registry.py
+        self.extractors = default_registry(self._supported_ext)
+
     ##########
     # STAGE 1
     ##########
-    def download(self, url, user_save_path):
+    def download(self, url, user_save_path, lane=None, retry=False):
         """
         Called from the client
         Figure out which finction to run
+        :param lane: scheduler lane for the files, default is picked by file type
+        :param retry: try the url even if the url index says it is dead
+        :return: list of downloaded files
+        """
+        file_list = []
+        self._set_error(None)
+        self.log(user_save_path + " " + url)
+        url = self._clean_url(url)
+
+        # Where user files are stored
+        user_files_save_path = os.path.join(user_save_path, "files")
+
+        extractor = self._get_extractor(url)
+        if extractor is None:
+            return file_list
+
+        # Have we seen this url before?
+        url_key = None
+        if self.url_index is not None:
+            url_key = self._url_key(url, extractor)
+            file_list = self._from_url_index(url_key, user_files_save_path)
+            if file_list is not None and (len(file_list) > 0 or not retry):
+                if len(file_list) == 0:
+                    self._set_error('DeadUrl')
+                return file_list
+
+        if extractor == 'youtube_dl':
+            file_list = self._youtube_dl(url, user_files_save_path)
+        else:
+            with metrics.timer('stage_seconds', stage='extract', domain=domain_label(url), extractor=extractor):
+                targets = getattr(self, '_' + extractor)(url)
+            temp_files = []
+            for file_url, file_ext in targets:
+                temp_files.append(self._download_file(file_url, file_ext, lane=lane, extractor=extractor))
+            file_list = self._process_dl_files(temp_files, user_files_save_path)
+
+        if url_key is not None and (len(file_list) > 0 or self._is_dead(self.last_error())):
+            self.url_index.record(url_key, file_list)
+        self._count_error(url, extractor, file_list)
+
+        # self.log("Returned file list [external_downloads]: " + str(file_list), level='debug')
+        return file_list
+
+    async def download_async(self, url, user_save_path, session=None, lane=None, retry=False):
+        """
+        Coroutine version of `download` used by the async engine
+        Files are fetched with the aiohttp `session`, everything that would block the
+        event loop (page scraping, youtube-dl, hashing) is run in the loop's executor
+        :param retry: try the url even if the url index says it is dead
         :return: list of downloaded files
         """
+        loop = asyncio.get_event_loop()
+        if session is None or aiohttp is None:
+            return await loop.run_in_executor(None, self.download, url, user_save_path, lane, retry)
+
         file_list = []
+        self._set_error(None)
         self.log(user_save_path + " " + url)
+        url = self._clean_url(url)
+
+        # Where user files are stored
+        user_files_save_path = os.path.join(user_save_path, "files")
+
+        extractor = self._get_extractor(url)
+        if extractor is None:
+            return file_list
+
+        # Have we seen this url before?
+        url_key = None
+        if self.url_index is not None:
+            url_key = self._url_key(url, extractor)
+            file_list = await loop.run_in_executor(None, self._from_url_index, url_key, user_files_save_path)
+            if file_list is not None and (len(file_list) > 0 or not retry):
+                if len(file_list) == 0:
+                    self._set_error('DeadUrl')
+                return file_list
+
+        # Other downloads run in this thread while we wait, so errors are kept here instead of in last_error()
+        error = None
+        if extractor == 'youtube_dl':
+            file_list, error = await loop.run_in_executor(None, self._call_in_thread, self._youtube_dl, url,
+                                                          user_files_save_path)
+        else:
+            start = time.perf_counter()
+            if extractor == 'single_file':
+                targets = self._single_file(url)
+            else:
+                targets, error = await loop.run_in_executor(None, self._call_in_thread, getattr(self, '_' + extractor),
+                                                            url)
+            metrics.observe('stage_seconds', time.perf_counter() - start, stage='extract', domain=domain_label(url),
+                            extractor=extractor)
+            download_errors = []
+            temp_files = await asyncio.gather(*[self._download_file_async(session, file_url, file_ext, lane=lane,
+                                                                          extractor=extractor, errors=download_errors)
+                                                for file_url, file_ext in targets])
+            if len(download_errors) > 0:
+                error = download_errors[-1]
+            file_list, process_error = await loop.run_in_executor(None, self._call_in_thread, self._process_dl_files,
+                                                                  temp_files, user_files_save_path)
+            error = process_error or error
+
+        if url_key is not None and (len(file_list) > 0 or self._is_dead(error)):
+            await loop.run_in_executor(None, self.url_index.record, url_key, file_list)
+        # Nothing else gets to run between here and our caller, so it can use last_error()
+        self._set_error(error)
+        self._count_error(url, extractor, file_list)
+
+        return file_list
+
+    def is_supported(self, url):
+        """
+        :return: `True` if there is an extractor for `url`
+        """
+        return self._get_extractor(self._clean_url(url)) is not None
+
+    def last_error(self):
+        """
+        Only set for errors that happen in this thread, the async engine runs many downloads in one
+        :return: name of the last error from `download` in this thread, None if there was not one
+        """
+        return getattr(self._errors, 'last', None)
+
+    def _set_error(self, error):
+        self._errors.last = error
+
+    def _call_in_thread(self, func, *args):
+        """
+        Run `func` in an executor thread for download_async
+        :return: (what `func` returned, the error it hit in that thread)
+        """
+        self._set_error(None)
+        return func(*args), self.last_error()
+
+    def _is_dead(self, error):
+        """
+        :return: `True` if a url that gave no files with `error` should be remembered as dead
+        """
+        # No error means the extractor found nothing to download
+        return error is None or error in self.DEAD_ERRORS
+
+    def _count_error(self, url, extractor, file_list):
+        """
+        Count the download as failed if it gave us nothing
+        """
+        if len(file_list) == 0:
+            metrics.inc('download_errors_total', domain=domain_label(url), extractor=extractor,
+                        error=self.last_error() or 'NoFiles')
+
+    def _clean_url(self, url):
+        """
+        :return: url with any junk reddit left in it removed
+        """
         # Make sure the url does not have a space in it with content after
         #   Reason: This happend 'http://i.imgur.com/82y5SCN.png [x-post from /r/comics]'
         url = url.split(' ')[0]
         # Sometimes the url has unconverted char in it
         url = url.replace('&amp;', '&')
+        return url
 
-        # Where user files are stored
-        user_files_save_path = os.path.join(user_save_path, "files")
+    def _url_key(self, url, extractor):
+        """
+        Strip the parts of the url that do not change what gets downloaded
+        :return: key to use in the url index
+        """
+        # http and https give us the same content
+        key = url.split('://', 1)[-1]
+        key = key.split('#')[0]
+        # Same parts of the url the extractors throw away
+        if extractor in ['single_file', 'imgur']:
+            key = key.split('?')[0]
 
-        ###
-        # Direct file links
-        ###
-        # Check to see if url is a file
-        url_temp = url.split('?')[0]
-        if url_temp.split('.')[-1].lower() in self._supported_ext:
-            file_list = self._single_file(url, user_files_save_path)
-
-        ###
-        # Imgur links
-        ###
-        elif re.match('.*imgur.com.*', url):
-            file_list = self._imgur(url, user_files_save_path)
-
-        ###
-        # Download using youtube-dl
-        ###
-        elif re.match('.*youtu(be\.com|\.be).*', url) or \
-             re.match('.*vid\.me.*', url) or \
-             re.match('.*vimeo\.com.*', url) or \
-             \
-             re.match('.*xvideos\.com.*', url) or \
-             re.match('.*xvids\.us.*', url) or \
-             re.match('.*xvid6\.com.*', url) or \
-             re.match('.*soundgasm\.net.*', url) or \
-             re.match('.*mrpeepers\.net.*', url) or \
-             re.match('.*lovefreeporn\.com.*', url) or \
-             re.match('.*extremetube\.com.*', url) or \
-             re.match('.*vidbox\.us.*', url) or \
-             re.match('.*pornhub\.com.*', url) or \
-             re.match('.*xhamster\.com.*', url):
-             
-            file_list = self._youtube_dl(url, user_files_save_path)
+        host, _, path = key.partition('/')
+        host = host.lower()
+        if host.startswith('www.'):
+            host = host[4:]
 
-        ###
-        # Get gfycat links
-        ###
-        elif re.match('.*gfycat\.com.*', url):
-            file_list = self._gfycat(url, user_files_save_path)
+        if extractor == 'gfycat':
+            # Only the id is used to get the files
+            return 'gfycat.com/' + path.rstrip('/').split('/')[-1]
+        if extractor == 'single_file' and path.endswith('.gifv'):
+            path = path.replace('.gifv', '.gif')
 
-        ###
-        # Get images from vidble.com
-        ###
-        elif re.match('.*vidble\.com.*', url):
-            file_list = self._vidble(url, user_files_save_path)
+        return host + '/' + path.rstrip('/')
 
-        ###
-        # Get gfycat link from pornbot.net
-        ###
-        elif re.match('.*pornbot\.net.*', url):
-            file_list = self._pornbot(url, user_files_save_path)
+    def _from_url_index(self, url_key, user_files_save_path):
+        """
+        Give the user the files from an earlier download of the same url
+        :return: list of saved files, None if the url needs to be downloaded
+        """
+        files = self.url_index.lookup(url_key)
+        if files is None:
+            return None
 
-        # self.log("Returned file list [external_downloads]: " + str(file_list), level='debug')
-        return file_list
+        saved_file_list = []
+        for file_hash, file_ext, size, source in files:
+            user_file = os.path.join(self._create_hash_folders(user_files_save_path, file_hash),
+                                     file_hash + "." + file_ext)
+            if self.media_store is not None and os.path.isfile(self.media_store.blob_path(file_hash, file_ext)):
+                saved_file_list.append(self.media_store.link(file_hash, file_ext, user_file))
+            elif os.path.isfile(user_file):
+                saved_file_list.append(user_file)
+            elif os.path.isfile(source):
+                self._link_file(source, self.create_path(user_file))
+                saved_file_list.append(user_file)
+            else:
+                # The file has been removed since, get it again
+                return None
+
+        self.log("Found in url index [external_downloads]: " + url_key, level='debug')
+        return saved_file_list
+
+    def _get_extractor(self, url):
+        """
+        :return: name of the extractor that can handle `url`, None if not supported
+        """
+        extractor = self.extractors.find(url)
+        if extractor is None:
+            return None
+        return extractor.name
 
     ##########
     # STAGE 2
     ##########
-    def _single_file(self, url, user_files_save_path):
+    def _single_file(self, url):
         """
         Only ever a single file
-        :return: List of save file paths
+        :return: List of (url, file_ext) to download
         """
         self.log("_single_file [external_downloads]: " + url, level='debug')
-        temp_files = []
 
         # Some time the url will have ? in the end which we do not need
         url = url.split('?')[0]
@@ -130,74 +316,58 @@ class ExternalDownload(GeneralUtils):
 
         # Get file ext, sometimes the url has other data after the ext
         file_ext = url.split('.')[-1]
-        # Add all files that need to be downloaded
-        temp_files.append(self._download_file(url, file_ext))
-
-        saved_image_list = self._process_dl_files(temp_files, user_files_save_path)
 
-        return saved_image_list
+        return [(url, file_ext)]
 
-    def _gfycat(self, url, user_files_save_path):
+    def _gfycat(self, url):
         """
         Download both the mp4 and gif versions of file
         api: http://gfycat.com/api
-        :return: List of save file paths
+        :return: List of (url, file_ext) to download
         """
-        temp_files = []
+        targets = []
         gfycat_file = url.split('/')[-1]
         gfycat = self._get_html("http://gfycat.com/cajax/get/" + gfycat_file, self._url_header, is_json=True)
 
         if gfycat is not False:
             data = gfycat['gfyItem']
-            temp_files.append(self._download_file(data['gifUrl'], 'gif'))
-            temp_files.append(self._download_file(data['mp4Url'], 'mp4'))
+            targets.append((data['gifUrl'], 'gif'))
+            targets.append((data['mp4Url'], 'mp4'))
 
-        saved_image_list = self._process_dl_files(temp_files, user_files_save_path)
-        return saved_image_list
+        return targets
 
-    def _pornbot(self, url, user_files_save_path):
+    def _pornbot(self, url):
         """
-        Get gfycat link from page and pass to _gfycat to download and process
-        :return: List of save file paths
+        Get gfycat link from page and pass to _gfycat
+        :return: List of (url, file_ext) to download
         """
-        saved_image_list = []
         gfycat_link = None
 
         # Remove v. subdomain
         url = url.replace('v.', '')
 
         # Scrape the gfycat link
-        page_soup = self._get_html(url, self._url_header)
-        if page_soup is not False:
-            try:
-                content_list = page_soup.find_all("a", {"target": "_new"})
-                for content in content_list:
-                    link = content['href']
-                    # If we find the link thats it
-                    if re.match('.*gfycat.com.*', link):
-                        gfycat_link = link
-                        break
-
-            except AttributeError:
-                self.log("Failed to find link on page [_pornbot]: " + url, level='error')
-                return []
-
-        if gfycat_link is not None:
-            # Download file using _gfycat
-            saved_image_list = self._gfycat(gfycat_link, user_files_save_path)
-        else:
+        page = self._get_html(url, self._url_header)
+        if page is not False:
+            for link in self._parse_html('pornbot', url, page):
+                # If we find the link thats it
+                if 'gfycat.com' in link:
+                    gfycat_link = link
+                    break
+
+        if gfycat_link is None:
             self.log("Failed to find link on page [_pornbot]: " + url, level='error')
             return []
 
-        return saved_image_list
+        # Get the files using _gfycat
+        return self._gfycat(gfycat_link)
 
-    def _imgur(self, url, user_files_save_path):
+    def _imgur(self, url):
         """
         Download images from imgur albums or single images on page
-        :return: List of save file paths
+        :return: List of (url, file_ext) to download
         """
-        saved_image_list = []
-        temp_files = []
+        targets = []
 
         # Some time the url will have ? or # in the end which we do not need
         url = url.split('?')[0]
@@ -207,68 +377,37 @@ class ExternalDownload(GeneralUtils):
         if '/a/' in url:
             url += "/noscript"
 
-        # Scrape the images from imgur
-        imgur = self._get_html(url, self._url_header)
-        if imgur is not False:
-            try:
-                content_list = imgur.find_all("div", {"class": "image"})
-                for content in content_list:
-                    imgur_url = None
-                    image_url = content.find("img")
-                    if image_url is not None:  # If it is an image or gif
-                        imgur_url = image_url['src']
-                        self.log("Found image [_imgur]: " + url, level='debug')
-                    else:
-                        video_url = content.find("source", {"type": "video/mp4"})
-                        if video_url:  # If we found a video instead
-                            self.log("Found video [_imgur]: " + url, level='debug')
-                            imgur_url = video_url['src']
-
-                    # Check if we found a video/gif/image
-                    if imgur_url is not None:
-                        # Now process the link
-                        if imgur_url.startswith('//'):
-                            imgur_url = 'http:' + imgur_url
-                        imgur_url = imgur_url.split('?')[0]
-                        imgur_ext = imgur_url.split('.')[-1]
-                        temp_files.append(self._download_file(imgur_url, imgur_ext))
-
-            except AttributeError:
-                self.log("Failed to find images in url [_imgur]: " + url, level='error')
-                return []
-
-            saved_image_list = self._process_dl_files(temp_files, user_files_save_path)
-        return saved_image_list
+        # Scrape the images from imgur, the first image (or else mp4 video) in each div.image
+        page = self._get_html(url, self._url_header)
+        if page is not False:
+            for imgur_url in self._parse_html('imgur', url, page):
+                self.log("Found file [_imgur]: " + url, level='debug')
+                # Now process the link
+                if imgur_url.startswith('//'):
+                    imgur_url = 'http:' + imgur_url
+                imgur_url = imgur_url.split('?')[0]
+                imgur_ext = imgur_url.split('.')[-1]
+                targets.append((imgur_url, imgur_ext))
 
-    def _vidble(self, url, user_files_save_path):
+        return targets
+
+    def _vidble(self, url):
         """
         Download images from vidble.com
-        :return: List of save file paths
+        :return: List of (url, file_ext) to download
         """
-        saved_image_list = []
-        temp_files = []
+        targets = []
         base_url = 'http://www.vidble.com/'
 
         # Scrape the images
-        page_soup = self._get_html(url, self._url_header)
-        if page_soup is not False:
-            try:
-                content_list = page_soup.find_all("img", {"class": "img2"})
-                for content in content_list:
-                    try:
-                        image_url = base_url + content['src']
-                    except KeyError:
-                        image_url = base_url + content['data-original']
-
-                    image_ext = image_url.split('.')[-1]
-                    temp_files.append(self._download_file(image_url, image_ext))
-
-            except AttributeError:
-                self.log("Failed to find images in url [_imgur]: " + url, level='error')
-                return []
-
-            saved_image_list = self._process_dl_files(temp_files, user_files_save_path)
-        return saved_image_list
+        page = self._get_html(url, self._url_header)
+        if page is not False:
+            for image in self._parse_html('vidble', url, page):
+                image_url = base_url + image
+                image_ext = image_url.split('.')[-1]
+                targets.append((image_url, image_ext))
+
+        return targets
 
     def _youtube_dl(self, url, user_files_save_path):
         """
@@ -282,17 +421,22 @@ class ExternalDownload(GeneralUtils):
             'format': 'mp4',
             'outtmpl': temp_file,
             'quiet': True,
-            'no_warnings': True
+            'no_warnings': True,
+            'socket_timeout': self.http.read_timeout,
         }
         self.log("Download video [_youtube_dl]: " + url, level='info')
         try:
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+            with self.scheduler.slot(url, 'video'), youtube_dl.YoutubeDL(ydl_opts) as ydl, \
+                 metrics.timer('stage_seconds', stage='download', domain=domain_label(url), extractor='youtube_dl'):
                 ydl.download([url])
         except youtube_dl.utils.ExtractorError as e:
+            self._set_error('ExtractorError')
             self.log("ExtractorError [_youtube_dl]: " + str(e) + " " + url, level='error')
         except youtube_dl.utils.DownloadError as e:
+            self._set_error('DownloadError')
             self.log("DownloadError [_youtube_dl]: " + str(e) + " " + url, level='error')
         except Exception as e:
+            self._set_error(e.__class__.__name__)
             self.log("Exception [_youtube_dl]: " + str(e) + " " + url + "\n" + str(traceback.format_exc()), level='error')
         else:
             saved_image_list = self._process_dl_files([temp_file], user_files_save_path)
@@ -304,28 +448,114 @@ class ExternalDownload(GeneralUtils):
     ##########
     # STAGE 3
     ##########
-    def _download_file(self, url, file_ext, header={}):
+    def _download_file(self, url, file_ext, header={}, lane=None, extractor='single_file'):
         """
+        Stream `url` to a temp file in chunks, hashing each chunk as it is written
+        :param extractor: extractor that found the file, to label its metrics with
+        :return: (temp file, sha256 hash), False if something broke
         """
         self.log("Download file [external_downloads]: " + url + " w/ext " + file_ext, level='debug')
         self.log("Starting download: " + url)
         temp_file = self._create_temp_file(file_ext)
+        hasher = hashlib.sha256()
+        if lane is None:
+            lane = self._file_lane(file_ext)
+        labels = {'domain': domain_label(url), 'extractor': extractor}
+        size = 0
+        hash_time = 0
+        start = None
         try:
-            with urllib.request.urlopen(
-              urllib.request.Request(url, headers=header)) as response, \
-                open(temp_file, 'wb') as out_file:
-                    data = response.read()
-                    out_file.write(data)
+            with self.scheduler.slot(url, lane):
+                # Time waiting for the host is counted by the scheduler
+                start = time.perf_counter()
+                with self.http.get(url, headers=header, stream=True) as response:
+                    # Before the file is opened, so errors do not leave empty files behind
+                    response.raise_for_status()
+                    with open(temp_file, 'wb') as out_file:
+                        for chunk in response.iter_content(self._chunk_size):
+                            hash_start = time.perf_counter()
+                            hasher.update(chunk)
+                            hash_time += time.perf_counter() - hash_start
+                            out_file.write(chunk)
+                            size += len(chunk)
+
+            return_value = (temp_file, hasher.hexdigest())
 
-            return_value = temp_file
-
-        except urllib.error.HTTPError as e:
+        except requests.exceptions.HTTPError as e:
             return_value = False
-            self.log("Error [download]: " + str(e.code) + " " + url, level='error')
+            self._remove_temp_file(temp_file)
+            self._set_error('HTTPError:' + str(e.response.status_code))
+            self.log("Error [download]: " + str(e.response.status_code) + " " + url, level='error')
         except Exception as e:
             return_value = False
+            self._remove_temp_file(temp_file)
+            self._set_error(e.__class__.__name__)
             self.log("Exception [download]: " + str(e) + " " + url, level='error')
 
+        if start is not None:
+            metrics.observe('stage_seconds', time.perf_counter() - start - hash_time, stage='download', **labels)
+            metrics.observe('stage_seconds', hash_time, stage='hash', **labels)
+            metrics.inc('download_bytes_total', size, **labels)
+        return return_value
+
+    async def _download_file_async(self, session, url, file_ext, header={}, lane=None, extractor='single_file',
+                                   errors=None):
+        """
+        Same as `_download_file` but does not hold a thread while waiting on the host
+        :param errors: list to add the error to if it fails
+        """
+        self.log("Download file async [external_downloads]: " + url + " w/ext " + file_ext, level='debug')
+        temp_file = self._create_temp_file(file_ext)
+        hasher = hashlib.sha256()
+        if lane is None:
+            lane = self._file_lane(file_ext)
+        labels = {'domain': domain_label(url), 'extractor': extractor}
+        size = 0
+        hash_time = 0
+
+        # Wait for our turn with the host
+        start = time.perf_counter()
+        wait = self.scheduler.try_acquire(url, lane)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.scheduler.try_acquire(url, lane)
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='host_wait', domain=labels['domain'],
+                        extractor='')
+        start = time.perf_counter()
+
+        try:
+            async with session.get(url, headers=header) as response:
+                response.raise_for_status()
+                with open(temp_file, 'wb') as out_file:
+                    async for chunk in response.content.iter_chunked(self._chunk_size):
+                        hash_start = time.perf_counter()
+                        hasher.update(chunk)
+                        hash_time += time.perf_counter() - hash_start
+                        out_file.write(chunk)
+                        size += len(chunk)
+
+            return_value = (temp_file, hasher.hexdigest())
+
+        except aiohttp.ClientResponseError as e:
+            return_value = False
+            self._remove_temp_file(temp_file)
+            self._set_error('HTTPError:' + str(e.status))
+            if errors is not None:
+                errors.append(self.last_error())
+            self.log("Error [download_async]: " + str(e.status) + " " + url, level='error')
+        except Exception as e:
+            return_value = False
+            self._set_error(e.__class__.__name__)
+            if errors is not None:
+                errors.append(self.last_error())
+            self._remove_temp_file(temp_file)
+            self.log("Exception [download_async]: " + str(e) + " " + url, level='error')
+        finally:
+            self.scheduler.release(url)
+
+        metrics.observe('stage_seconds', time.perf_counter() - start - hash_time, stage='download', **labels)
+        metrics.observe('stage_seconds', hash_time, stage='hash', **labels)
+        metrics.inc('download_bytes_total', size, **labels)
         return return_value
 
     ##########
@@ -334,13 +564,17 @@ class ExternalDownload(GeneralUtils):
     def _process_dl_files(self, file_list, user_files_save_path):
         """
         After all files have been downloaded, do stuff to them
+        :param file_list: temp files, or (temp file, hash) if the hash was taken while downloading
         """
         saved_image_list = []
         for temp_file in file_list:
             if temp_file is not False:
+                file_hash = None
+                if isinstance(temp_file, tuple):
+                    temp_file, file_hash = temp_file
                 self.log("_process_dl_files [external_downloads] temp file: " + temp_file, level='debug')
                 # Post process the temp file
-                post_processed = self._post_process(temp_file, user_files_save_path)
+                post_processed = self._post_process(temp_file, user_files_save_path, file_hash=file_hash)
                 # Now save the file name/path to be passed back to the client
                 saved_image_list.append(post_processed)
 
@@ -349,12 +583,16 @@ class ExternalDownload(GeneralUtils):
     ##########
     # STAGE 5
     ##########
-    def _post_process(self, temp_file, user_files_save_path):
+    def _post_process(self, temp_file, user_files_save_path, file_hash=None):
         """
         After downloads have finished, rename and move them
+        :param file_hash: sha256 of the file if we already have it
         """
-        # Get file hash
-        file_hash = self._get_file_hash(temp_file)
+        # Get file hash, only need to read the file again if it was not hashed while downloading
+        if file_hash is None:
+            # Only youtube-dl files are not hashed while downloading
+            with metrics.timer('stage_seconds', stage='hash', domain='', extractor='youtube_dl'):
+                file_hash = self._get_file_hash(temp_file)
         # self.log("_post_process [external_downloads] file hash: " + file_hash, level='debug')
         # Get file ext
         file_ext = temp_file.split('.')[-1]
@@ -362,8 +600,12 @@ class ExternalDownload(GeneralUtils):
         hashed_save_path = self._create_hash_folders(user_files_save_path, file_hash)
         # self.log("_post_process [external_downloads] hashed save path: " + hashed_save_path, level='debug')
         new_save_file = os.path.join(hashed_save_path, file_hash + "." + file_ext)
-        # Move temp file to new save location
-        self._move_file(temp_file, self.create_path(new_save_file))
+        with metrics.timer('stage_seconds', stage='move', domain='', extractor=''):
+            if self.media_store is not None:
+                self.media_store.add(temp_file, file_hash, file_ext)
+                return self.media_store.link(file_hash, file_ext, new_save_file)
+            # Move temp file to new save location
+            self._move_file(temp_file, self.create_path(new_save_file))
         return new_save_file
 
     ##########
@@ -396,12 +638,40 @@ class ExternalDownload(GeneralUtils):
     def _move_file(self, source, destination):
         """
         Move temp download file to users hashed files
+        The temp dir lives under the save path so this is normally a single rename,
+        only fall back to copying if they are on different filesystems
         """
-        shutil.move(source, destination)
+        try:
+            os.replace(source, destination)
+        except FileNotFoundError:
+            if not os.path.isfile(source):
+                raise
+            # The users dir was removed since we created it
+            self.forget_path(destination)
+            os.replace(source, self.create_path(destination))
+        except OSError:
+            shutil.move(source, destination)
 
     ##########
     # Helpers
     ##########
+    def _file_lane(self, file_ext):
+        """
+        :return: scheduler lane to download a file with `file_ext` in
+        """
+        if file_ext.lower() in self._video_ext:
+            return 'video'
+        return 'image'
+
+    def _link_file(self, source, destination):
+        """
+        Hardlink source -> destination, copy it if the filesystem can not
+        """
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
     def _create_temp_file(self, file_ext):
         """
         :return: Full save path of temp file
@@ -409,6 +679,15 @@ class ExternalDownload(GeneralUtils):
         temp_name = str(uuid.uuid4())
         temp_file = os.path.join(self._download_path, temp_name + "." + file_ext)
         return temp_file
+
+    def _remove_temp_file(self, temp_file):
+        """
+        Remove what is left of a download that failed, if it got as far as being created
+        """
+        try:
+            os.remove(temp_file)
+        except FileNotFoundError:
+            pass
         
     def _hashfile(self, afile, hasher, blocksize=65536):
         """
@@ -422,31 +701,50 @@ class ExternalDownload(GeneralUtils):
         afile.close()
         return hasher.hexdigest()
 
+    def _parse_html(self, extractor, url, page):
+        """
+        :return: list of the links `extractor` needs from `page`, empty if something broke
+        """
+        try:
+            with metrics.timer('stage_seconds', stage='page_parse', domain=domain_label(url), extractor=extractor):
+                return html_extract.extract(extractor, page)
+        except Exception as e:
+            self.log("Failed to parse page [_" + extractor + "]: " + str(e) + " " + url + "\n" + str(traceback.format_exc()), level='error')
+            return []
+
     def _get_html(self, url, header={}, is_json=False):
         """
-        :return: soup of json from url, False if something broke
+        :return: page text (or json) from url, False if something broke
         """
         try:
-            response = requests.get(url, headers=header)
+            # The connection goes back to the pool once the body has been read
+            with self.scheduler.slot(url, 'json'), \
+                 metrics.timer('stage_seconds', stage='page_fetch', domain=domain_label(url),
+                               extractor=self._get_extractor(url) or ''):
+                response = self.http.get(url, headers=header)
             if response.status_code == requests.codes.ok:
                 if is_json:
                     data = response.json()
                 else:
-                    data = BeautifulSoup(response.text)
+                    data = response.text
 
                 return data
 
             response.raise_for_status()
+        except requests.exceptions.Timeout as e:
+            self._set_error('Timeout')
+            self.log("Timeout [_get_site]: " + str(e) + " " + url, level='error')
         except requests.exceptions.HTTPError as e:
+            self._set_error('HTTPError:' + str(e.response.status_code))
             self.log("HTTPError [_get_site]: " + str(e.response.status_code) + " " + url, level='error')
         except requests.exceptions.ConnectionError as e:
+            self._set_error('ConnectionError')
             self.log("ConnectionError [_get_site]: " + str(e) + " " + url, level='error')
         except requests.exceptions.TooManyRedirects as e:
+            self._set_error('TooManyRedirects')
             self.log("TooManyRedirects [_get_site]: " + str(e) + " " + url, level='error')
         except Exception as e:
+            self._set_error(e.__class__.__name__)
             self.log("Exception [_get_site]: " + str(e) + " " + url + "\n" + str(traceback.format_exc()), level='critical')
-        finally:
-            # https://github.com/kennethreitz/requests/issues/1882
-            response.connection.close()
 
         return False
@@ -0,0 +1,112 @@
+import re
+
+
+class Extractor:
+    """
+    Which hosts an extractor handles
+    """
+
+    def __init__(self, name, hosts):
+        """
+        :param name: name of the ExternalDownload method, without the leading `_`
+        :param hosts: host suffixes handled, `imgur.com` also covers `i.imgur.com`
+        """
+        self.name = name
+        self.hosts = hosts
+
+    def __repr__(self):
+        return "<Extractor " + self.name + ">"
+
+
+# scheme://login@host:port/...
+HOST_PATTERN = re.compile(r'(?:[^:/?#]*://)?(?:[^@/?#]*@)?([^:/?#]*)')
+
+
+class ExtractorRegistry:
+    """
+    Finds the extractor for a url by looking up its host (and each parent domain) in a dict
+    Urls whose host is not registered are checked against one precompiled pattern of all
+    the hosts, so a host anywhere in the url still matches like it used to
+    """
+
+    def __init__(self, file_exts=()):
+        # Direct links to any of these get the `single_file` extractor
+        self.file_exts = frozenset(ext.lower() for ext in file_exts)
+        self.single_file = Extractor('single_file', [])
+
+        self._by_host = {}
+        self._by_name = {}
+        self._fallback = None
+
+    def register(self, extractor):
+        """
+        Add `extractor`, later registrations win if they use the same host
+        """
+        self._by_name[extractor.name] = extractor
+        for host in extractor.hosts:
+            self._by_host[host.lower()] = extractor
+        self._fallback = None
+
+    def get(self, name):
+        """
+        :return: Extractor registered as `name`, None if there is not one
+        """
+        if name == 'single_file':
+            return self.single_file
+        return self._by_name.get(name)
+
+    def find(self, url):
+        """
+        :return: Extractor to use for `url`, None if it is not supported
+        """
+        # Check to see if url is a file
+        url_temp = url.split('?', 1)[0]
+        if url_temp.rsplit('.', 1)[-1].lower() in self.file_exts:
+            return self.single_file
+
+        host = self.get_host(url)
+        while host:
+            extractor = self._by_host.get(host)
+            if extractor is not None:
+                return extractor
+            # i.imgur.com -> imgur.com -> com
+            host = host.partition('.')[2]
+
+        return self._find_fallback(url)
+
+    def get_host(self, url):
+        """
+        :return: lower case host name of `url` without the port or login
+        """
+        return HOST_PATTERN.match(url).group(1).lower()
+
+    def _find_fallback(self, url):
+        if self._fallback is None:
+            # Plain alternation of the hosts, named groups or IGNORECASE make it many times slower
+            hosts = sorted(self._by_host, key=len, reverse=True)
+            self._fallback = re.compile('|'.join(re.escape(host) for host in hosts) or '(?!)')
+        match = self._fallback.search(url.lower())
+        if match is None:
+            return None
+        return self._by_host[match.group(0)]
+
+
+def default_registry(file_exts):
+    """
+    :return: ExtractorRegistry with every extractor ExternalDownload has
+    """
+    registry = ExtractorRegistry(file_exts)
+
+    registry.register(Extractor('imgur', ['imgur.com']))
+    registry.register(Extractor('youtube_dl', ['youtube.com', 'youtu.be', 'vid.me', 'vimeo.com',
+                                               # NSFW
+                                               'xvideos.com', 'xvids.us', 'xvid6.com',
+                                               'soundgasm.net', 'mrpeepers.net', 'lovefreeporn.com',
+                                               'extremetube.com', 'vidbox.us', 'pornhub.com',
+                                               'xhamster.com',
+                                               ]))
+    registry.register(Extractor('gfycat', ['gfycat.com']))
+    registry.register(Extractor('vidble', ['vidble.com']))
+    registry.register(Extractor('pornbot', ['pornbot.net']))
+
+    return registry
@@ -0,0 +1,134 @@
+from utils.sqlite_db import SqliteDb
+
+
+class FailedBacklog:
+    """
+    Work list for --get_failed, kept on disk so a run that dies can pick up where it stopped
+    failed_domains.csv is read into it a batch at a time, each url is only kept once
+    along with every post that links to it
+    """
+
+    def __init__(self, db_file):
+        self.index = SqliteDb(db_file, schema=(
+            '''CREATE TABLE IF NOT EXISTS urls (
+                 url TEXT PRIMARY KEY,
+                 domain TEXT NOT NULL,
+                 done INTEGER NOT NULL DEFAULT 0)''',
+            'CREATE INDEX IF NOT EXISTS urls_todo ON urls (done, domain)',
+            '''CREATE TABLE IF NOT EXISTS posts (
+                 url TEXT NOT NULL,
+                 post_path TEXT NOT NULL,
+                 PRIMARY KEY (url, post_path))''',
+            '''CREATE TABLE IF NOT EXISTS meta (
+                 key TEXT PRIMARY KEY,
+                 value TEXT)''',
+        ))
+
+    def _get_meta(self, key, default=None):
+        row = self.index.db().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def import_file(self, failed_file, batch_size=10000, progress=None):
+        """
+        Add the lines of `failed_file` that have not been added yet
+        The offset read up to is saved with each batch, so it can be stopped at any time
+        :param progress: called with the number of lines read after each batch
+        """
+        offset = int(self._get_meta('offset:' + failed_file, 0))
+        num_lines = 0
+        with open(failed_file, 'rb') as f:
+            f.seek(offset)
+            while True:
+                urls = []
+                posts = []
+                for line in f:
+                    # domain,url,post_save_path the url can have `,` in it
+                    content = line.decode('utf-8').strip()
+                    if content.count(',') < 2:
+                        continue
+                    domain, rest = content.split(',', 1)
+                    url, post_path = rest.rsplit(',', 1)
+                    urls.append((url, domain.lower()))
+                    posts.append((url, post_path))
+                    if len(urls) >= batch_size:
+                        break
+                if len(urls) == 0:
+                    break
+
+                with self.index.db() as db:
+                    db.executemany('INSERT OR IGNORE INTO urls (url, domain) VALUES (?, ?)', urls)
+                    db.executemany('INSERT OR IGNORE INTO posts (url, post_path) VALUES (?, ?)', posts)
+                    db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                               ('offset:' + failed_file, str(f.tell())))
+                num_lines += len(urls)
+                if progress is not None:
+                    progress(num_lines)
+
+        return num_lines
+
+    def forget_file(self, failed_file):
+        """
+        Call just before `failed_file` is removed, so a new file with the same name is read from the start
+        """
+        with self.index.db() as db:
+            db.execute('DELETE FROM meta WHERE key = ?', ('offset:' + failed_file,))
+
+    def _domain_filter(self, domains):
+        """
+        :return: sql and args to only match `domains` and their subdomains
+        """
+        if not domains:
+            return '', []
+        where = []
+        args = []
+        for domain in domains:
+            where.append('domain = ? OR domain LIKE ?')
+            args += [domain.lower(), '%.' + domain.lower()]
+        return ' AND (' + ' OR '.join(where) + ')', args
+
+    def pending(self, domains=None, batch_size=1000):
+        """
+        :param domains: only urls from these domains (and their subdomains)
+        :return: generator of (url, domain) still to do, grouped by domain
+        """
+        where, args = self._domain_filter(domains)
+        last = ('', '')
+        while True:
+            # Page through so no read is held open while the workers update rows
+            rows = self.index.db().execute('SELECT domain, url FROM urls WHERE done = 0 AND '
+                                           '(domain > ? OR (domain = ? AND url > ?))' +
+                                           where + ' ORDER BY domain, url LIMIT ?',
+                                           [last[0], last[0], last[1]] + args + [batch_size]).fetchall()
+            if len(rows) == 0:
+                return
+            for domain, url in rows:
+                yield url, domain
+            last = rows[-1]
+
+    def count_pending(self, domains=None):
+        where, args = self._domain_filter(domains)
+        return self.index.db().execute('SELECT COUNT(*) FROM urls WHERE done = 0' + where, args).fetchone()[0]
+
+    def post_paths(self, url):
+        """
+        :return: list of post save paths that link to `url`
+        """
+        rows = self.index.db().execute('SELECT post_path FROM posts WHERE url = ?', (url,)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_done(self, url):
+        with self.index.db() as db:
+            db.execute('UPDATE urls SET done = 1 WHERE url = ?', (url,))
+
+    def clear_done(self):
+        """
+        Remove everything that has been done
+        """
+        with self.index.db() as db:
+            db.execute('DELETE FROM posts WHERE url IN (SELECT url FROM urls WHERE done = 1)')
+            db.execute('DELETE FROM urls WHERE done = 1')
+
+    def close(self):
+        self.index.close()
@@ -1,5 +1,4 @@
 import os
-import re
 import json
 import urllib
 import shutil
@@ -7,6 +6,52 @@ import logging
 import traceback
 import threading
 from datetime import datetime
+from utils.lru_cache import LruSet
+from utils.json_serializer import JsonSerializer
+
+# Locks for append_file, files are spread over these so we never need more then this many
+_append_locks = [threading.Lock() for i in range(64)]
+
+# Dirs we know exist, shared by every thread so each dir is only checked once
+_known_dirs = LruSet(maxsize=10000)
+
+# Used by save_file/load_json, set from the config with set_json_serializer()
+_json_serializer = JsonSerializer()
+
+
+def set_json_serializer(serializer):
+    """
+    Use `serializer` for all json files saved/loaded from now on
+    """
+    global _json_serializer
+    _json_serializer = serializer
+
+
+# Set with set_process_locks() when other processes (shards) save to the same save path
+_process_locks = None
+
+
+class _NoLock:
+    """
+    Stands in for a process lock when there is only one process
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+
+_no_lock = _NoLock()
+
+
+def set_process_locks(process_locks):
+    """
+    Use `process_locks` (a ProcessLocks) around files that other processes write to as well
+    """
+    global _process_locks
+    _process_locks = process_locks
 
 
 class GeneralUtils:
@@ -16,12 +61,12 @@ class GeneralUtils:
         self.log_name = logger_name
         self.logger = logging.getLogger(self.log_name)
 
-        # Lock file access when in use
-        self.file_lock = {}
-
         # So we know how long the prev string printed was
         self.prev_cstr = ''
 
+        # Set to a RetryQueue to retry failed downloads in the background
+        self.retry_queue = None
+
         # Windows folders can not be these names
         self.bad_folders = ['con', 'prn', 'aux', 'nul', 'com1', 'com2', 'com3',
                             'com4', 'com5', 'com6', 'com7', 'com8', 'com9',
@@ -52,21 +97,55 @@ class GeneralUtils:
         """
         path = self.norm_path(path)
         path_check = path
-        does_path_exists = os.path.exists(path_check)
 
         if not is_dir:
             path_check = os.path.dirname(path)
 
-        if does_path_exists:
+        if path_check == '' or _known_dirs.has(path_check):
             return path
 
         try:
-            os.makedirs(path_check)
+            os.makedirs(path_check, exist_ok=True)
+            _known_dirs.add(path_check)
         except OSError:
             pass
 
         return path
 
+    def process_lock(self, path):
+        """
+        :return: lock to hold while changing `path`, does nothing when this is the only process
+        """
+        if _process_locks is None:
+            return _no_lock
+        return _process_locks.lock(path)
+
+    def forget_path(self, path, is_dir=False):
+        """
+        Remove the dir of `path` from the known dirs, call when it turns out to be gone
+        """
+        path = self.norm_path(path)
+        if not is_dir:
+            path = os.path.dirname(path)
+        _known_dirs.discard(path)
+
+    def path_cache_stats(self):
+        """
+        :return: dict of dirs known and create_path hits/misses, each hit is a stat we did not do
+        """
+        return _known_dirs.stats()
+
+    def open_file(self, save_file, mode):
+        """
+        Open `save_file`, creating its dir if needed
+        If the dir was removed since we last saw it, create it again
+        """
+        try:
+            return open(self.create_path(save_file), mode)
+        except FileNotFoundError:
+            self.forget_path(save_file)
+            return open(self.create_path(save_file), mode)
+
     def create_save_path(self, *args):
         """
         Creates directory from base_dir and appends on any dirs passed in on args
@@ -111,24 +190,41 @@ class GeneralUtils:
         path = self.norm_path(path)
         return path
 
-    def download_content(self, post):
+    def download_content(self, post, retry=False):
         """
+        :param retry: this is a retry, use the lowest priority and do not trust the url index if it says the url is dead
         :return: Modified post dict
         """
         # Create an empty file list
         file_list = []
+        error = None
 
         self.cprint("Downloading external data for: " + post['id'] + " from " + post['domain'], log=True)
         try:
-            file_list = self.ed.download(post['url'], post['user_save_path'])
+            if retry:
+                file_list = self.ed.download(post['url'], post['user_save_path'], lane='retry', retry=True)
+            else:
+                file_list = self.ed.download(post['url'], post['user_save_path'])
         except Exception as e:
+            error = e.__class__.__name__
             self.log("Download failed: " + str(e) + "\n" + str(traceback.format_exc()), level='error')
 
+        return self.add_file_downloads(post, file_list, error=error)
+
+    def add_file_downloads(self, post, file_list, error=None):
+        """
+        Record the downloaded files in the post, log it as failed if there are none
+        :param error: why nothing was downloaded, if known
+        :return: Modified post dict
+        """
         # If file_list is empty, that means that the downloads failed and we need to tray again
         if len(file_list) == 0:
-            failed_content = post['domain'] + "," + post['url'] + "," + post['post_save_path']
-            self.append_file(self.failed_domain_file, failed_content)
-            self.log("Failed domain: " + post['domain'] + " post: " + post['post_save_path'], level='error')
+            if error is None:
+                if not self.ed.is_supported(post['url']):
+                    error = 'Unsupported'
+                else:
+                    error = self.ed.last_error() or 'NoFiles'
+            self.failed_download(post, error)
 
         # Add file list to selftext_html to be viewed
         post['selftext_html'] = '<h2>Files:</h2><a href="' + post['url'] + '">External link</a><br />'
@@ -143,6 +239,25 @@ class GeneralUtils:
 
         return post
 
+    def failed_download(self, post, error):
+        """
+        Queue the post to be retried later, or if we can not (or have given up) log it
+        to failed_domains.csv so `--get_failed` can get it
+        """
+        if self.retry_queue is not None and error != 'Unsupported':
+            # No point waiting for these to come back
+            permanent = error in ['HTTPError:404', 'HTTPError:410']
+            is_dead = self.retry_queue.add_failure(post['post_save_path'], post['url'], post['domain'], error,
+                                                   permanent=permanent)
+            if not is_dead:
+                self.log("Will retry: " + error + " " + post['domain'] + " post: " + post['post_save_path'], level='warning')
+                return
+            self.log("Giving up on: " + error + " " + post['domain'] + " post: " + post['post_save_path'], level='error')
+
+        failed_content = post['domain'] + "," + post['url'] + "," + post['post_save_path']
+        self.append_file(self.failed_domain_file, failed_content)
+        self.log("Failed domain: " + post['domain'] + " post: " + post['post_save_path'], level='error')
+
     def cprint(self, cstr, log=False):
         """
         Clear then print on same line
@@ -150,7 +265,7 @@ class GeneralUtils:
         """
         # Blank out whole line
         #   The +1 is ther just to make sure it clears all chars
-        cstr = "Queue: " + str(self.q.qsize()) + " - " + cstr
+        cstr = self.queue_status() + " - " + cstr
         num_spaces = 0
         if len(cstr) < len(self.prev_cstr):
             num_spaces = abs(len(self.prev_cstr) - len(cstr))
@@ -164,6 +279,14 @@ class GeneralUtils:
             pass
             # self.log(cstr)
 
+    def queue_status(self):
+        """
+        :return: String showing how much work is waiting to be processed
+        """
+        if hasattr(self, 'q'):
+            return "Queue: " + str(self.q.qsize())
+        return "Queue: 0"
+
     def log(self, msg, level='info'):
         """
         :param msg: Data to save to file
@@ -198,37 +321,43 @@ class GeneralUtils:
         # Make sure path exists
         self.create_path(destination)
         # Copy over file
-        shutil.copy2(source, destination)
+        try:
+            shutil.copy2(source, destination)
+        except FileNotFoundError:
+            if not os.path.isfile(source):
+                raise
+            self.forget_path(destination)
+            shutil.copy2(source, self.create_path(destination))
         self.log("Copied file '" + source + "' to '" + destination + "'", level='debug')
 
     def append_file(self, save_file, content):
         """
         Append content to end of file
         """
-        # Create dict save name from savefile
-        pattern = re.compile('[\W_]+')
-        file_dict_name = pattern.sub('', save_file)
-        # Create perfile Lock
-        if file_dict_name not in self.file_lock:
-            self.file_lock[file_dict_name] = threading.Lock()
-        self.file_lock[file_dict_name].acquire()
-        try:
-            with open(self.create_path(save_file), 'a') as f:
+        # Only one thread can write to a file at a time
+        with _append_locks[hash(save_file) % len(_append_locks)], self.process_lock(save_file):
+            with self.open_file(save_file, 'a') as f:
                 f.write(content + "\n")
-        finally:
-            self.file_lock[file_dict_name].release()
 
     def save_file(self, save_file, content, content_type='plain_text'):
         """
         Saves file json or plain text default=plain_text
         If content is not json it will save in plain text
         """
-        with open(self.create_path(save_file), 'w') as f:
-            if content_type == 'json':
-                json.dump(content, f, sort_keys=True, indent=4)
-            else:
+        if content_type == 'json':
+            with self.open_file(save_file, 'wb') as f:
+                f.write(_json_serializer.encode(content))
+        else:
+            with self.open_file(save_file, 'w') as f:
                 f.write(content)
 
+    def load_json(self, json_file):
+        """
+        :return: content of the json file
+        """
+        with open(json_file, 'rb') as f:
+            return _json_serializer.decode(f.read())
+
     def debug_dump_to_file(self, dump_file, content, out_format=None):
         """
         Used for debugging only
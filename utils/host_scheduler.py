@@ -0,0 +1,205 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from utils.metrics import metrics, domain_label
+
+
+class HostScheduler:
+    """
+    Decides when a request to a host can go out
+    Each host has a token bucket (rate limit), a cap on requests in flight and its own
+    queue of waiting requests, ordered by lane so cheap requests go before big ones
+    """
+
+    # Lower goes first
+    LANES = {'json': 0,
+             'thumbnail': 0,
+             'image': 1,
+             'video': 2,
+             # Background retries of failed downloads
+             'retry': 3,
+             }
+
+    def __init__(self, rate=5.0, burst=10, concurrency=4, host_limits={}, max_hosts=10000):
+        """
+        :param rate: requests per second allowed to each host, 0 for no limit
+        :param burst: requests that can go out at once after the host has been idle
+        :param concurrency: max requests in flight to each host
+        :param host_limits: dict of host suffix -> (rate, burst, concurrency) to override the defaults
+        :param max_hosts: hosts to keep state for, past this idle hosts are forgotten (least recently used first)
+        """
+        self.default_limits = (rate, burst, concurrency)
+        self.host_limits = host_limits
+        self.max_hosts = max(1, max_hosts)
+
+        self._lock = threading.Lock()
+        # Least recently used first
+        self._hosts = OrderedDict()
+
+    def _get_host(self, url):
+        """
+        :return: _Host that requests to `url` go through
+        """
+        host = urlsplit(url).hostname or url
+        host = host.lower()
+
+        # Use the most specific configured suffix, i.imgur.com -> imgur.com
+        key = host
+        limits = self.default_limits
+        labels = host.split('.')
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:])
+            if suffix in self.host_limits:
+                key = suffix
+                limits = self.host_limits[suffix]
+                break
+
+        with self._lock:
+            host = self._hosts.get(key)
+            if host is not None:
+                self._hosts.move_to_end(key)
+                return host
+            host = _Host(*limits)
+            self._hosts[key] = host
+            if len(self._hosts) > self.max_hosts:
+                self._evict()
+            return host
+
+    def _evict(self):
+        """
+        Must hold self._lock
+        Forget idle hosts until there are `max_hosts` left, a forgotten host starts again with a full bucket
+        so only ones that already have one (and nothing in flight or waiting) can go
+        """
+        for key in list(self._hosts):
+            if len(self._hosts) <= self.max_hosts:
+                break
+            if self._hosts[key].is_idle():
+                del self._hosts[key]
+
+    @contextmanager
+    def slot(self, url, lane='image'):
+        """
+        Block until a request to the host of `url` can be made
+        Use as `with scheduler.slot(url, 'image'):`
+        """
+        host = self._get_host(url)
+        start = time.perf_counter()
+        host.acquire(self.LANES.get(lane, 1))
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='host_wait', domain=domain_label(url),
+                        extractor='')
+        try:
+            yield
+        finally:
+            host.release()
+
+    def try_acquire(self, url, lane='image'):
+        """
+        Non blocking version of `slot` for the async engine
+        If it worked `release` must be called once the request is done
+        :return: 0 if a slot was taken, else number of seconds to wait before trying again
+        """
+        return self._get_host(url).try_acquire(self.LANES.get(lane, 1))
+
+    def release(self, url):
+        self._get_host(url).release()
+
+    def stats(self):
+        """
+        :return: dict of host -> (in flight, waiting)
+        """
+        with self._lock:
+            hosts = list(self._hosts.items())
+        return {key: (host.active, len(host.waiting)) for key, host in hosts}
+
+
+class _Host:
+
+    # Seconds to wait before trying again when at the concurrency cap and there is no rate to go by
+    UNLIMITED_WAIT = 0.05
+
+    def __init__(self, rate, burst, concurrency):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.concurrency = concurrency
+
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        self.active = 0
+        # heap of (lane, ticket) waiting for a slot
+        self.waiting = []
+        self._ticket = itertools.count()
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def _take(self):
+        """
+        Must hold self._cond
+        :return: 0 if a slot was taken, else seconds until a token is ready, None if at the concurrency cap
+        """
+        if self.active >= self.concurrency:
+            return None
+        if self.rate <= 0:
+            # No rate limit, only the concurrency cap
+            self.active += 1
+            return 0
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.active += 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def _retry_wait(self):
+        if self.rate <= 0:
+            return self.UNLIMITED_WAIT
+        return 1 / self.rate
+
+    def acquire(self, lane):
+        with self._cond:
+            entry = (lane, next(self._ticket))
+            heapq.heappush(self.waiting, entry)
+            while True:
+                if self.waiting[0] == entry:
+                    wait = self._take()
+                    if wait == 0:
+                        heapq.heappop(self.waiting)
+                        # Let the next one in line check
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def try_acquire(self, lane):
+        with self._cond:
+            # Do not jump ahead of someone waiting in a more important lane
+            if self.waiting and self.waiting[0][0] <= lane:
+                return self._retry_wait()
+            wait = self._take()
+            if wait is None:
+                return self._retry_wait()
+            return wait
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def is_idle(self):
+        """
+        :return: `True` if nothing is using the host and its bucket is full, so forgetting it changes nothing
+        """
+        with self._cond:
+            self._refill()
+            return self.active == 0 and len(self.waiting) == 0 and (self.rate <= 0 or self.tokens >= self.burst)
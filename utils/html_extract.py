@@ -0,0 +1,183 @@
+"""
+Pull the few links each extractor needs out of a page, without building the whole DOM
+The tags are found with one compiled pattern. If that finds nothing (the site changed, or the page is odd)
+and beautifulsoup4 is installed, the page is parsed again with a SoupStrainer so only those tags are built
+"""
+import re
+import html
+
+try:
+    # Optional, only used when the fast path finds nothing
+    from bs4 import BeautifulSoup, SoupStrainer
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    # Optional, a lot faster then html.parser
+    import lxml
+    SOUP_PARSER = 'lxml'
+except ImportError:
+    SOUP_PARSER = 'html.parser'
+
+# Attribute in a tag: name, name=value, name="value" or name='value'
+ATTR_PATTERN = re.compile(r'''([^\s"'<>/=]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'=<>`]+)))?''')
+
+# Compiled tag patterns, by the tags they look for
+_tag_patterns = {}
+
+
+def _tag_pattern(tags):
+    pattern = _tag_patterns.get(tags)
+    if pattern is None:
+        # Comments and scripts come first so tags inside of them are skipped over
+        pattern = re.compile(r'<!--.*?-->|<script\b.*?</script\s*>|'
+                             r'<(/?)(' + '|'.join(tags) + r''')\b((?:"[^"]*"|'[^']*'|[^'">])*)>''',
+                             re.IGNORECASE | re.DOTALL)
+        _tag_patterns[tags] = pattern
+    return pattern
+
+
+def parse_attrs(attr_text):
+    """
+    :return: dict of the attributes in a tag, names lower case and values unescaped like a parser would
+    """
+    attrs = {}
+    for match in ATTR_PATTERN.finditer(attr_text):
+        value = match.group(2)
+        if value is None:
+            value = match.group(3)
+        if value is None:
+            value = match.group(4)
+        # The first one wins if it is there twice
+        attrs.setdefault(match.group(1).lower(), html.unescape(value) if value else '')
+    return attrs
+
+
+def iter_tags(page, tags):
+    """
+    :param tags: tuple of lower case tag names to look for
+    :return: generator of (tag, attrs, is_end) for each of `tags` in `page`, in order
+    """
+    for match in _tag_pattern(tags).finditer(page):
+        tag = match.group(2)
+        if tag is None:
+            # Comment or script
+            continue
+        if match.group(1):
+            yield tag.lower(), {}, True
+        else:
+            yield tag.lower(), parse_attrs(match.group(3)), False
+
+
+def has_class(attrs, name):
+    return name in attrs.get('class', '').split()
+
+
+##########
+# Fast path
+##########
+def imgur_files(page):
+    """
+    :return: list of the src of the first img, or else mp4 source, in each div.image
+    """
+    files = []
+    depth = 0  # divs open in the div.image we are in, 0 when not in one
+    image = None
+    video = None
+    for tag, attrs, is_end in iter_tags(page, ('div', 'img', 'source')):
+        if tag == 'div':
+            if depth == 0:
+                if not is_end and has_class(attrs, 'image'):
+                    depth = 1
+                    image = None
+                    video = None
+                continue
+            depth += -1 if is_end else 1
+            if depth == 0 and (image or video):
+                files.append(image or video)
+        elif depth > 0 and not is_end:
+            if tag == 'img' and image is None:
+                image = attrs.get('src')
+            elif tag == 'source' and video is None and attrs.get('type') == 'video/mp4':
+                video = attrs.get('src')
+
+    # Page ended before the div did
+    if depth > 0 and (image or video):
+        files.append(image or video)
+    return files
+
+
+def vidble_images(page):
+    """
+    :return: list of the src (or data-original when it is lazy loaded) of each img.img2
+    """
+    images = []
+    for tag, attrs, is_end in iter_tags(page, ('img',)):
+        if has_class(attrs, 'img2'):
+            image = attrs.get('src') or attrs.get('data-original')
+            if image:
+                images.append(image)
+    return images
+
+
+def pornbot_links(page):
+    """
+    :return: list of the href of each a[target=_new]
+    """
+    links = []
+    for tag, attrs, is_end in iter_tags(page, ('a',)):
+        if not is_end and attrs.get('target') == '_new' and attrs.get('href'):
+            links.append(attrs['href'])
+    return links
+
+
+##########
+# BeautifulSoup, only building the tags we need
+##########
+def _soup(page, *args, **kwargs):
+    return BeautifulSoup(page, SOUP_PARSER, parse_only=SoupStrainer(*args, **kwargs))
+
+
+def imgur_files_soup(page):
+    files = []
+    for content in _soup(page, 'div', {'class': 'image'}).find_all('div', {'class': 'image'}):
+        image = content.find('img')
+        if image is not None and image.get('src'):
+            files.append(image['src'])
+            continue
+        video = content.find('source', {'type': 'video/mp4'})
+        if video is not None and video.get('src'):
+            files.append(video['src'])
+    return files
+
+
+def vidble_images_soup(page):
+    images = []
+    for content in _soup(page, 'img', {'class': 'img2'}).find_all('img'):
+        image = content.get('src') or content.get('data-original')
+        if image:
+            images.append(image)
+    return images
+
+
+def pornbot_links_soup(page):
+    return [content['href'] for content in _soup(page, 'a', {'target': '_new'}).find_all('a') if content.get('href')]
+
+
+# extractor: (fast path, soup)
+EXTRACTORS = {'imgur': (imgur_files, imgur_files_soup),
+              'vidble': (vidble_images, vidble_images_soup),
+              'pornbot': (pornbot_links, pornbot_links_soup),
+              }
+
+
+def extract(extractor, page):
+    """
+    :param extractor: `imgur`, `vidble` or `pornbot`
+    :return: list of the links `extractor` wants from `page`
+    """
+    fast, soup = EXTRACTORS[extractor]
+    found = fast(page)
+    if len(found) == 0 and BeautifulSoup is not None:
+        found = soup(page)
+    return found
@@ -0,0 +1,83 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from utils.general_utils import GeneralUtils
+
+
+class HttpClient(GeneralUtils):
+    """
+    One requests session shared by every extractor and worker thread
+    Connections are kept alive and pooled per host so each fetch does not need a new handshake
+    """
+
+    def __init__(self, logger_name, connect_timeout=10, read_timeout=60, retries=3, backoff=0.5,
+                 pool_hosts=100, pool_size=10, stats_interval=1000):
+        super().__init__(logger_name)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=retries,
+                      status=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        # pool_hosts: number of hosts to keep connections open for
+        # pool_size: max connections kept open per host, should be >= the number of threads
+        adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._adapter = adapter
+
+        # Log the pool stats every n requests
+        self.stats_interval = stats_interval
+        self._stats_lock = threading.Lock()
+        self._num_requests = 0
+        self._num_errors = 0
+
+    def get(self, url, headers={}, stream=False):
+        """
+        :return: requests response, raises requests exceptions like `requests.get`
+        """
+        with self._stats_lock:
+            self._num_requests += 1
+            log_stats = self.stats_interval > 0 and self._num_requests % self.stats_interval == 0
+        if log_stats:
+            self.log("HTTP pool stats: " + str(self.stats()), level='info')
+
+        try:
+            return self.session.get(url, headers=headers, stream=stream,
+                                    timeout=(self.connect_timeout, self.read_timeout))
+        except requests.exceptions.RequestException:
+            with self._stats_lock:
+                self._num_errors += 1
+            raise
+
+    def stats(self):
+        """
+        :return: dict of request counts and open connections per host
+        """
+        hosts = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hosts[pool.host] = {'connections': pool.num_connections,
+                                'requests': pool.num_requests,
+                                'idle': pool.pool.qsize() if pool.pool is not None else 0,
+                                }
+
+        return {'requests': self._num_requests,
+                'errors': self._num_errors,
+                'pools': len(hosts),
+                'hosts': hosts,
+                }
+
+    def close(self):
+        self.session.close()
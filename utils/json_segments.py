@@ -0,0 +1,370 @@
+import os
+import gzip
+import time
+import threading
+import traceback
+from queue import Queue
+from collections import OrderedDict
+from utils.general_utils import GeneralUtils
+from utils.json_serializer import JsonSerializer
+
+try:
+    # Optional, smaller and faster then gzip
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# File extension used for each compression
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+# Bytes of json lines compressed together, only this much needs to be read to get one post
+BLOCK_SIZE = 1024 * 1024
+
+
+def get_compression(segment_file):
+    """
+    :return: compression used by `segment_file`, from its extension
+    """
+    for compression, ext in EXTENSIONS.items():
+        if ext and segment_file.endswith(ext):
+            return compression
+    return 'none'
+
+
+def compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    elif compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class SegmentWriter(GeneralUtils):
+    """
+    Appends posts as compact json lines to hourly segment files
+        <base_dir>/segments/<subreddit or _all>/<year>/<month>/<day>/<hour><name_suffix>.jsonl.part
+    Each shard process has its own `name_suffix`, so only one process ever writes to a segment
+    When the hour is over the segment is compressed in blocks to <hour>.jsonl.gz (or .zst) and
+    a sidecar <hour>.jsonl.gz.idx is written with a line for each post: id, block offset, block size, line offset
+    """
+
+    def __init__(self, base_dir, logger_name, per_subreddit=False, compression='gzip', max_open=256, serializer=None,
+                 name_suffix=''):
+        super().__init__(logger_name)
+        self.base_dir = base_dir
+        self.per_subreddit = per_subreddit
+        self.name_suffix = name_suffix
+        # One post per line, so it must not be pretty printed
+        if serializer is None:
+            serializer = JsonSerializer(pretty=False, sort_keys=False, ensure_ascii=False)
+        self.serializer = serializer
+
+        if compression == 'zstd' and zstandard is None:
+            self.log("zstandard is not installed, using gzip for json segments", level='warning')
+            compression = 'gzip'
+        if compression not in EXTENSIONS:
+            compression = 'gzip'
+        self.compression = compression
+
+        # Open segments, oldest used first. Only `max_open` are kept open at once
+        self.max_open = max(1, max_open)
+        self._open = OrderedDict()
+        self._hour = None
+        # Every segment written to this hour, open or not, they all need rolling when the hour is over
+        self._hour_parts = set()
+        self._lock = threading.Lock()
+
+        # Segments waiting to be compressed, done in their own thread so saving posts is not held up
+        self._roll_q = Queue()
+        roller = threading.Thread(target=self._roller, name="json_segment_roller")
+        roller.setDaemon(True)
+        roller.start()
+
+        self._recover()
+
+    def write(self, post):
+        """
+        Append `post` to its segment
+        :return: path the segment will have once it is compressed
+        """
+        line = self.serializer.encode(post) + b"\n"
+
+        with self._lock:
+            hour = self._hour_key(time.time())
+            if hour != self._hour:
+                # New hour, all of the segments from the last one are done
+                for part_file in self._hour_parts:
+                    self._close_part(part_file)
+                    self._roll_q.put(part_file)
+                self._hour_parts = set()
+                self._hour = hour
+
+            segment = self._segment_base(post['subreddit'], hour)
+            self._hour_parts.add(segment + ".part")
+            f = self._get_fh(segment + ".part")
+            f.write(line)
+            f.flush()
+
+        return segment + EXTENSIONS[self.compression]
+
+    def close(self):
+        """
+        Close the open segments and wait for any being compressed
+        Segments for the current hour are left as .part so the next run can keep adding to them
+        """
+        with self._lock:
+            for part_file in list(self._open):
+                self._close_part(part_file)
+        self._roll_q.put(None)
+        self._roll_q.join()
+
+    def _hour_key(self, timestamp):
+        created = self.get_datetime(timestamp)
+        return (str(created.year), str(created.month), str(created.day), str(created.hour).zfill(2))
+
+    def _segment_base(self, subreddit, hour):
+        name = '_all'
+        if self.per_subreddit:
+            name = subreddit
+            # Make sure the subreddit cannot create the folder `con` (Windows bug)
+            if name in self.bad_folders:
+                name = name + "_r_" + name
+        y, m, d, h = hour
+        return self.create_base_path('segments', name, y, m, d, h + self.name_suffix + ".jsonl")
+
+    def _get_fh(self, part_file):
+        f = self._open.get(part_file)
+        if f is not None:
+            self._open.move_to_end(part_file)
+            return f
+
+        if len(self._open) >= self.max_open:
+            # Close the one used longest ago, it can be opened again if needed
+            self._close_part(next(iter(self._open)))
+        f = self.open_file(part_file, 'ab')
+        self._open[part_file] = f
+        return f
+
+    def _close_part(self, part_file):
+        f = self._open.pop(part_file, None)
+        if f is not None:
+            f.close()
+
+    def _recover(self):
+        """
+        Compress any segments a previous run did not finish, ones from this hour are rolled when it is over
+        """
+        current = self._hour_key(time.time())
+        current_name = current[3] + self.name_suffix + ".jsonl.part"
+        with self._lock:
+            # Set the hour now, so write() knows these belong to it
+            if self._hour is None:
+                self._hour = current
+        for root, dirs, files in os.walk(os.path.join(self.base_dir, 'segments')):
+            for name in files:
+                # Segments of other shards are theirs to finish
+                if name.split('.')[0][2:] != self.name_suffix:
+                    continue
+                part_file = os.path.join(root, name)
+                if name.endswith(".jsonl.rolling"):
+                    # Was being compressed when we stopped
+                    self._roll_q.put(part_file)
+                    continue
+                if not name.endswith(".jsonl.part"):
+                    continue
+                # Still being written to this hour, roll it with the rest when the hour is over
+                if name == current_name and root.endswith(os.path.join(*current[0:3])):
+                    with self._lock:
+                        if self._hour == current:
+                            self._hour_parts.add(part_file)
+                            continue
+                self._roll_q.put(part_file)
+
+    def _roller(self):
+        while True:
+            part_file = self._roll_q.get()
+            try:
+                if part_file is not None:
+                    # Move it out of the way first, anything written to this segment after
+                    # this goes to a new .part file instead of one we are about to remove
+                    with self._lock:
+                        self._close_part(part_file)
+                        rolling_file = part_file
+                        if part_file.endswith(".part") and os.path.isfile(part_file):
+                            rolling_file = part_file[:-len(".part")] + ".rolling"
+                            os.replace(part_file, rolling_file)
+                    self._roll(rolling_file)
+            except Exception as e:
+                self.log("Exception rolling json segment " + part_file + ": " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+            self._roll_q.task_done()
+            if part_file is None:
+                return
+
+    def _roll(self, rolling_file):
+        """
+        Compress `rolling_file` a block at a time and write its index
+        """
+        if not os.path.isfile(rolling_file):
+            return
+        segment_file = rolling_file[:-len(".rolling")] + EXTENSIONS[self.compression]
+        index_file = segment_file + ".idx"
+
+        # Written to temp files and moved over, so a roll that gets stopped part way can just be done again
+        with open(rolling_file, 'rb') as part, open(segment_file + ".tmp", 'wb') as out, \
+                open(index_file + ".tmp", 'w') as index:
+            block_offset = 0
+            while True:
+                block = []
+                block_ids = []
+                block_len = 0
+                for line in part:
+                    if not line.endswith(b"\n"):
+                        # Partial line left by a crash
+                        break
+                    block_ids.append((self.serializer.decode(line)['id'], block_len))
+                    block.append(line)
+                    block_len += len(line)
+                    if block_len >= BLOCK_SIZE:
+                        break
+                if len(block) == 0:
+                    break
+
+                data = b''.join(block)
+                if self.compression == 'none':
+                    # Not compressed, so each line can be read on its own
+                    for i, (post_id, line_offset) in enumerate(block_ids):
+                        index.write(post_id + "\t" + str(block_offset + line_offset) + "\t" + str(len(block[i])) + "\t0\n")
+                else:
+                    data = compress(data, self.compression)
+                    for post_id, line_offset in block_ids:
+                        index.write(post_id + "\t" + str(block_offset) + "\t" + str(len(data)) + "\t" + str(line_offset) + "\n")
+                out.write(data)
+                block_offset += len(data)
+            out.flush()
+            os.fsync(out.fileno())
+
+        os.replace(index_file + ".tmp", index_file)
+        os.replace(segment_file + ".tmp", segment_file)
+        os.remove(rolling_file)
+        self.log("Rolled json segment: " + segment_file, level='debug')
+
+
+class SegmentReader:
+    """
+    Read posts back out of json segments, rolled or still being written to
+    """
+
+    def __init__(self, serializer=None):
+        if serializer is None:
+            serializer = JsonSerializer(pretty=False, sort_keys=False, ensure_ascii=False)
+        self.serializer = serializer
+
+    def _files(self, segment_file):
+        """
+        :return: list of files that make up `segment_file`, it may not have been rolled yet
+        """
+        # Any of <hour>.jsonl[.gz|.zst|.rolling|.part] can be passed in, find all of them
+        base = segment_file
+        for suffix in [".part", ".rolling", EXTENSIONS['gzip'], EXTENSIONS['zstd']]:
+            if base.endswith(suffix):
+                base = base[:-len(suffix)]
+                break
+
+        files = []
+        for suffix in [EXTENSIONS['gzip'], EXTENSIONS['zstd'], EXTENSIONS['none'], ".rolling", ".part"]:
+            if os.path.isfile(base + suffix):
+                files.append(base + suffix)
+        if len(files) == 0:
+            raise FileNotFoundError(segment_file)
+        return files
+
+    def iter_posts(self, segment_file):
+        """
+        :return: generator of every post in the segment, in the order they were saved
+        """
+        for path in self._files(segment_file):
+            if not self._is_rolled(path) or get_compression(path) == 'none':
+                with open(path, 'rb') as f:
+                    for line in f:
+                        if line.endswith(b"\n"):
+                            yield self.serializer.decode(line)
+                continue
+
+            compression = get_compression(path)
+            with open(path, 'rb') as f:
+                for block_offset, block_size in self._blocks(path):
+                    f.seek(block_offset)
+                    for line in decompress(f.read(block_size), compression).splitlines():
+                        yield self.serializer.decode(line)
+
+    def get(self, segment_file, post_id):
+        """
+        :return: post dict for `post_id`, None if it is not in the segment
+        """
+        for path in self._files(segment_file):
+            if self._is_rolled(path):
+                post = self._get_indexed(path, post_id)
+            else:
+                post = self._get_unindexed(path, post_id)
+            if post is not None:
+                return post
+        return None
+
+    def _get_indexed(self, segment_file, post_id):
+        entry = self._index_entry(segment_file, post_id)
+        if entry is None:
+            return None
+        block_offset, block_size, line_offset = entry
+        with open(segment_file, 'rb') as f:
+            f.seek(block_offset)
+            block = decompress(f.read(block_size), get_compression(segment_file))
+        line_end = block.index(b"\n", line_offset)
+        return self.serializer.decode(block[line_offset:line_end])
+
+    def _get_unindexed(self, segment_file, post_id):
+        # Not indexed yet, look through it
+        match = ('"id":"' + post_id + '"').encode('utf-8')
+        with open(segment_file, 'rb') as f:
+            for line in f:
+                if match in line and line.endswith(b"\n"):
+                    post = self.serializer.decode(line)
+                    if post['id'] == post_id:
+                        return post
+        return None
+
+    def _is_rolled(self, segment_file):
+        return not segment_file.endswith(".part") and not segment_file.endswith(".rolling")
+
+    def _index(self, segment_file):
+        """
+        :return: generator of (post id, block offset, block size, line offset) from the sidecar index
+        """
+        with open(segment_file + ".idx", 'r') as f:
+            for line in f:
+                post_id, block_offset, block_size, line_offset = line.rstrip("\n").split("\t")
+                yield post_id, int(block_offset), int(block_size), int(line_offset)
+
+    def _index_entry(self, segment_file, post_id):
+        for entry in self._index(segment_file):
+            if entry[0] == post_id:
+                return entry[1:]
+        return None
+
+    def _blocks(self, segment_file):
+        """
+        :return: list of (offset, size) of each compressed block, in order
+        """
+        blocks = []
+        for post_id, block_offset, block_size, line_offset in self._index(segment_file):
+            if len(blocks) == 0 or blocks[-1][0] != block_offset:
+                blocks.append((block_offset, block_size))
+        return blocks
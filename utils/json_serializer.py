@@ -0,0 +1,77 @@
+import json
+
+try:
+    # Optional, many times faster then the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # Optional, faster then the json module
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonSerializer:
+    """
+    Turns post dicts into json bytes and back using the fastest library installed
+    The fast libraries are only used for compact utf-8 output, the rest is written by the json module
+    so a file comes out the same whatever is installed. Anything they can not handle falls back to it too
+    """
+
+    def __init__(self, library='auto', pretty=True, sort_keys=True, ensure_ascii=True):
+        """
+        :param library: `auto`, `orjson`, `ujson` or `json`, if the one asked for is not installed `json` is used
+        :param pretty: indent the output by 4 spaces
+        :param sort_keys: sort the keys so the same post always gives the same file
+        :param ensure_ascii: escape anything that is not ascii, like json.dump always has
+        """
+        if library == 'auto':
+            library = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+        if (library == 'orjson' and orjson is None) or (library == 'ujson' and ujson is None) or \
+           library not in ['orjson', 'ujson']:
+            library = 'json'
+        self.library = library
+        self.pretty = pretty
+        self.sort_keys = sort_keys
+        self.ensure_ascii = ensure_ascii
+        # orjson can not indent by 4 or escape to ascii, and ujson does both a little differently then json
+        self._use_fast = not pretty and not ensure_ascii
+
+        self._orjson_option = 0
+        if orjson is not None and sort_keys:
+            self._orjson_option |= orjson.OPT_SORT_KEYS
+
+    def encode(self, content):
+        """
+        :return: `content` as utf-8 json bytes
+        """
+        try:
+            if self._use_fast and self.library == 'orjson':
+                return orjson.dumps(content, option=self._orjson_option)
+            elif self._use_fast and self.library == 'ujson':
+                return ujson.dumps(content, sort_keys=self.sort_keys, ensure_ascii=False,
+                                   escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, ValueError, OverflowError):
+            # Something the fast library does not support, like an int bigger then 64 bits
+            pass
+
+        if self.pretty:
+            data = json.dumps(content, sort_keys=self.sort_keys, indent=4, ensure_ascii=self.ensure_ascii)
+        else:
+            data = json.dumps(content, sort_keys=self.sort_keys, separators=(',', ':'), ensure_ascii=self.ensure_ascii)
+        return data.encode('utf-8')
+
+    def decode(self, data):
+        """
+        :param data: json as bytes or str
+        :return: decoded content
+        """
+        if self.library == 'orjson':
+            return orjson.loads(data)
+        elif self.library == 'ujson':
+            return ujson.loads(data)
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return json.loads(data)
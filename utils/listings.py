@@ -0,0 +1,116 @@
+import os
+import threading
+import traceback
+from utils.general_utils import GeneralUtils
+from utils.json_serializer import JsonSerializer
+from utils.metrics import metrics
+
+
+class ListingWriter(GeneralUtils):
+    """
+    Keeps a sorted, paged list of the posts in each year/month/day dir for the csv_viewer
+        listing.json    newest posts (up to `page_size`) plus how many pages there are
+        listing-<n>.json  older pages of `page_size` posts, listing-1.json is the oldest
+    Posts are buffered and merged in every `flush_interval` seconds, so a dir is only
+    rewritten once for all of the posts added to it in that time
+    """
+
+    def __init__(self, logger_name, page_size=100, flush_interval=10, stripes=64):
+        super().__init__(logger_name)
+        self.page_size = max(1, page_size)
+        self.flush_interval = flush_interval
+        self.serializer = JsonSerializer(pretty=False, sort_keys=False, ensure_ascii=False)
+
+        # Each stripe has its own lock and its own dict of listing dir -> posts waiting
+        self._locks = [threading.Lock() for i in range(max(1, stripes))]
+        self._buffers = [{} for i in range(len(self._locks))]
+        self._flush_lock = threading.Lock()
+
+        self._closed = threading.Event()
+        flusher = threading.Thread(target=self._flusher, name="listing_flusher")
+        flusher.setDaemon(True)
+        flusher.start()
+
+    def listing_entry(self, post):
+        """
+        :return: the fields of `post` the viewer needs
+        """
+        thumbnail = ''
+        # Only link to thumbnails we have a copy of
+        if post.get('thumbnail', '').startswith('/'):
+            thumbnail = post['thumbnail']
+        return {'title': post['title'],
+                'thumbnail': thumbnail,
+                'created_utc': post['created_utc'],
+                'path': post['post_web_path'],
+                }
+
+    def add(self, listing_dir, entry):
+        """
+        Queue `entry` to be added to the listing in `listing_dir`
+        """
+        stripe = hash(listing_dir) % len(self._locks)
+        with self._locks[stripe]:
+            self._buffers[stripe].setdefault(listing_dir, []).append(entry)
+
+    def flush(self):
+        """
+        Merge everything that is waiting into the listings
+        """
+        # Only one flush at a time, so a listing is never merged by two threads at once
+        with self._flush_lock:
+            for stripe in range(len(self._locks)):
+                # Take the posts waiting, so adding more is not held up while we write
+                with self._locks[stripe]:
+                    buffer = self._buffers[stripe]
+                    self._buffers[stripe] = {}
+                for listing_dir, entries in buffer.items():
+                    try:
+                        with metrics.timer('stage_seconds', stage='listing_write', domain='', extractor=''), \
+                                self.process_lock(listing_dir):
+                            self._merge(listing_dir, entries)
+                    except Exception as e:
+                        self.log("Exception updating listing " + listing_dir + ": " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+    def _merge(self, listing_dir, entries):
+        """
+        Must hold self._flush_lock, and the process lock for `listing_dir` when running as a shard
+        """
+        listing_file = os.path.join(listing_dir, 'listing.json')
+        try:
+            listing = self.load_json(listing_file)
+        except FileNotFoundError:
+            listing = {'page_size': self.page_size, 'pages': 0, 'count': 0, 'posts': []}
+
+        # Newest first
+        posts = listing['posts'] + entries
+        posts.sort(key=lambda entry: entry['created_utc'], reverse=True)
+
+        # Move the oldest posts out into their own pages, they never change after this
+        while len(posts) > listing['page_size']:
+            listing['pages'] += 1
+            page = posts[-listing['page_size']:]
+            posts = posts[:-listing['page_size']]
+            self._write(os.path.join(listing_dir, 'listing-' + str(listing['pages']) + '.json'),
+                        {'page': listing['pages'], 'posts': page})
+
+        listing['posts'] = posts
+        listing['count'] += len(entries)
+        self._write(listing_file, listing)
+
+    def _write(self, save_file, content):
+        """
+        Write to a temp file then move it over, so the viewer never gets half a file
+        """
+        temp_file = save_file + '.tmp'
+        with self.open_file(temp_file, 'wb') as f:
+            f.write(self.serializer.encode(content))
+        os.replace(temp_file, save_file)
+
+    def _flusher(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+
+class LruSet:
+    """
+    Thread safe set that forgets the least recently used keys once it has `maxsize` of them
+    Counts hits and misses so we can see how much it saves
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = max(1, maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def has(self, key):
+        """
+        :return: `True` if `key` is in the set
+        """
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._keys[key] = True
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def stats(self):
+        """
+        :return: dict of keys held, hits and misses
+        """
+        with self._lock:
+            return {'size': len(self._keys),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    }
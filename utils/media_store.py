@@ -0,0 +1,208 @@
+import os
+import uuid
+import shutil
+from utils.sqlite_db import SqliteDb
+from utils.general_utils import GeneralUtils
+
+
+class MediaStore(GeneralUtils):
+    """
+    Keeps a single copy of every file under <save_path>/files/<h0:2>/<h2:4>/<hash>.<ext>
+    Users files are hardlinks into the store, the index keeps a count of how many
+    user paths point at each file so it is only removed when nothing uses it
+    """
+
+    def __init__(self, base_dir, logger_name):
+        super().__init__(logger_name)
+        self.base_dir = base_dir
+        self.store_path = self.create_save_path("files")
+        self.index = SqliteDb(os.path.join(self.store_path, "index.sqlite"), schema=(
+            '''CREATE TABLE IF NOT EXISTS blobs (
+                 hash TEXT NOT NULL,
+                 ext TEXT NOT NULL,
+                 size INTEGER NOT NULL,
+                 refs INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (hash, ext))''',
+            '''CREATE TABLE IF NOT EXISTS refs (
+                 path TEXT PRIMARY KEY,
+                 hash TEXT NOT NULL,
+                 ext TEXT NOT NULL)''',
+            '''CREATE TABLE IF NOT EXISTS migrated (
+                 user_path TEXT PRIMARY KEY)''',
+        ))
+
+    def blob_path(self, file_hash, file_ext):
+        """
+        :return: Full path of the file in the store
+        """
+        return os.path.join(self.store_path, file_hash[0:2], file_hash[2:4], file_hash + "." + file_ext)
+
+    def add(self, source, file_hash, file_ext):
+        """
+        Move `source` into the store, if we already have it `source` is removed
+        :return: Full path of the file in the store
+        """
+        blob_file = self.blob_path(file_hash, file_ext)
+        size = os.path.getsize(source)
+        with self.index.db() as db:
+            cur = db.execute('INSERT OR IGNORE INTO blobs (hash, ext, size) VALUES (?, ?, ?)',
+                             (file_hash, file_ext, size))
+            is_new = cur.rowcount == 1 or not os.path.isfile(blob_file)
+
+        if is_new:
+            try:
+                os.replace(source, self.create_path(blob_file))
+            except OSError:
+                shutil.move(source, blob_file)
+        else:
+            self.log("Already in store [media_store]: " + blob_file, level='debug')
+            os.remove(source)
+
+        return blob_file
+
+    def link(self, file_hash, file_ext, user_file):
+        """
+        Point `user_file` at the file in the store
+        Uses a hardlink, if the filesystem does not support that the index entry is
+        all that is kept and the store path is returned instead
+        :return: Path the file can be found at
+        """
+        blob_file = self.blob_path(file_hash, file_ext)
+        return_path = user_file
+
+        if not self._same_file(blob_file, user_file):
+            # Link next to it and move that over, so if linking fails the file that was there is left alone
+            temp_file = user_file + "." + str(uuid.uuid4()) + ".link"
+            try:
+                os.link(blob_file, self.create_path(temp_file))
+                os.replace(temp_file, user_file)
+            except OSError as e:
+                self.log("Could not hardlink [media_store]: " + str(e) + " " + user_file, level='warning')
+                if os.path.lexists(temp_file):
+                    os.remove(temp_file)
+                return_path = blob_file
+
+        self._add_ref(user_file, file_hash, file_ext)
+        return return_path
+
+    def unlink(self, user_file):
+        """
+        Remove `user_file` and drop its reference, the stored file is removed once nothing uses it
+        :return: Number of bytes freed in the store
+        """
+        freed_bytes = 0
+        with self.index.db() as db:
+            row = db.execute('SELECT hash, ext FROM refs WHERE path = ?', (user_file,)).fetchone()
+            if row is None:
+                return freed_bytes
+            db.execute('DELETE FROM refs WHERE path = ?', (user_file,))
+            db.execute('UPDATE blobs SET refs = refs - 1 WHERE hash = ? AND ext = ?', row)
+            refs = db.execute('SELECT refs FROM blobs WHERE hash = ? AND ext = ?', row).fetchone()[0]
+            if refs <= 0:
+                db.execute('DELETE FROM blobs WHERE hash = ? AND ext = ?', row)
+
+        if os.path.lexists(user_file):
+            os.remove(user_file)
+        if refs <= 0:
+            blob_file = self.blob_path(*row)
+            if os.path.isfile(blob_file):
+                freed_bytes = os.path.getsize(blob_file)
+                os.remove(blob_file)
+        return freed_bytes
+
+    def prune(self):
+        """
+        Drop the references of user files that have been removed (a user dir deleted by hand),
+        and remove stored files nothing uses any more
+        Only run when nothing else is saving to the store, a file added but not linked yet has no references
+        :return: (references dropped, bytes freed)
+        """
+        dropped = 0
+        freed_bytes = 0
+        paths = [row[0] for row in self.index.db().execute('SELECT path FROM refs')]
+        for user_file in paths:
+            if not os.path.lexists(user_file):
+                freed_bytes += self.unlink(user_file)
+                dropped += 1
+
+        # Added to the store but never linked to a user
+        with self.index.db() as db:
+            rows = db.execute('SELECT hash, ext FROM blobs WHERE refs <= 0').fetchall()
+            db.execute('DELETE FROM blobs WHERE refs <= 0')
+        for file_hash, file_ext in rows:
+            blob_file = self.blob_path(file_hash, file_ext)
+            if os.path.isfile(blob_file):
+                freed_bytes += os.path.getsize(blob_file)
+                os.remove(blob_file)
+
+        return dropped, freed_bytes
+
+    def _add_ref(self, user_file, file_hash, file_ext):
+        with self.index.db() as db:
+            cur = db.execute('INSERT OR IGNORE INTO refs (path, hash, ext) VALUES (?, ?, ?)',
+                             (user_file, file_hash, file_ext))
+            if cur.rowcount == 1:
+                db.execute('UPDATE blobs SET refs = refs + 1 WHERE hash = ? AND ext = ?', (file_hash, file_ext))
+
+    def _same_file(self, file_a, file_b):
+        try:
+            return os.path.samefile(file_a, file_b)
+        except OSError:
+            return False
+
+    ##########
+    # Migration
+    ##########
+    def is_migrated(self, user_path):
+        """
+        :return: `True` if the users files have already been moved into the store
+        """
+        row = self.index.db().execute('SELECT 1 FROM migrated WHERE user_path = ?', (user_path,)).fetchone()
+        return row is not None
+
+    def migrate_user(self, user_path):
+        """
+        Move every file in the users `files` dir into the store and replace it with a hardlink
+        Safe to run again on the same user if it was stopped part way
+        :return: Number of bytes saved by removing duplicates
+        """
+        saved_bytes = 0
+        user_files_path = os.path.join(user_path, "files")
+        for root, dirs, files in os.walk(user_files_path):
+            for file_name in files:
+                user_file = os.path.join(root, file_name)
+                file_hash, _, file_ext = file_name.partition('.')
+                # Files are already named by their sha256, skip links left by a link() that was stopped part way
+                if len(file_hash) != 64 or file_ext == '' or file_ext.endswith('.link'):
+                    continue
+
+                blob_file = self.blob_path(file_hash, file_ext)
+                if self._same_file(blob_file, user_file):
+                    self._add_ref(user_file, file_hash, file_ext)
+                    continue
+
+                if os.path.isfile(blob_file):
+                    saved_bytes += os.path.getsize(user_file)
+                    self.link(file_hash, file_ext, user_file)
+                else:
+                    # First time we have seen this file, link it into the store without copying
+                    size = os.path.getsize(user_file)
+                    try:
+                        os.link(user_file, self.create_path(blob_file))
+                    except FileExistsError:
+                        # Something else stored the same file since we looked, use theirs
+                        saved_bytes += size
+                        self.link(file_hash, file_ext, user_file)
+                        continue
+                    with self.index.db() as db:
+                        db.execute('INSERT OR IGNORE INTO blobs (hash, ext, size) VALUES (?, ?, ?)',
+                                   (file_hash, file_ext, size))
+                    self._add_ref(user_file, file_hash, file_ext)
+
+        with self.index.db() as db:
+            db.execute('INSERT OR IGNORE INTO migrated (user_path) VALUES (?)', (user_path,))
+
+        return saved_bytes
+
+    def close(self):
+        self.index.close()
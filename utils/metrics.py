@@ -0,0 +1,266 @@
+import os
+import time
+import bisect
+import threading
+import traceback
+from urllib.parse import urlsplit
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from utils.general_utils import GeneralUtils
+
+# Every metric name starts with this
+PREFIX = 'reddit_archive_'
+
+# Upper bounds (seconds) of the histogram buckets, from a local file write up to a slow video
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Label sets kept per metric, anything past this is counted under domain="other"
+MAX_SERIES = 2000
+
+
+def domain_label(url):
+    """
+    :return: domain to label `url` with, i.imgur.com -> imgur.com, so each host does not get its own series
+    """
+    host = (urlsplit(url).hostname or '').lower()
+    parts = host.split('.')
+    if len(parts) > 2:
+        host = '.'.join(parts[-2:])
+    return host
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(name + '="' + _escape(value) + '"' for name, value in labels) + '}'
+
+
+class _Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Counters and latency histograms, labelled by things like stage, domain and extractor
+    Rendered in the Prometheus text format. Stats other parts keep themselves (queue sizes, pool stats, ...)
+    are added as gauges with add_collector(), so they are only read when the metrics are
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+        self._collectors = []
+
+    def _key(self, series, name, labels):
+        """
+        Must hold self._lock
+        :return: key for the series, with domain set to `other` once the metric has too many
+        """
+        key = tuple(sorted(labels.items()))
+        metric = series.setdefault(name, {})
+        if key not in metric and len(metric) >= MAX_SERIES and 'domain' in labels:
+            labels = dict(labels, domain='other')
+            key = tuple(sorted(labels.items()))
+        return key
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add `value` to the counter `name`
+        """
+        with self._lock:
+            key = self._key(self._counters, name, labels)
+            metric = self._counters[name]
+            metric[key] = metric.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a time to the histogram `name`
+        """
+        with self._lock:
+            key = self._key(self._histograms, name, labels)
+            metric = self._histograms[name]
+            histogram = metric.get(key)
+            if histogram is None:
+                histogram = metric[key] = _Histogram()
+            histogram.observe(seconds)
+
+    def timer(self, name, **labels):
+        """
+        with metrics.timer('stage_seconds', stage='download'):
+        """
+        return _Timer(self, name, labels)
+
+    def add_collector(self, collector):
+        """
+        :param collector: called each time the metrics are rendered, returns a list of (name, labels dict, value)
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def remove_collector(self, collector):
+        with self._lock:
+            if collector in self._collectors:
+                self._collectors.remove(collector)
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            counters = {name: dict(metric) for name, metric in self._counters.items()}
+            histograms = {name: {key: (list(h.buckets), h.count, h.sum) for key, h in metric.items()}
+                          for name, metric in self._histograms.items()}
+            collectors = list(self._collectors)
+
+        for name in sorted(counters):
+            self._header(lines, name, 'counter')
+            for key, value in sorted(counters[name].items()):
+                lines.append(PREFIX + name + _format_labels(key) + ' ' + str(value))
+
+        for name in sorted(histograms):
+            self._header(lines, name, 'histogram')
+            for key, (buckets, count, total) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, num in zip(BUCKETS, buckets):
+                    cumulative += num
+                    lines.append(PREFIX + name + '_bucket' + _format_labels(key + (('le', str(bound)),)) + ' ' + str(cumulative))
+                lines.append(PREFIX + name + '_bucket' + _format_labels(key + (('le', '+Inf'),)) + ' ' + str(count))
+                lines.append(PREFIX + name + '_sum' + _format_labels(key) + ' ' + repr(round(total, 6)))
+                lines.append(PREFIX + name + '_count' + _format_labels(key) + ' ' + str(count))
+
+        gauges = {}
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, []).append((tuple(sorted(labels.items())), value))
+            except Exception as e:
+                lines.append('# collector ' + getattr(collector, '__name__', '') + ' failed: ' + str(e).replace('\n', ' '))
+        for name in sorted(gauges):
+            self._header(lines, name, 'gauge')
+            for key, value in gauges[name]:
+                lines.append(PREFIX + name + _format_labels(key) + ' ' + str(value))
+
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, metric_type):
+        if name in self._help:
+            lines.append('# HELP ' + PREFIX + name + ' ' + self._help[name])
+        lines.append('# TYPE ' + PREFIX + name + ' ' + metric_type)
+
+
+class _Timer:
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+# Shared by everything in the process
+metrics = Metrics()
+metrics.describe('stage_seconds', 'Time spent in each stage of saving a post')
+metrics.describe('pipeline_stage_seconds', 'Time each post spends in a pipeline stage (download, persist, retry), including all of its steps')
+metrics.describe('download_bytes_total', 'Bytes downloaded from external hosts')
+metrics.describe('download_errors_total', 'Downloads that failed, by error')
+
+
+class MetricsExporter(GeneralUtils):
+    """
+    Makes `metrics` available to Prometheus, or anything else that reads its text format
+        metrics_file: rewritten every `interval` seconds (node_exporter textfile collector can read it)
+        port: served at http://<host>:<port>/metrics
+    """
+
+    def __init__(self, logger_name, metrics_file=None, port=0, host='127.0.0.1', interval=15, registry=None):
+        super().__init__(logger_name)
+        self.metrics = registry if registry is not None else metrics
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self._closed = threading.Event()
+
+        self.httpd = None
+        if port > 0:
+            self.httpd = _MetricsHTTPServer((host, port), _MetricsHandler)
+            self.httpd.metrics = self.metrics
+            server = threading.Thread(target=self.httpd.serve_forever, name="metrics_server")
+            server.setDaemon(True)
+            server.start()
+            self.log("Serving metrics on http://" + host + ":" + str(self.httpd.server_address[1]) + "/metrics", level='info')
+
+        if self.metrics_file is not None:
+            writer = threading.Thread(target=self._writer, name="metrics_writer")
+            writer.setDaemon(True)
+            writer.start()
+
+    def write(self):
+        # Write to a temp file then move it over, so it is never read half written
+        temp_file = self.metrics_file + '.tmp'
+        with self.open_file(temp_file, 'w') as f:
+            f.write(self.metrics.render())
+        os.replace(temp_file, self.metrics_file)
+
+    def close(self):
+        self._closed.set()
+        if self.metrics_file is not None:
+            self.write()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def _writer(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                self.log("Exception writing metrics: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+
+
+class _MetricsHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
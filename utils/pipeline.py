@@ -0,0 +1,90 @@
+import time
+import threading
+import traceback
+from utils.general_utils import GeneralUtils
+from utils.metrics import metrics
+
+
+class StageCounter:
+    """
+    Thread safe count of items a stage has worked on and the time spent on them
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.processed = 0
+        self.passed = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, took, passed=True):
+        """
+        :param took: seconds spent on the item
+        :param passed: `False` if the item was dropped by the stage
+        """
+        with self._lock:
+            self.processed += 1
+            self.busy += took
+            if passed:
+                self.passed += 1
+
+    def stats(self):
+        """
+        :return: dict of items processed/passed on, items per second and avg seconds per item
+        """
+        with self._lock:
+            run_time = max(time.time() - self.started, 0.001)
+            return {'name': self.name,
+                    'processed': self.processed,
+                    'passed': self.passed,
+                    'per_sec': self.processed / run_time,
+                    'avg_time': self.busy / self.processed if self.processed else 0,
+                    }
+
+
+class Stage(GeneralUtils):
+    """
+    Pool of worker threads running `func` on every item from `in_q`
+    Whatever `func` returns is passed on to `out_q`, unless it is None or False
+    """
+
+    def __init__(self, name, func, in_q, num_threads, out_q=None, logger_name='root'):
+        super().__init__(logger_name)
+        self.name = name
+        self.func = func
+        self.in_q = in_q
+        self.out_q = out_q
+        self.num_threads = max(1, num_threads)
+        self.counter = StageCounter(name)
+
+    def start(self):
+        for i in range(self.num_threads):
+            worker = threading.Thread(target=self._worker, name=self.name + "_worker-" + str(i))
+            worker.setDaemon(True)
+            worker.start()
+
+    def _worker(self):
+        while True:
+            item = self.in_q.get()
+            start = time.time()
+            result = None
+            try:
+                result = self.func(item)
+            except Exception as e:
+                self.log("Exception in " + self.name + " stage: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+            passed = result is not None and result is not False
+            took = time.time() - start
+            self.counter.add(took, passed=passed)
+            metrics.observe('pipeline_stage_seconds', took, stage=self.name)
+
+            if passed and self.out_q is not None:
+                # Blocks if the next stage is full
+                self.out_q.put(result)
+            self.in_q.task_done()
+
+    def stats(self):
+        stats = self.counter.stats()
+        stats['threads'] = self.num_threads
+        stats['queue'] = self.in_q.qsize()
+        return stats
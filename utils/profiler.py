@@ -0,0 +1,202 @@
+import os
+import re
+import sys
+import time
+import pstats
+import signal
+import cProfile
+import threading
+import traceback
+from utils.general_utils import GeneralUtils
+
+# Frames deeper then this are cut off, only the ones nearest the thread start are kept
+MAX_DEPTH = 128
+
+
+class SamplingProfiler(GeneralUtils):
+    """
+    Looks at what every thread is doing every `interval` seconds and counts each stack it sees
+    The counts are saved in the collapsed format flamegraph.pl/speedscope/inferno read, one stack per line:
+        download_worker;run (threading.py:982);_worker (pipeline.py:70);download_post (main.py:640) 42
+    Threads with the same name apart from a -<n> at the end are counted together
+    Saved to <out_dir>/<name>-<time>.collapsed after `duration` seconds (0 for when stop() is called)
+    and each time the process gets SIGUSR1
+    """
+
+    def __init__(self, logger_name, out_dir, interval=0.01, duration=0, name='profile'):
+        super().__init__(logger_name)
+        self.out_dir = out_dir
+        self.name = name
+        self.interval = interval
+        self.duration = duration
+
+        self.counts = {}
+        self.num_samples = 0
+        self._lock = threading.Lock()
+        # Labels for code objects we have already seen
+        self._labels = {}
+
+        self._stopped = threading.Event()
+        self._dump_now = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self._signal_dump)
+        self._thread = threading.Thread(target=self._sampler, name="profiler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self.log("Profiling every " + str(self.interval) + "s, saving to " + self.out_dir +
+                 (" after " + str(self.duration) + "s" if self.duration > 0 else ""), level='info')
+
+    def stop(self):
+        """
+        Stop sampling and save what we have, if it was not already saved when `duration` was up
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.dump()
+
+    def dump(self):
+        """
+        Save the stacks counted so far
+        :return: path of the file saved, None if there was nothing to save
+        """
+        with self._lock:
+            counts = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+            num_samples = self.num_samples
+        if len(counts) == 0:
+            return None
+
+        profile_file = os.path.join(self.out_dir, self.name + '-' + time.strftime('%Y%m%d-%H%M%S') + '.collapsed')
+        temp_file = profile_file + '.tmp'
+        with self.open_file(temp_file, 'w') as f:
+            for stack, count in counts:
+                f.write(stack + ' ' + str(count) + "\n")
+        os.replace(temp_file, profile_file)
+        self.log("Saved profile of " + str(num_samples) + " samples: " + profile_file, level='info')
+        return profile_file
+
+    def sample(self):
+        """
+        Count the stack of every thread once
+        """
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code))
+                frame = frame.f_back
+            frames = frames[-MAX_DEPTH:]
+            frames.append(self._thread_group(names.get(thread_id, 'unknown')))
+            frames.reverse()
+            stacks.append(';'.join(frames))
+
+        with self._lock:
+            self.num_samples += 1
+            for stack in stacks:
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = (code.co_name + ' (' + os.path.basename(code.co_filename) + ':' +
+                     str(code.co_firstlineno) + ')').replace(';', ':')
+            self._labels[code] = label
+        return label
+
+    def _thread_group(self, name):
+        """
+        :return: `name` without the worker number, download_worker-3 -> download_worker
+        """
+        return re.sub(r'-\d+$', '', name).replace(';', ':').replace(' ', '_')
+
+    def _signal_dump(self, signum, frame):
+        # Do the saving in the sampler thread, not in the middle of whatever the main thread was doing
+        self._dump_now.set()
+
+    def _sampler(self):
+        started = time.time()
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+                if self._dump_now.is_set():
+                    self._dump_now.clear()
+                    self.dump()
+            except Exception as e:
+                self.log("Exception profiling: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+
+            if self.duration > 0 and time.time() - started >= self.duration:
+                self._stopped.set()
+                self.dump()
+
+
+class ThreadProfiler(GeneralUtils):
+    """
+    Deterministic profile (cProfile) of every thread started after start(), including the one calling it
+    Gives exact call counts but slows everything down a lot, so best used with a single worker thread
+    Saved to <out_dir>/<name>-<time>.pstats (open with `python3 -m pstats <file>` or snakeviz),
+    plus the top functions by cumulative time in a .txt next to it
+    """
+
+    def __init__(self, logger_name, out_dir, name='profile'):
+        super().__init__(logger_name)
+        self.out_dir = out_dir
+        self.name = name
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self._thread_start)
+        self._enable()
+        self.log("Profiling with cProfile, saving to " + self.out_dir, level='info')
+
+    def stop(self):
+        threading.setprofile(None)
+        with self._lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+
+        stats = None
+        for profile in profiles:
+            # Threads that never got to call anything have no stats
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                pass
+        if stats is None:
+            return None
+
+        profile_file = os.path.join(self.out_dir, self.name + '-' + time.strftime('%Y%m%d-%H%M%S') + '.pstats')
+        stats.dump_stats(profile_file)
+        with self.open_file(os.path.splitext(profile_file)[0] + '.txt', 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(50)
+        self.log("Saved profile of " + str(len(profiles)) + " threads: " + profile_file, level='info')
+        return profile_file
+
+    def _thread_start(self, frame, event, arg):
+        # Called once in each new thread, swap this hook out for a profiler of its own
+        sys.setprofile(None)
+        self._enable()
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ only allows one at a time, the one already running sees every thread
+            return
+        with self._lock:
+            self.profiles.append(profile)
@@ -0,0 +1,104 @@
+import time
+import random
+from utils.sqlite_db import SqliteDb
+
+
+class RetryQueue:
+    """
+    Posts whose media failed to download, with when to try them next
+    Each failure waits twice as long as the last (with some jitter so a host that was down
+    does not get them all back at once), after `max_attempts` they are moved to the dead letters
+    """
+
+    def __init__(self, db_file, max_attempts=5, base_delay=300, max_delay=86400, lease=3600):
+        """
+        :param base_delay: seconds to wait after the first failure
+        :param max_delay: most seconds to wait between tries
+        :param lease: seconds a claimed post is hidden for, in case it never reports back
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.index = SqliteDb(db_file, schema=(
+            '''CREATE TABLE IF NOT EXISTS retries (
+                 post_path TEXT PRIMARY KEY,
+                 url TEXT NOT NULL,
+                 domain TEXT,
+                 attempts INTEGER NOT NULL,
+                 last_error TEXT,
+                 next_retry REAL NOT NULL,
+                 dead INTEGER NOT NULL DEFAULT 0,
+                 added REAL NOT NULL)''',
+            'CREATE INDEX IF NOT EXISTS retries_due ON retries (dead, next_retry)',
+        ))
+
+    def next_delay(self, attempts):
+        """
+        :return: seconds to wait before the next try after `attempts` failures
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def add_failure(self, post_path, url, domain, error, permanent=False):
+        """
+        Record a failed download for the post at `post_path`
+        :param permanent: the error will not go away by waiting, go straight to the dead letters
+        :return: `True` if the post is now a dead letter
+        """
+        now = time.time()
+        with self.index.db() as db:
+            row = db.execute('SELECT attempts, added FROM retries WHERE post_path = ?', (post_path,)).fetchone()
+            attempts = 1
+            added = now
+            if row is not None:
+                attempts = row[0] + 1
+                added = row[1]
+            is_dead = permanent or attempts >= self.max_attempts
+            db.execute('INSERT OR REPLACE INTO retries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (post_path, url, domain, attempts, error, now + self.next_delay(attempts), int(is_dead), added))
+        return is_dead
+
+    def claim_due(self, limit=100):
+        """
+        Get the posts due for a retry, they will not be given out again until `lease` is up
+        :return: list of (post_path, url, attempts)
+        """
+        now = time.time()
+        with self.index.db() as db:
+            # Take the write lock before looking, so two shards can not claim the same posts
+            db.execute('BEGIN IMMEDIATE')
+            rows = db.execute('SELECT post_path, url, attempts FROM retries WHERE dead = 0 AND next_retry <= ? '
+                              'ORDER BY next_retry LIMIT ?', (now, limit)).fetchall()
+            db.executemany('UPDATE retries SET next_retry = ? WHERE post_path = ?',
+                           [(now + self.lease, row[0]) for row in rows])
+        return rows
+
+    def remove(self, post_path):
+        """
+        The post got its media, stop trying
+        """
+        with self.index.db() as db:
+            db.execute('DELETE FROM retries WHERE post_path = ?', (post_path,))
+
+    def dead_letters(self, limit=100, offset=0):
+        """
+        :return: list of dicts of the posts we gave up on, newest first
+        """
+        cur = self.index.db().execute('SELECT * FROM retries WHERE dead = 1 ORDER BY next_retry DESC LIMIT ? OFFSET ?',
+                                      (limit, offset))
+        columns = [column[0] for column in cur.description]
+        return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    def stats(self):
+        """
+        :return: dict of posts waiting to be retried and posts given up on
+        """
+        rows = self.index.db().execute('SELECT dead, COUNT(*) FROM retries GROUP BY dead').fetchall()
+        counts = dict(rows)
+        return {'waiting': counts.get(0, 0),
+                'dead': counts.get(1, 0),
+                }
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+import traceback
+import configparser
+from types import MappingProxyType
+from utils.general_utils import GeneralUtils
+
+try:
+    # Optional, lets us wait for the file to change instead of checking it
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class ScrapeFilter:
+    """
+    Read only snapshot of scrape.ini, built once each time the file changes
+    Never changed after it is created so it can be used from any thread without a lock
+    """
+
+    def __init__(self, subreddits=(), users=(), content={}):
+        self.subreddits = frozenset(name for name in subreddits if name)
+        self.users = frozenset(name for name in users if name)
+        # name -> `sfw` or `nsfw`
+        self.content = MappingProxyType(dict(content))
+
+        self.all_subreddits = 'all' in self.subreddits
+        self.all_content = self.content.get('all')
+
+    @classmethod
+    def from_file(cls, scrape_config_file):
+        """
+        :return: ScrapeFilter built from `scrape_config_file`
+        """
+        config = configparser.ConfigParser()
+        config.read(scrape_config_file)
+
+        feeds = {'subreddits': [], 'users': []}
+        content = {}
+        # Break down the params in the user and subreddit lists
+        for feed in feeds:
+            for line in config['scrape'].get(feed, '').split("\n"):
+                option = line.lower().split(',')
+                name = option[0].strip()
+                feeds[feed].append(name)
+                if len(option) > 1:
+                    content[name] = option[1].strip().lower()
+
+        return cls(feeds['subreddits'], feeds['users'], content)
+
+    def is_empty(self):
+        """
+        :return: `True` if there are no users or subreddits to scrape
+        """
+        return len(self.subreddits) == 0 and len(self.users) == 0
+
+    def wants(self, subreddit, author, over_18):
+        """
+        :param subreddit: lower case subreddit name
+        :param author: lower case username
+        :return: `True` if the post should be saved
+        """
+        # Check if we even want this post
+        if not self.all_subreddits:
+            if subreddit not in self.subreddits and author not in self.users:
+                return False
+
+        # Check if we want only sfw or nsfw content from this subreddit
+        rule = self.all_content
+        if rule is None:
+            rule = self.content.get(subreddit)
+        if rule == 'nsfw' and over_18 is False:
+            return False
+        elif rule == 'sfw' and over_18 is True:
+            return False
+
+        return True
+
+
+class ScrapeConfigWatcher(GeneralUtils):
+    """
+    Keeps `current` up to date with scrape.ini
+    The file is only parsed again when its mtime/inode/size changes, then the new snapshot
+    is swapped in with a single assignment
+    """
+
+    def __init__(self, scrape_config_file, logger_name, interval=10, on_reload=None):
+        super().__init__(logger_name)
+        self.scrape_config_file = scrape_config_file
+        self.interval = interval
+        # Called with the new ScrapeFilter after each reload
+        self.on_reload = on_reload
+
+        self._signature = None
+        self.current = ScrapeFilter()
+        self.reload()
+
+    def start(self):
+        watcher = threading.Thread(target=self._watch, name="scrape_config_watcher")
+        watcher.setDaemon(True)
+        watcher.start()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.scrape_config_file)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def reload(self):
+        """
+        Build a new snapshot if the file has changed
+        :return: `True` if it was reloaded
+        """
+        signature = self._file_signature()
+        if signature is None:
+            if self._signature is not None:
+                self.log("Scrape config file not found: " + self.scrape_config_file, level='error')
+                self._signature = None
+            return False
+        if signature == self._signature:
+            return False
+
+        new_filter = ScrapeFilter.from_file(self.scrape_config_file)
+        self._signature = signature
+        self.current = new_filter
+
+        self.log("Reloaded scape config: " + str(sorted(new_filter.subreddits)), level='debug')
+        if self.on_reload is not None:
+            self.on_reload(new_filter)
+        return True
+
+    def _watch(self):
+        if inotify_simple is not None:
+            inotify = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            # Watch the dir, editors often replace the file instead of writing to it
+            inotify.add_watch(os.path.dirname(os.path.abspath(self.scrape_config_file)),
+                              flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE)
+
+        while True:
+            if inotify_simple is not None:
+                inotify.read(timeout=int(self.interval * 1000))
+            else:
+                time.sleep(self.interval)
+            try:
+                self.reload()
+            except Exception as e:
+                self.log("Exception reloading scrape config: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
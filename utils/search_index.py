@@ -0,0 +1,215 @@
+import re
+import time
+import sqlite3
+import calendar
+import threading
+import traceback
+from datetime import datetime
+from utils.sqlite_db import SqliteDb
+from utils.general_utils import GeneralUtils
+
+
+def parse_date(value):
+    """
+    :param value: epoch seconds or YYYY-MM-DD (UTC)
+    :return: epoch seconds, None if `value` is empty
+    """
+    if value is None or str(value).strip() == '':
+        return None
+    value = str(value).strip()
+    if re.match(r'^\d{4}-\d{1,2}-\d{1,2}$', value):
+        return float(calendar.timegm(datetime.strptime(value, '%Y-%m-%d').timetuple()))
+    return float(value)
+
+
+class SearchIndex(GeneralUtils):
+    """
+    Full text search over the title, selftext, author, subreddit, domain and url of saved posts
+    Uses a sqlite FTS5 table that only stores the index, the text itself stays in the post.json files
+    Posts are added in batches of `batch_size`, or every `flush_interval` seconds
+    """
+
+    def __init__(self, db_file, logger_name, batch_size=500, flush_interval=5):
+        super().__init__(logger_name)
+        self.index = SqliteDb(db_file, schema=(
+            '''CREATE TABLE IF NOT EXISTS docs (
+                 rowid INTEGER PRIMARY KEY,
+                 id TEXT NOT NULL UNIQUE,
+                 subreddit TEXT NOT NULL COLLATE NOCASE,
+                 author TEXT NOT NULL COLLATE NOCASE,
+                 created_utc REAL NOT NULL,
+                 title TEXT,
+                 path TEXT NOT NULL,
+                 web_path TEXT)''',
+            'CREATE INDEX IF NOT EXISTS docs_subreddit ON docs (subreddit, created_utc)',
+            'CREATE INDEX IF NOT EXISTS docs_author ON docs (author, created_utc)',
+            'CREATE INDEX IF NOT EXISTS docs_created ON docs (created_utc)',
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5 (
+                 title, selftext, author, subreddit, domain, url,
+                 content='')''',
+            '''CREATE TABLE IF NOT EXISTS meta (
+                 key TEXT PRIMARY KEY,
+                 value TEXT)''',
+        ))
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+        self._closed = threading.Event()
+        flusher = threading.Thread(target=self._flusher, name="search_index_flusher")
+        flusher.setDaemon(True)
+        flusher.start()
+
+    def post_row(self, post, post_path):
+        """
+        :return: tuple to add to the index for `post`
+        """
+        return (post['id'],
+                post.get('subreddit_original', post['subreddit']),
+                post.get('author_original', post['author']),
+                post['created_utc'],
+                post.get('title') or '',
+                post.get('selftext') or '',
+                post.get('domain') or '',
+                post.get('url') or '',
+                post_path,
+                post.get('post_web_path'),
+                )
+
+    def add_post(self, post, post_path):
+        """
+        Queue `post` to be added to the index
+        """
+        rows = None
+        with self._lock:
+            self._pending.append(self.post_row(post, post_path))
+            if len(self._pending) >= self.batch_size:
+                rows = self._pending
+                self._pending = []
+        if rows is not None:
+            self.add_rows(rows)
+
+    def add_rows(self, rows):
+        """
+        Add rows from post_row(), posts already in the index are skipped
+        """
+        with self.index.db() as db:
+            for post_id, subreddit, author, created_utc, title, selftext, domain, url, path, web_path in rows:
+                cur = db.execute('INSERT OR IGNORE INTO docs (id, subreddit, author, created_utc, title, path, web_path) '
+                                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (post_id, subreddit, author, created_utc, title, path, web_path))
+                if cur.rowcount != 1:
+                    continue
+                db.execute('INSERT INTO posts_fts (rowid, title, selftext, author, subreddit, domain, url) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (cur.lastrowid, title, selftext, author, subreddit, domain, url))
+
+    def flush(self):
+        with self._lock:
+            rows = self._pending
+            self._pending = []
+        if len(rows) > 0:
+            self.add_rows(rows)
+
+    def clear(self):
+        """
+        Remove everything, used before rebuilding the index
+        """
+        with self.index.db() as db:
+            db.execute("INSERT INTO posts_fts (posts_fts) VALUES ('delete-all')")
+            db.execute('DELETE FROM docs')
+            db.execute("DELETE FROM meta WHERE key = 'built'")
+
+    def is_built(self):
+        """
+        :return: `True` once a rebuild has added everything already in the save path
+        """
+        row = self.index.db().execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone()
+        return row is not None
+
+    def set_built(self):
+        with self.index.db() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', ?)", (str(time.time()),))
+
+    def optimize(self):
+        """
+        Merge the index into one b-tree, makes queries faster after a big rebuild
+        """
+        with self.index.db() as db:
+            db.execute("INSERT INTO posts_fts (posts_fts) VALUES ('optimize')")
+
+    def count(self):
+        return self.index.db().execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def search(self, query, subreddit=None, author=None, after=None, before=None, sort='relevance', limit=50, offset=0):
+        """
+        :param query: FTS5 query (`cat OR dog`, `title:cat`, `"two words"`, `cat*`), if it is not valid
+                      FTS5 each word is searched for as is
+        :param after: only posts created on or after this time (epoch seconds)
+        :param before: only posts created before this time (epoch seconds)
+        :param sort: `relevance`, `new` or `old`
+        :return: list of dicts with id, subreddit, author, created_utc, title, path, web_path
+        """
+        where = ['posts_fts MATCH ?']
+        args = []
+        if subreddit:
+            where.append('docs.subreddit = ?')
+            args.append(subreddit)
+        if author:
+            where.append('docs.author = ?')
+            args.append(author)
+        if after is not None:
+            where.append('docs.created_utc >= ?')
+            args.append(after)
+        if before is not None:
+            where.append('docs.created_utc < ?')
+            args.append(before)
+
+        order = 'posts_fts.rank'
+        if sort == 'new':
+            order = 'docs.created_utc DESC'
+        elif sort == 'old':
+            order = 'docs.created_utc'
+
+        sql = ('SELECT docs.id, docs.subreddit, docs.author, docs.created_utc, docs.title, docs.path, docs.web_path '
+               'FROM posts_fts JOIN docs ON docs.rowid = posts_fts.rowid WHERE ' + ' AND '.join(where) +
+               ' ORDER BY ' + order + ' LIMIT ? OFFSET ?')
+        try:
+            rows = self.index.db().execute(sql, [query] + args + [limit, offset]).fetchall()
+        except sqlite3.OperationalError:
+            # Not a valid FTS5 query, look for the words instead
+            rows = self.index.db().execute(sql, [self.quote_query(query)] + args + [limit, offset]).fetchall()
+
+        results = []
+        for row in rows:
+            results.append(dict(zip(['id', 'subreddit', 'author', 'created_utc', 'title', 'path', 'web_path'], row)))
+        return results
+
+    def quote_query(self, query):
+        """
+        :return: `query` with each word quoted, so nothing in it is read as FTS5 syntax
+        """
+        terms = []
+        for word in query.split():
+            prefix = word.endswith('*') and len(word) > 1
+            word = word.rstrip('*')
+            if word:
+                terms.append('"' + word.replace('"', '""') + '"' + ('*' if prefix else ''))
+        return ' '.join(terms) or '""'
+
+    def close(self):
+        self._closed.set()
+        try:
+            self.flush()
+        except Exception as e:
+            self.log("Exception flushing search index: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+        self.index.close()
+
+    def _flusher(self):
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.log("Exception flushing search index: " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
@@ -0,0 +1,76 @@
+import os
+import zlib
+import threading
+import contextlib
+
+try:
+    # Not on windows, there the locks only work between threads
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def shard_for(key, num_shards):
+    """
+    :return: shard `key` (an author or subreddit) belongs to, the same in every process and every run unlike hash()
+    """
+    return zlib.crc32(key.lower().encode('utf-8')) % num_shards
+
+
+def parse_shard(value):
+    """
+    :param value: `<n>/<shards>` from --shard, n starts at 0
+    :return: (n, shards)
+    """
+    shard, _, num_shards = value.partition('/')
+    shard, num_shards = int(shard), int(num_shards)
+    if num_shards < 1 or not 0 <= shard < num_shards:
+        raise ValueError("Bad shard: " + value)
+    return shard, num_shards
+
+
+class ShardStream:
+    """
+    Posts the supervisor sent to this shard, one json line each
+    Ends when the supervisor closes the pipe
+    """
+
+    def __init__(self, in_file, serializer):
+        self.in_file = in_file
+        self.serializer = serializer
+
+    def __iter__(self):
+        for line in self.in_file:
+            line = line.strip()
+            if line:
+                yield self.serializer.decode(line)
+
+
+class ProcessLocks:
+    """
+    Locks shared by every process saving to the same save path, for the files more then one shard writes to
+    (subreddit urls.csv/listing.json, failed_domains.csv)
+    Paths are spread over `stripes` lock files in `lock_dir`, each held with flock
+    """
+
+    def __init__(self, lock_dir, stripes=64):
+        os.makedirs(lock_dir, exist_ok=True)
+        self._files = [open(os.path.join(lock_dir, str(i) + '.lock'), 'a') for i in range(stripes)]
+        # flock is held by the process, so threads in this one still need to take turns
+        self._locks = [threading.Lock() for i in range(stripes)]
+
+    @contextlib.contextmanager
+    def lock(self, path):
+        stripe = zlib.crc32(path.encode('utf-8')) % len(self._locks)
+        with self._locks[stripe]:
+            if fcntl is not None:
+                fcntl.flock(self._files[stripe].fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._files[stripe].fileno(), fcntl.LOCK_UN)
+
+    def close(self):
+        for f in self._files:
+            f.close()
@@ -0,0 +1,192 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+class SpillQueue:
+    """
+    Queue that keeps up to `maxsize` items in memory and appends anything past that to
+    segment files on disk, which are read back in order as the workers catch up
+    Items must be json serializable
+    Works like queue.Queue: put/get/task_done/join/qsize
+    """
+
+    def __init__(self, spill_dir, maxsize=1000, segment_size=64 * 1024 * 1024):
+        self.spill_dir = spill_dir
+        self.maxsize = max(1, maxsize)
+        self.segment_size = segment_size
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._all_tasks_done = threading.Condition(self._lock)
+        self._unfinished_tasks = 0
+
+        # (time added, item)
+        self._mem = deque()
+
+        # Segment files, oldest first. We read from the first one and write to the last one
+        self._segments = deque()
+        self._segment_num = 0
+        self._write_fh = None
+        self._read_fh = None
+        self._disk_items = 0
+        # When the next item to be read from disk was added, at most (the last one read back or the first spilled)
+        self._disk_oldest = None
+
+        # Total bytes ever written to disk
+        self.bytes_spilled = 0
+
+        self._recover()
+
+    ##########
+    # Queue api
+    ##########
+    def put(self, item):
+        with self._lock:
+            # Once we have started spilling, keep going to disk so the order stays the same
+            if self._disk_items == 0 and len(self._mem) < self.maxsize:
+                self._mem.append((time.time(), item))
+            else:
+                self._spill(time.time(), item)
+            self._unfinished_tasks += 1
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while len(self._mem) == 0 and self._disk_items == 0:
+                self._not_empty.wait()
+            if len(self._mem) == 0:
+                self._refill()
+            added, item = self._mem.popleft()
+            return item
+
+    def task_done(self):
+        with self._all_tasks_done:
+            unfinished = self._unfinished_tasks - 1
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            self._unfinished_tasks = unfinished
+            if unfinished == 0:
+                self._all_tasks_done.notify_all()
+
+    def join(self):
+        with self._all_tasks_done:
+            while self._unfinished_tasks:
+                self._all_tasks_done.wait()
+
+    def qsize(self):
+        with self._lock:
+            return len(self._mem) + self._disk_items
+
+    def stats(self):
+        """
+        :return: dict of items in memory/on disk, total bytes spilled and age of the oldest item in seconds
+        """
+        with self._lock:
+            oldest_age = 0
+            # Everything in memory was added before anything on disk
+            if len(self._mem) > 0:
+                oldest_age = time.time() - self._mem[0][0]
+            elif self._disk_items > 0 and self._disk_oldest is not None:
+                oldest_age = time.time() - self._disk_oldest
+            return {'memory': len(self._mem),
+                    'disk': self._disk_items,
+                    'bytes_spilled': self.bytes_spilled,
+                    'oldest_age': oldest_age,
+                    }
+
+    ##########
+    # Disk
+    ##########
+    def _segment_file(self, num):
+        return os.path.join(self.spill_dir, "segment-" + str(num).zfill(8) + ".jsonl")
+
+    def _spill(self, added, item):
+        """
+        Must hold self._lock
+        """
+        if self._write_fh is None or self._write_fh.tell() >= self.segment_size:
+            self._new_segment()
+        line = json.dumps([added, item]) + "\n"
+        self._write_fh.write(line)
+        self._write_fh.flush()
+        if self._disk_items == 0:
+            self._disk_oldest = added
+        self._disk_items += 1
+        self.bytes_spilled += len(line)
+
+    def _new_segment(self):
+        if self._write_fh is not None:
+            self._write_fh.close()
+        self._segment_num += 1
+        segment = self._segment_file(self._segment_num)
+        self._segments.append(segment)
+        self._write_fh = open(segment, 'a')
+
+    def _refill(self):
+        """
+        Move the oldest items on disk back into memory
+        Must hold self._lock
+        """
+        while len(self._mem) < self.maxsize and self._disk_items > 0 and len(self._segments) > 0:
+            if self._read_fh is None:
+                self._read_fh = open(self._segments[0], 'r')
+                self._read_fh.seek(self._read_pos(self._segments[0]))
+
+            line = self._read_fh.readline()
+            if line.endswith("\n"):
+                added, item = json.loads(line)
+                self._mem.append((added, item))
+                self._disk_items -= 1
+                self._disk_oldest = added
+                continue
+
+            # Hit the end of the segment, move on to the next one
+            self._read_fh.close()
+            self._read_fh = None
+            segment = self._segments.popleft()
+            if len(self._segments) == 0:
+                # We were also writing to this one
+                self._write_fh.close()
+                self._write_fh = None
+            os.remove(segment)
+            if os.path.isfile(segment + ".pos"):
+                os.remove(segment + ".pos")
+
+        if self._read_fh is not None:
+            # Remember how far we got in case the process dies
+            with open(self._segments[0] + ".pos", 'w') as f:
+                f.write(str(self._read_fh.tell()))
+
+    def _read_pos(self, segment):
+        try:
+            with open(segment + ".pos") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _recover(self):
+        """
+        Pick up anything left on disk by a previous run
+        """
+        segments = sorted(name for name in os.listdir(self.spill_dir)
+                          if name.startswith("segment-") and name.endswith(".jsonl"))
+        for name in segments:
+            segment = os.path.join(self.spill_dir, name)
+            self._segments.append(segment)
+            self._segment_num = max(self._segment_num, int(name[8:16]))
+            with open(segment, 'r') as f:
+                f.seek(self._read_pos(segment))
+                for line in f:
+                    if line.endswith("\n"):
+                        if self._disk_items == 0:
+                            self._disk_oldest = json.loads(line)[0]
+                        self._disk_items += 1
+                        self._unfinished_tasks += 1
+
+        if len(self._segments) > 0:
+            # Never append to a segment a previous run was writing to, it may end with a partial line
+            self._new_segment()
@@ -0,0 +1,43 @@
+import os
+import sqlite3
+import threading
+
+
+class SqliteDb:
+    """
+    sqlite database that can be used from any thread
+    sqlite connections can not be shared between threads so each thread gets its own
+    """
+
+    def __init__(self, db_file, schema=()):
+        self.db_file = db_file
+        self._local = threading.local()
+
+        db_dir = os.path.dirname(db_file)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        with self.db() as db:
+            for statement in schema:
+                db.execute(statement)
+
+    def db(self):
+        """
+        :return: sqlite connection for the current thread
+        """
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.db_file, timeout=60)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def close(self):
+        """
+        Close the connection for the current thread
+        """
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -0,0 +1,58 @@
+import os
+import json
+import time
+from utils.sqlite_db import SqliteDb
+
+
+class UrlIndex:
+    """
+    Remembers what files each url gave us so a repeat of the url does not need to be downloaded again
+    Urls that are gone (404/410, or nothing to download on the page) are kept for `dead_ttl` seconds
+    so we do not keep retrying dead links
+    """
+
+    def __init__(self, index_file, dead_ttl=86400):
+        self.dead_ttl = dead_ttl
+        self.index = SqliteDb(index_file, schema=(
+            '''CREATE TABLE IF NOT EXISTS urls (
+                 url TEXT PRIMARY KEY,
+                 files TEXT NOT NULL,
+                 is_dead INTEGER NOT NULL,
+                 checked REAL NOT NULL)''',
+        ))
+
+    def lookup(self, url_key):
+        """
+        :return: list of (hash, ext, size, path) for the url,
+                 empty list if it is a known dead link,
+                 None if we have not seen it (or the dead entry expired)
+        """
+        row = self.index.db().execute('SELECT files, is_dead, checked FROM urls WHERE url = ?',
+                                      (url_key,)).fetchone()
+        if row is None:
+            return None
+
+        files, is_dead, checked = row
+        if is_dead:
+            if time.time() - checked > self.dead_ttl:
+                return None
+            return []
+
+        return [tuple(item) for item in json.loads(files)]
+
+    def record(self, url_key, file_list):
+        """
+        Save what `url_key` gave us
+        :param file_list: saved file paths, named <hash>.<ext>, empty if the url is dead
+        """
+        files = []
+        for saved_file in file_list:
+            file_hash, _, file_ext = os.path.basename(saved_file).partition('.')
+            files.append((file_hash, file_ext, os.path.getsize(saved_file), saved_file))
+
+        with self.index.db() as db:
+            db.execute('INSERT OR REPLACE INTO urls (url, files, is_dead, checked) VALUES (?, ?, ?, ?)',
+                       (url_key, json.dumps(files), len(files) == 0, time.time()))
+
+    def close(self):
+        self.index.close()
@@ -0,0 +1,82 @@
+import threading
+import traceback
+from utils.general_utils import GeneralUtils
+from utils.metrics import metrics
+
+
+class WriteBehindAppender(GeneralUtils):
+    """
+    Buffers lines to append to files and writes each file's lines out in one go
+    A file is written once it has `flush_lines` waiting, every `flush_interval` seconds, or on close()
+    Files are spread over a fixed number of locks so memory does not grow with the number of files
+    """
+
+    def __init__(self, logger_name, flush_lines=100, flush_interval=5, stripes=64):
+        super().__init__(logger_name)
+        self.flush_lines = max(1, flush_lines)
+        self.flush_interval = flush_interval
+
+        # Each stripe has its own lock and its own dict of file -> lines waiting
+        self._locks = [threading.Lock() for i in range(max(1, stripes))]
+        self._buffers = [{} for i in range(len(self._locks))]
+
+        # Per stripe counts of lines buffered and files written, to see how many writes we save
+        self._lines = [0] * len(self._locks)
+        self._writes = [0] * len(self._locks)
+
+        self._closed = threading.Event()
+        flusher = threading.Thread(target=self._flusher, name="write_behind_flusher")
+        flusher.setDaemon(True)
+        flusher.start()
+
+    def append(self, save_file, content):
+        """
+        Queue `content` to be appended as a line to `save_file`
+        """
+        stripe = hash(save_file) % len(self._locks)
+        with self._locks[stripe]:
+            buffer = self._buffers[stripe]
+            lines = buffer.setdefault(save_file, [])
+            lines.append(content + "\n")
+            self._lines[stripe] += 1
+            if len(lines) >= self.flush_lines:
+                # Write while holding the lock so lines for a file stay in order
+                self._write(stripe, save_file, buffer.pop(save_file))
+
+    def flush(self):
+        """
+        Write out everything that is waiting
+        """
+        for stripe in range(len(self._locks)):
+            with self._locks[stripe]:
+                buffer = self._buffers[stripe]
+                for save_file in list(buffer):
+                    self._write(stripe, save_file, buffer.pop(save_file))
+
+    def stats(self):
+        """
+        :return: dict of lines appended and times a file was written
+        """
+        return {'lines': sum(self._lines),
+                'writes': sum(self._writes),
+                }
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+    def _write(self, stripe, save_file, lines):
+        """
+        Must hold the lock for `stripe`
+        """
+        try:
+            with metrics.timer('stage_seconds', stage='csv_write', domain='', extractor=''), self.process_lock(save_file):
+                with self.open_file(save_file, 'a') as f:
+                    f.write(''.join(lines))
+            self._writes[stripe] += 1
+        except Exception as e:
+            self.log("Exception appending to " + save_file + ": " + str(e) + "\n" + str(traceback.format_exc()), level='critical')
+
+    def _flusher(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()